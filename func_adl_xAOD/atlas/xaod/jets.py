@@ -1,10 +1,25 @@
 # Code to aid with accessing jet collections
+#
+# Attributes are read with an `SG::AuxElement::ConstAccessor`, a member of the query class that is
+# made once for each attribute name. Reading through `getAttribute` would look the name up again
+# for every object in every event.
 import ast
+from functools import partial
+from typing import cast
 
 import func_adl_xAOD.common.cpp_ast as cpp_ast
-import func_adl_xAOD.common.cpp_representation as crep
 import func_adl_xAOD.common.cpp_types as ctyp
-from func_adl_xAOD.common.cpp_vars import unique_name
+
+
+def _attribute_accessor(call_node: ast.Call, cpp_type: str) -> cpp_ast.CPPCodeValue:
+    'Return C++ that reads the attribute named in `call_node` with a class member accessor'
+    moment_name = cast(ast.Str, call_node.args[0]).s
+    r = cpp_ast.CPPCodeValue()
+    r.class_include_files += ['AthContainers/AuxElement.h']
+    r.class_members += [('attrib_accessor', f'SG::AuxElement::ConstAccessor<{cpp_type}>', f'"{moment_name}"')]
+    r.replacement_instance_obj = ('obj_j', call_node.func.value.id)  # type: ignore
+    r.result = 'attrib_accessor(*obj_j)'
+    return r
 
 
 def getAttributeFloatAst(call_node: ast.Call):
@@ -17,13 +32,8 @@ def getAttributeFloatAst(call_node: ast.Call):
     if not isinstance(call_node.args[0], ast.Str):
         raise Exception("Calling getAttributeFloat - only acceptable argument is a string")
 
-    r = cpp_ast.CPPCodeValue()
-    # We don't need include files for this - just quick access
-    r.args = ['moment_name', ]
-    r.replacement_instance_obj = ('obj_j', call_node.func.value.id)  # type: ignore
-    r.running_code += ['float result = obj_j->getAttribute<float>(moment_name);']
-    r.result = 'result'
-    r.result_rep = lambda sc: crep.cpp_variable(unique_name("jet_attrib"), scope=sc, cpp_type=ctyp.terminal('float'))
+    r = _attribute_accessor(call_node, 'float')
+    r.result_rep = partial(cpp_ast.variable_result_rep, "jet_attrib", ctyp.terminal('float'))
 
     # Replace it as the function that is going to get called.
     call_node.func = r  # type: ignore
@@ -41,13 +51,10 @@ def getAttributeVectorFloatAst(call_node: ast.Call):
     if not isinstance(call_node.args[0], ast.Str):
         raise Exception("Calling getAttributeVectorFloat - only acceptable argument is a string")
 
-    r = cpp_ast.CPPCodeValue()
-    r.include_files += ['vector']
-    r.args = ['moment_name', ]
-    r.replacement_instance_obj = ('obj_j', call_node.func.value.id)  # type: ignore
-    r.running_code += ['auto result = obj_j->getAttribute<std::vector<double>>(moment_name);']
-    r.result = 'result'
-    r.result_rep = lambda sc: crep.cpp_collection(unique_name("jet_vec_attrib_"), scope=sc, collection_type=ctyp.collection(ctyp.terminal('double')))  # type: ignore
+    # The accessor returns a reference into the aux store, which is used as it is rather than copied.
+    r = _attribute_accessor(call_node, 'std::vector<double>')
+    r.class_include_files += ['vector']
+    r.result_rep = partial(cpp_ast.collection_result_rep, "jet_vec_attrib_", ctyp.collection(ctyp.terminal('double')))
 
     # Replace it as the function that is going to get called.
     call_node.func = r  # type: ignore
@@ -5,11 +5,11 @@ from func_adl_xAOD.common.executor import executor
 
 
 class cms_aod_executor(executor):
-    def __init__(self):
-        file_names = ['analyzer_cfg.py', 'Analyzer.cc', 'BuildFile.xml', "copy_root_tree.C", 'runner.sh']
+    def __init__(self, **kwargs):
+        file_names = ['analyzer_cfg.py', 'Analyzer.cc', 'func_adl_kinematics.h', 'BuildFile.xml', "copy_root_tree.C", 'runner.sh']
         runner_name = 'runner.sh'
         template_dir_name = 'func_adl_xAOD/template/cms/r5'
-        super().__init__(file_names, runner_name, template_dir_name, ec().get_method_names())
+        super().__init__(file_names, runner_name, template_dir_name, ec().get_method_names(), **kwargs)
 
     def get_visitor_obj(self):
         return cms_aod_query_ast_visitor()
@@ -0,0 +1,138 @@
+# Passes that prepare the aggregate terminals (`Count`, `Sum`, `Min`, `Max`, and `Aggregate`)
+# for translation.
+#
+# The translator implements each terminal directly, with an accumulator of the right type. These
+# passes put the calls into the form it expects, and find aggregates that can share a loop: a
+# query like `Select(lambda js: (js.Count(), js.Select(lambda j: j.pt()).Sum()))` would otherwise
+# run over the jets once for each column.
+import ast
+from typing import Dict, List, Optional, Tuple, cast
+
+from func_adl_xAOD.common.fingerprint import canonical_text
+
+# The terminals that loop over their source and keep a running value.
+aggregate_terminals = ['Count', 'Sum', 'Min', 'Max', 'Aggregate']
+
+# Sequence operators that only change, or filter, each item of their source.
+_per_item_operators = ['Select', 'Where']
+
+
+def _is_call_to(node: ast.AST, names: List[str]) -> bool:
+    return isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in names
+
+
+class normalize_aggregates(ast.NodeTransformer):
+    r'''
+    Rewrite the short forms of the aggregate terminals:
+
+        len(seq)                => Count(seq)
+        Count(seq, predicate)   => Count(Where(seq, predicate))
+        Sum(seq, selector)      => Sum(Select(seq, selector)) (and the same for `Min` and `Max`)
+    '''
+
+    def visit_Call(self, node: ast.Call):
+        self.generic_visit(node)
+        if not isinstance(node.func, ast.Name):
+            return node
+
+        if node.func.id == 'len' and len(node.args) == 1:
+            return ast.copy_location(ast.Call(func=ast.Name(id='Count', ctx=ast.Load()), args=node.args, keywords=[]), node)
+
+        if node.func.id in ['Count', 'Sum', 'Min', 'Max'] and len(node.args) == 2 and isinstance(node.args[1], ast.Lambda):
+            operator = 'Where' if node.func.id == 'Count' else 'Select'
+            node.args = [ast.Call(func=ast.Name(id=operator, ctx=ast.Load()), args=node.args, keywords=[])]
+        return node
+
+
+def _source_base(node: ast.Call) -> Tuple[ast.Call, ast.AST]:
+    r'''
+    Follow the `Select` and `Where` calls back from the source of the aggregate `node`. Return the
+    collection they start from, and the call that has it as its first argument.
+    '''
+    holder = node
+    base = node.args[0]
+    while _is_call_to(base, _per_item_operators) and len(cast(ast.Call, base).args) == 2:
+        holder = cast(ast.Call, base)
+        base = holder.args[0]
+    return holder, base
+
+
+def _is_per_item(node: ast.Call) -> bool:
+    r'''
+    True if the lambdas along the way from `node` back to its collection only look at a single
+    item. A nested sequence operator would need a loop of its own inside the shared loop.
+    '''
+    _, base = _source_base(node)
+    lambdas = list(node.args[1:])
+    n = cast(ast.Call, node.args[0])
+    while n is not base:
+        lambdas += n.args[1:]
+        n = cast(ast.Call, n.args[0])
+    for lam in lambdas:
+        for c in ast.walk(lam):
+            if c is lam:
+                continue
+            if isinstance(c, ast.Lambda) or (isinstance(c, ast.Call) and isinstance(c.func, ast.Name)):
+                return False
+    return True
+
+
+def _fusion_key(node: ast.AST) -> Optional[str]:
+    'Aggregates with the same key can be calculated in the same loop'
+    if not _is_call_to(node, aggregate_terminals) or len(cast(ast.Call, node).args) == 0:
+        return None
+    call = cast(ast.Call, node)
+    _, base = _source_base(call)
+    if not isinstance(base, ast.Call) or not _is_per_item(call):
+        return None
+    return canonical_text(base)
+
+
+def _fuse(values: List[ast.AST]):
+    'Make the aggregates in `values` that run over the same collection share it'
+    groups: Dict[str, List[ast.Call]] = {}
+    for v in values:
+        key = _fusion_key(v)
+        if key is not None:
+            groups.setdefault(key, []).append(cast(ast.Call, v))
+
+    for group in groups.values():
+        if len(group) < 2:
+            continue
+        _, base = _source_base(group[0])
+        for agg in group:
+            holder, _ = _source_base(agg)
+            holder.args[0] = base
+            agg.fused_group = group  # type: ignore
+
+
+class _aggregate_fuser(ast.NodeVisitor):
+    def visit_Tuple(self, node: ast.Tuple):
+        _fuse(node.elts)
+        self.generic_visit(node)
+
+    def visit_List(self, node: ast.List):
+        _fuse(node.elts)
+        self.generic_visit(node)
+
+    def visit_Dict(self, node: ast.Dict):
+        _fuse(node.values)
+        self.generic_visit(node)
+
+
+def fuse_aggregates(a: ast.AST) -> ast.AST:
+    r'''
+    Find aggregates in the same tuple, list, or dict that run over the same collection, and set
+    them up to be calculated in a single loop: they are made to share one copy of the collection,
+    and each gets a `fused_group` attribute that lists the group. Returns `a`.
+
+    Only aggregates whose `Select` and `Where` lambdas work on a single item are fused. Run this
+    before `mark_repeated_expressions`, so the shared collection is seen as shared.
+    '''
+    _aggregate_fuser().visit(a)
+    return a
+
+
+def fused_group(node: ast.AST) -> Optional[List[ast.Call]]:
+    'The aggregates `node` should share a loop with, or None'
+    return getattr(node, 'fused_group', None)
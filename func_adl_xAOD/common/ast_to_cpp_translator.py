@@ -2,9 +2,11 @@
 # Python AST code.
 
 import ast
+import copy
 import logging
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Type, Union, cast
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union, cast
 
 import func_adl_xAOD.common.cpp_ast as cpp_ast
 import func_adl_xAOD.common.cpp_representation as crep
@@ -15,9 +17,15 @@ import func_adl_xAOD.common.statement as statement
 from func_adl.ast.call_stack import argument_stack, stack_frame
 from func_adl.ast.func_adl_ast_utils import FuncADLNodeVisitor, function_call
 from func_adl.util_ast import lambda_unwrap
+from func_adl_xAOD.common.aggregates import fused_group
 from func_adl_xAOD.common.cpp_functions import FunctionAST
 from func_adl_xAOD.common.cpp_vars import unique_name
+from func_adl_xAOD.common.cse import is_repeated, is_shared
 from func_adl_xAOD.common.generated_code import generated_code
+from func_adl_xAOD.common.output_options import ttree_output_options
+from func_adl_xAOD.common.profiling import profile_phase
+from func_adl_xAOD.common.translation_context import (TranslationContext,
+                                                      current_context)
 from func_adl_xAOD.common.util_scope import (deepest_scope, gc_scope,
                                              gc_scope_top_level,
                                              top_level_scope)
@@ -62,7 +70,7 @@ class xAODTranslationError(Exception):
 def check_accumulator_type(t: ctyp.terminal):
     'We can only deal with certain types for doing an accumulation. Make sure this is one.'
     t_str = str(t)
-    return (t_str == "float") or (t_str == "double") or (t_str == "int")
+    return (t_str == "float") or (t_str == "double") or (t_str == "int") or (t_str == "bool")
 
 
 def guess_type_from_number(n):
@@ -89,20 +97,21 @@ def get_ttree_type(rep):
         return rep.cpp_type()
 
 
-def determine_type_mf(parent_type, function_name):
+def determine_type_mf(parent_type, function_name, context: Optional[TranslationContext] = None):
     '''
     Determine the return type of the member function. Do our best to make
     an intelligent case when we can.
 
     parent_type:        the type of the parent
     function_name:      the name of the function we are calling
+    context:            translation context to look up method types in (defaults to the active one)
     '''
     # If we don't know the type...
     if parent_type is None:
         raise RuntimeError("Internal Error: Trying to call member function for a type we do not know!")
     # If we are doing one of the normal "terminals", then we can just bomb. This should not happen!
 
-    rtn_type = ctyp.method_type_info(str(parent_type), function_name)
+    rtn_type = current_context(context).method_type_info(str(parent_type), function_name)
     if rtn_type is not None:
         return rtn_type
 
@@ -117,6 +126,90 @@ def determine_type_mf(parent_type, function_name):
     return ctyp.terminal('double')
 
 
+# `a op b` is the same as `b mirror(op) a`
+_mirrored_compare: Dict[Type, Type] = {
+    ast.Lt: ast.Gt,
+    ast.LtE: ast.GtE,
+    ast.Gt: ast.Lt,
+    ast.GtE: ast.LtE,
+    ast.Eq: ast.Eq,
+    ast.NotEq: ast.NotEq,
+}
+
+# For `count op n`, the count at which the answer is known, as a function of n
+_count_decided_at: Dict[Type, Callable[[int], int]] = {
+    ast.Lt: lambda n: n,
+    ast.LtE: lambda n: n + 1,
+    ast.Gt: lambda n: n + 1,
+    ast.GtE: lambda n: n,
+    ast.Eq: lambda n: n + 1,
+    ast.NotEq: lambda n: n + 1,
+}
+
+
+def _is_count(node: ast.AST) -> bool:
+    'True if `node` is a `Count()`, or an `Aggregate` that counts'
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'Count' \
+            and len(node.args) == 1:
+        return True
+    if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Name) or node.func.id != 'Aggregate' \
+            or len(node.args) != 3:
+        return False
+    start, update = node.args[1], node.args[2]
+    if not (isinstance(start, ast.Constant) and start.value == 0 and type(start.value) is int):
+        return False
+    if not (isinstance(update, ast.Lambda) and len(update.args.args) == 2):
+        return False
+    body = update.body
+    return isinstance(body, ast.BinOp) and isinstance(body.op, ast.Add) \
+        and isinstance(body.left, ast.Name) and body.left.id == update.args.args[0].arg \
+        and isinstance(body.right, ast.Constant) and body.right.value == 1 and type(body.right.value) is int
+
+
+def _count_limit(left: ast.AST, op: ast.cmpop, right: ast.AST) -> Tuple[Optional[ast.Call], int]:
+    r'''
+    If `left op right` is a count compared to an integer, return the count and the number it
+    can stop at. Otherwise return (None, 0).
+    '''
+    if not _is_count(left) or not isinstance(right, ast.Constant) or type(right.value) is not int \
+            or type(op) not in _count_decided_at:
+        return None, 0
+    limit = _count_decided_at[type(op)](right.value)
+    if limit < 1:
+        return None, 0
+    return cast(ast.Call, left), limit
+
+
+def _has_own_loop(sequence: ast.AST) -> bool:
+    r'''
+    True if the loop that `sequence` is made from will run nothing but the code for `sequence`:
+    it starts from a collection (rather than a sequence that was passed in), and no part of it has
+    been, or will be, used anywhere else.
+    '''
+    for n in ast.walk(sequence):
+        if is_shared(n) or hasattr(n, 'rep'):
+            return False
+
+    base = sequence
+    while isinstance(base, ast.Call) and isinstance(base.func, ast.Name) \
+            and base.func.id in ['Where', 'Select', 'SelectMany'] and len(base.args) > 0:
+        base = base.args[0]
+    return isinstance(base, ast.Call)
+
+
+def _is_float_literal(node: ast.AST) -> bool:
+    return isinstance(node, ast.Constant) and type(node.value) is float
+
+
+def _narrowed_to_float(t: ctyp.terminal) -> ctyp.terminal:
+    'The type `t` with double replaced by float, including inside collections'
+    if isinstance(t, ctyp.collection):
+        return ctyp.collection(_narrowed_to_float(t.element_type()))
+    if str(t) == 'double':
+        return ctyp.terminal('float')
+    return t
+
+
 def _extract_column_names(names_ast: ast.AST) -> List[str]:
     'Extract a list of strings from an ast using literal evaluation. A single name is returned as a list.'
     names = ast.literal_eval(names_ast)
@@ -130,10 +223,15 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
     Drive the conversion to C++ from the top level query
     """
 
-    def __init__(self, prefix, is_loop_var_a_ref):
+    def __init__(self, prefix, is_loop_var_a_ref, context: Optional[TranslationContext] = None):
         r'''
         Initialize the visitor.
+
+        context - The translation context to use. Defaults to the active one. It should be
+                  active while the visitor runs.
         '''
+        self._context = current_context(context)
+
         # Tracks the output of the code.
         self._gc = generated_code()
         self._arg_stack = argument_stack()
@@ -141,9 +239,15 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         self._prefix = prefix
         self._is_loop_var_a_ref = is_loop_var_a_ref
 
+        # The loop each group of fused aggregates shares, once it has been made.
+        self._fused_loops: Dict[int, Union[gc_scope, gc_scope_top_level]] = {}
+
     def include_files(self):
         return self._gc.include_files()
 
+    def class_include_files(self):
+        return self._gc.class_include_files()
+
     def emit_query(self, e):
         'Emit the parsed lines'
         self._gc.emit_query_code(e)
@@ -207,7 +311,8 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         pass
 
     @abstractmethod
-    def create_book_ttree_obj(self, tree_name: str, leaves: list) -> statement.book_ttree:
+    def create_book_ttree_obj(self, tree_name: str, leaves: list,
+                              options: Optional[ttree_output_options] = None) -> statement.book_ttree:
         pass
 
     def get_as_ROOT(self, node: ast.AST) -> rh.cpp_ttree_rep:
@@ -361,28 +466,46 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
             # Next, process the lambda's body.
             call_node.rep = self.get_rep(call_node.func.body)
 
+    def _accumulator_scope(self, seq: crep.cpp_sequence) -> Union[gc_scope, gc_scope_top_level]:
+        r'''
+        The scope an accumulator over `seq` lives in. If this is a straight sequence of items, then
+        we want the sequence level. But if this is a sequence of sequences, we are aggregating over
+        the sequence itself. So we need to do it one level up from where the iterator is running on
+        the interior sequence.
+        '''
+        seq_val = seq.sequence_value()
+        if isinstance(seq_val, crep.cpp_sequence):
+            return seq_val.iterator_value().scope()[-1]
+        return seq.iterator_value().scope()[-1]
+
+    def _filtered_scope(self, seq: crep.cpp_sequence,
+                        scope: Union[gc_scope, gc_scope_top_level]) -> Union[gc_scope, gc_scope_top_level]:
+        r'''
+        Return `scope`, or the scope of the sequence of values `seq` if that is inside it. Any filters
+        (a `Where`) on the sequence open a scope below the iterator. Code that must only run for the
+        items that pass them has to go in there - even when the value of the item was calculated ahead
+        of the filter (it can be re-used from the filter's test, see `common_subexpression`).
+        '''
+        return seq.scope() if seq.scope().starts_with(scope) else scope
+
+    def _item_scope(self, seq: crep.cpp_sequence) -> Union[gc_scope, gc_scope_top_level]:
+        'The scope where each item of `seq` is seen'
+        sv = seq.sequence_value()
+        if isinstance(sv, crep.cpp_sequence):
+            return sv.iterator_value().scope()[-1]
+        return self._filtered_scope(seq, sv.scope())
+
+    def _set_accumulate_scope(self, seq: crep.cpp_sequence):
+        'Move to the scope where each item of `seq` is seen, to update an accumulator'
+        self._gc.set_scope(self._item_scope(seq))
+
     def _create_accumulator(self, seq: crep.cpp_sequence, acc_type: ctyp.terminal, initial_value=None):
         'Helper to create an accumulator for the Aggregate function'
         accumulator_type = acc_type
-
-        # When we implement other types of aggregate, this code will need to
-        # be back in.
-        # if accumulator_type is None:
-        #     sv = seq.sequence_value()
-        #     if not isinstance(sv, crep.cpp_value):
-        #         raise Exception("Do not know how to accumulate a sequence!")
-        #     accumulator_type = sv.cpp_type()
         if not check_accumulator_type(accumulator_type):
             raise ValueError(f"Aggregate over a sequence of type '{str(accumulator_type)}' is not supported.")
 
-        # Getting the scope level right is tricky. If this is a straight sequence of items, then we want the sequence level.
-        # But if this is a sequence of sequences, we are aggregating over the sequence itself. So we need to do it one level
-        # up from where the iterator is running on the interior sequence.
-        seq_val = seq.sequence_value()
-        if isinstance(seq_val, crep.cpp_sequence):
-            accumulator_scope = seq_val.iterator_value().scope()[-1]
-        else:
-            accumulator_scope = seq.iterator_value().scope()[-1]
+        accumulator_scope = self._accumulator_scope(seq)
         accumulator = crep.cpp_variable(unique_name("aggResult"),
                                         accumulator_scope,
                                         accumulator_type,
@@ -391,151 +514,229 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
 
         return accumulator, accumulator_scope
 
+    def _declare_is_first(self, scope: Union[gc_scope, gc_scope_top_level]) -> crep.cpp_variable:
+        'Declare a bool, at `scope`, that is true until the first item of a sequence has been seen'
+        is_first = crep.cpp_variable(unique_name('is_first'),
+                                     scope,
+                                     cpp_type=ctyp.terminal('bool'),
+                                     initial_value=crep.cpp_value('true', self._gc.current_scope(), ctyp.terminal('bool')))
+        scope.declare_variable(is_first)
+        return is_first
+
+    def _aggregate_sequence(self, node: ast.Call) -> crep.cpp_sequence:
+        r'''
+        Return the sequence the aggregate `node` runs over.
+
+        The aggregates `fuse_aggregates` put in a group share a loop: the first of them to be
+        translated makes it, and the rest add their code to the end of its body - as long as they
+        are calculated at the scope the loop sits in.
+        '''
+        group = fused_group(node)
+        loop_scope = self._fused_loops.get(id(group)) if group is not None else None
+        if loop_scope is not None and loop_scope.parent() is self._gc.current_scope():
+            self._gc.set_scope(loop_scope)
+
+        seq = self.as_sequence(node.args[0])
+
+        if group is not None and loop_scope is None and not isinstance(seq.sequence_value(), crep.cpp_sequence):
+            self._fused_loops[id(group)] = seq.iterator_value().scope()
+        return seq
+
+    def _sequence_item(self, seq: crep.cpp_sequence, name: str) -> crep.cpp_value:
+        'The value of each item of `seq`, which must be a value and not a sequence'
+        sv = seq.sequence_value()
+        if isinstance(sv, crep.cpp_sequence):
+            raise xAODTranslationError(f'{name} needs a sequence of values, not a sequence of sequences.')
+        return sv
+
+    def _finish_aggregate(self, node: ast.Call, accumulator: crep.cpp_variable,
+                          accumulator_scope: Union[gc_scope, gc_scope_top_level]):
+        'Since an aggregate is a terminal, pop back out of the loop, and cache the result'
+        self._gc.set_scope(accumulator_scope)
+        node.rep = accumulator  # type: ignore
+        self._result = accumulator
+        return accumulator
+
+    def call_Count(self, node: ast.Call, args: List[ast.AST]):
+        'The number of items in the sequence'
+        if len(args) != 1:
+            raise xAODTranslationError(f'Count requires a sequence, but was given {len(args)} arguments.')
+
+        # Everything in a collection is counted by its size - there is no need for a loop.
+        size = self._collection_size(node.args[0])
+        if size is not None:
+            node.rep = size  # type: ignore
+            self._result = size
+            return size
+
+        seq = self._aggregate_sequence(node)
+        int_type = ctyp.terminal('int')
+        accumulator, accumulator_scope = self._create_accumulator(seq, int_type)
+
+        self._set_accumulate_scope(seq)
+        self._gc.add_statement(statement.set_var(accumulator, crep.cpp_value(f'({accumulator.as_cpp()}+1)', self._gc.current_scope(), int_type)))
+        self._add_count_limit(node, seq, accumulator)
+
+        return self._finish_aggregate(node, accumulator, accumulator_scope)
+
+    def _collection_size(self, source: ast.AST) -> Optional[crep.cpp_value]:
+        r'''
+        If `source` is a collection, or is made from one by `Select` calls alone, return the
+        size of the collection. Otherwise return None.
+        '''
+        base = source
+        while isinstance(base, ast.Call) and isinstance(base.func, ast.Name) and base.func.id == 'Select' \
+                and len(base.args) == 2:
+            base = base.args[0]
+
+        rep = self.get_rep(base)
+        if not isinstance(rep, crep.cpp_collection):
+            return None
+        size = f'{rep.as_cpp()}->size()' if rep.cpp_type().is_pointer() else f'{rep.as_cpp()}.size()'
+        return crep.cpp_value(f'static_cast<int>({size})', rep.scope(), ctyp.terminal('int'))
+
+    def _add_count_limit(self, node: ast.Call, seq: crep.cpp_sequence, accumulator: crep.cpp_variable):
+        r'''
+        A count that is only compared to a number can stop once it gets to the number where the
+        answer is known (see `visit_Compare`).
+        '''
+        count_limit = getattr(node, 'count_limit', None)
+        if count_limit is not None and self._can_break_out_of(seq.iterator_value().scope()):
+            limit_reached = crep.cpp_value(f'({accumulator.as_cpp()}>={count_limit})', self._gc.current_scope(), ctyp.terminal('bool'))
+            self._gc.add_statement(statement.iftest(limit_reached, break_after=True))
+
+    def call_Sum(self, node: ast.Call, args: List[ast.AST]):
+        'The sum of the items in the sequence. The sum has the type of the items (a bool counts as an int).'
+        if len(args) != 1:
+            raise xAODTranslationError(f'Sum requires a sequence, but was given {len(args)} arguments.')
+        seq = self._aggregate_sequence(node)
+        sv = self._sequence_item(seq, 'Sum')
+        sum_type = sv.cpp_type() if str(sv.cpp_type()) != 'bool' else ctyp.terminal('int')
+        accumulator, accumulator_scope = self._create_accumulator(seq, sum_type)
+
+        self._set_accumulate_scope(seq)
+        self._gc.add_statement(statement.set_var(accumulator, crep.cpp_value(f'({accumulator.as_cpp()}+{sv.as_cpp()})', self._gc.current_scope(), sum_type)))
+
+        return self._finish_aggregate(node, accumulator, accumulator_scope)
+
+    def call_Min(self, node: ast.Call, args: List[ast.AST]):
+        'The smallest item in the sequence, or zero if it is empty'
+        return self._call_extremum(node, args, 'Min', '<')
+
+    def call_Max(self, node: ast.Call, args: List[ast.AST]):
+        'The largest item in the sequence, or zero if it is empty'
+        return self._call_extremum(node, args, 'Max', '>')
+
+    def _call_extremum(self, node: ast.Call, args: List[ast.AST], name: str, compare: str):
+        r'''
+        Implement Min and Max. The first item always replaces the accumulator, and after that an
+        item replaces it if `item compare accumulator`.
+        '''
+        if len(args) != 1:
+            raise xAODTranslationError(f'{name} requires a sequence, but was given {len(args)} arguments.')
+        seq = self._aggregate_sequence(node)
+        sv = self._sequence_item(seq, name)
+        accumulator, accumulator_scope = self._create_accumulator(seq, sv.cpp_type())
+        is_first = self._declare_is_first(accumulator_scope)
+
+        self._set_accumulate_scope(seq)
+
+        # The item is used twice, so it is only calculated once.
+        item: crep.cpp_value = sv
+        if not sv.as_cpp().isidentifier():
+            item = crep.cpp_variable(unique_name('aggItem'), self._gc.current_scope(), sv.cpp_type())
+            self._gc.declare_variable(item)
+            self._gc.add_statement(statement.set_var(item, sv))
+
+        bool_type = ctyp.terminal('bool')
+        replace = crep.cpp_value(f'({is_first.as_cpp()}||({item.as_cpp()}{compare}{accumulator.as_cpp()}))', self._gc.current_scope(), bool_type)
+        s = statement.iftest(replace)
+        s.add_statement(statement.set_var(is_first, crep.cpp_value('false', top_level_scope(), bool_type)))
+        s.add_statement(statement.set_var(accumulator, item))
+        self._gc.add_statement(s)
+
+        return self._finish_aggregate(node, accumulator, accumulator_scope)
+
     def visit_Call_Aggregate_only(self, node: ast.Call, args: List[ast.AST]):
         '''
         - (acc lambda): the accumulator is set to the first element, and the lambda is called to
                         update it after that. This is called `agg_only`.
         '''
-        raise NotImplementedError()
-        # This is commented out b.c. we've not written detailed testing nor found a real
-        # use yet in code - though it may very well happen! So we'll leave our first guess in here.
-        # agg_lambda = node.args[0]
-
-        # # Get the sequence we are calling against and the accumulator
-        # if not isinstance(node.func, ast.Attribute):
-        #     raise Exception("Wrong type of function")
-        # seq = self.as_sequence(node.func.value)
-        # accumulator, accumulator_scope = self._create_accumulator(seq)
-
-        # # We have to do a simple if statement here so that the first time through we can set the
-        # # accumulator, and the second time we can add to it.
-
-        # is_first_iter = crep.cpp_variable(unique_name("is_first"), self._gc.current_scope(), cpp_type=ctyp.terminal('bool'), initial_value=crep.cpp_value('true', self._gc.current_scope(), ctyp.terminal('bool')))
-        # accumulator_scope.declare_variable(is_first_iter)
-
-        # # Set the scope where we will be doing the accumulation
-        # sv = seq.sequence_value()
-        # if isinstance(sv, crep.cpp_sequence):
-        #     self._gc.set_scope(sv.iterator_value().scope()[-1])
-        # else:
-        #     self._gc.set_scope(sv.scope())
-
-        # # Code up if statement to select out the first element.
-        # if_first = statement.iftest(is_first_iter)
-        # self._gc.add_statement(if_first)
-        # self._gc.add_statement(statement.set_var(is_first_iter, crep.cpp_value("false", self._gc.current_scope(), ctyp.terminal('bool'))))
-
-        # # Set the accumulator
-        # self._gc.add_statement(statement.set_var(accumulator, seq.sequence_value()))
-        # self._gc.pop_scope()
-
-        # # Now do the if statement and make the call to calculate the accumulation.
-        # self._gc.add_statement(statement.elsephrase())
-        # call = ast.Call(func=agg_lambda, args=[accumulator.as_ast(), seq.sequence_value().as_ast()])
-        # self._gc.add_statement(statement.set_var(accumulator, self.get_rep(call)))
-
-        # # Finally, since this is a terminal, we need to pop off the top.
-        # self._gc.set_scope(accumulator_scope)
-
-        # # Cache the results in our result in case we are skipping nodes in the AST.
-        # node.rep = accumulator
-        # self._result = accumulator
+        return self._aggregate_from_first(node, None, cast(ast.Lambda, node.args[1]))
 
     def visit_call_Aggregate_initial(self, node: ast.Call, args: List[ast.AST]):
         '''
         - (const, acc lambda): the accumulator is set to the value, and then the lambda is called to
                         update it on every single element. This is called `agg_initial`
         '''
-        raw_seq = node.args[0]
         init_val = self.get_rep(node.args[1])
         agg_lambda = node.args[2]
         assert isinstance(agg_lambda, ast.Lambda)
 
         # Get the sequence we are calling against and the accumulator
-        seq = self.as_sequence(raw_seq)
+        seq = self._aggregate_sequence(node)
         accumulator, accumulator_scope = self._create_accumulator(seq, initial_value=init_val, acc_type=init_val.cpp_type())
 
         # Now do the accumulation. This happens at the current iterator scope.
-        sv = seq.sequence_value()
-        if isinstance(sv, crep.cpp_sequence):
-            self._gc.set_scope(sv.iterator_value().scope()[-1])
-        else:
-            self._gc.set_scope(sv.scope())
-        call = ast.Call(func=agg_lambda, args=[accumulator.as_ast(), seq.sequence_value().as_ast()])
+        self._set_accumulate_scope(seq)
+        self._add_update(accumulator, init_val.cpp_type(), agg_lambda, seq.sequence_value())
+        self._add_count_limit(node, seq, accumulator)
+
+        return self._finish_aggregate(node, accumulator, accumulator_scope)
+
+    def _add_update(self, accumulator: crep.cpp_variable, start_type: ctyp.terminal, agg_lambda: ast.Lambda,
+                    item: Union[crep.cpp_value, crep.cpp_sequence]):
+        'Set `accumulator` to `agg_lambda(accumulator, item)` at the current scope'
+        # The accumulator changes on every pass through the loop, so inside the loop it is only
+        # valid at the loop's scope (this keeps it from being hoisted out of the loop).
+        call = ast.Call(func=agg_lambda, args=[accumulator.copy_with_new_scope(self._gc.current_scope()).as_ast(), item.as_ast()])
         update_lambda = self.get_rep(call)
 
         # Check the accumulator value still hols out. Since we need the accumulator previously,
         # this will allow us to patch things up. This isn't perfect, but it will do.
-        if update_lambda.cpp_type().type != init_val.cpp_type().type:
-            best_type = most_accurate_type([init_val.cpp_type(), update_lambda.cpp_type()])
+        if update_lambda.cpp_type().type != start_type.type:
+            best_type = most_accurate_type([start_type, update_lambda.cpp_type()])
             accumulator.update_type(best_type)
 
         self._gc.add_statement(statement.set_var(accumulator, update_lambda))
 
-        # Finally, since this is a terminal, we need to pop off the top.
-        self._gc.set_scope(accumulator_scope)
-
-        # Cache the results in our result in case we are skipping nodes in the AST.
-        node.rep = accumulator  # type: ignore
-        self._result = accumulator
-
     def visit_call_Aggregate_initial_func(self, node: ast.Call, args: List[ast.AST]):
         '''
         - (start lambda, acc lambda): the accumulator is set to the start lambda call on the first
                         element in the sequence, and then acc is called to update it after that.
                         This is called `agg_initial_func`
         '''
-        raise NotImplementedError()
-        # Needs testing!
-        # agg_lambda = node.args[1]
-        # init_lambda = node.args[0]
+        return self._aggregate_from_first(node, cast(ast.Lambda, node.args[1]), cast(ast.Lambda, node.args[2]))
 
-        # # Get the sequence we are calling against and the accumulator
-        # seq = self.as_sequence(node.func.value)
-        # accumulator, accumulator_scope = self._create_accumulator(seq, initial_value=init_val)
-
-        # is_first_iter = crep.cpp_value(unique_name("is_first"), accumulator_scope, cpp_type=ctyp.terminal("bool"), initial_value='true')
-        # accumulator_scope.declare_variable(is_first_iter)
-
-        # # BELOW HERE NOT CONVERTED YET.
-
-        # # We have to initialized the variable to some value, and it depends on how the user
-        # # is trying to initialize things - first iteration or with a value. We've done the value case above.
-        # is_first_iter = None
-        # if use_first_element_separately:
-        #     is_first_iter = cpp_variable(unique_name("is_first"), self._gc.current_scope(), cpp_type="bool", initial_value='true')
-        #     decl_block.declare_variable(is_first_iter)
-
-        # # Now we need to emit code at the accumulator level.
-        # self._gc.set_scope(c_loop.scope())
-
-        # # If we have to use the first lambda to set the first value, then we need that code up front.
-        # if use_first_element_separately:
-        #     if_first = statement.iftest(cpp_constant(is_first_iter.as_cpp()))
-        #     self._gc.add_statement(if_first)
-        #     self._gc.add_statement(statement.set_var(is_first_iter, cpp_constant("false")))
-        #     first_scope = self._gc.current_scope()
-
-        #     if init_lambda is not None:
-        #         call = ast.Call(init_lambda, [c_iter.as_ast()])
-        #         self._gc.add_statement(statement.set_var(result, self.get_rep(call)))
-        #     else:
-        #         self._gc.add_statement(statement.set_var(result, c_iter))
-
-        #     self._gc.set_scope(first_scope)
-        #     self._gc.pop_scope()
-        #     self._gc.add_statement(statement.elsephrase())
-
-        # # Perform the aggregation function. We need to call it with the value and the accumulator.
-        # call = ast.Call(func=agg_lambda, args=[result.as_ast(), c_iter.as_ast()])
-        # self._gc.add_statement(statement.set_var(result, self.get_rep(call)))
-
-        # # Finally, since this is a terminal, we need to pop off the top.
-        # self._gc.set_scope(decl_block_scope)
+    def _aggregate_from_first(self, node: ast.Call, init_lambda: Optional[ast.Lambda], agg_lambda: ast.Lambda):
+        r'''
+        Implement the forms of Aggregate that start from the first item: the accumulator is set
+        from the first item (via `init_lambda` if there is one), and updated with `agg_lambda` for
+        every other item. It is the accumulator type's default value for an empty sequence.
+        '''
+        seq = self._aggregate_sequence(node)
+        sv = self._sequence_item(seq, 'Aggregate')
+        accumulator_scope = self._accumulator_scope(seq)
+        is_first = self._declare_is_first(accumulator_scope)
+
+        # The first item sets the accumulator...
+        self._set_accumulate_scope(seq)
+        self._gc.add_statement(statement.iftest(is_first))
+        if_scope = self._gc.current_scope()
+        self._gc.add_statement(statement.set_var(is_first, crep.cpp_value('false', top_level_scope(), ctyp.terminal('bool'))))
+        first = sv if init_lambda is None else self.get_rep(ast.Call(func=lambda_unwrap(init_lambda), args=[sv.as_ast()]))
+        if isinstance(first, crep.cpp_sequence):
+            raise xAODTranslationError('Aggregate can only accumulate values, not sequences.')
+        accumulator, _ = self._create_accumulator(seq, first.cpp_type())
+        self._gc.add_statement(statement.set_var(accumulator, first))
+
+        # ... and the others update it.
+        self._gc.set_scope(if_scope)
+        self._gc.pop_scope()
+        self._gc.add_statement(statement.elsephrase())
+        self._add_update(accumulator, first.cpp_type(), agg_lambda, sv)
 
-        # # Cache the results in our result incase we are skipping nodes in the AST.
-        # node.rep = result
-        # self._result = result
+        return self._finish_aggregate(node, accumulator, accumulator_scope)
 
     def call_Aggregate(self, node: ast.Call, args: List[ast.AST]):
         r'''Implement the aggregate algorithm in C++
@@ -553,13 +754,13 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
                         element in the sequence, and then acc is called to update it after that.
                         This is called `agg_initial_func`
 
-        Limitations: only floats for now!
+        Limitations: only numbers and bools can be accumulated.
         '''
         # figure out which version of Aggregate we have here.
-        if len(node.args) == 2:
+        if len(node.args) == 2 and isinstance(node.args[1], ast.Lambda):
             return self.visit_Call_Aggregate_only(node, args)
-        elif len(node.args) == 3:
-            if isinstance(node.args[0], ast.Lambda):
+        elif len(node.args) == 3 and isinstance(node.args[2], ast.Lambda):
+            if isinstance(node.args[1], ast.Lambda):
                 return self.visit_call_Aggregate_initial_func(node, args)
             else:
                 return self.visit_call_Aggregate_initial(node, args)
@@ -584,10 +785,11 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         # We support member calls that directly translate only. Here, for example, this is only for
         # obj.pt() or similar. The translation is direct.
         c_stub = calling_against.as_cpp() + ("->" if calling_against.is_pointer() else ".")
-        result_type = determine_type_mf(calling_against.cpp_type(), function_name)
+        result_type = determine_type_mf(calling_against.cpp_type(), function_name, self._context)
 
         args = call_node.args
-        self._result = crep.cpp_value(c_stub + function_name + f"({','.join(self.get_rep(arg).as_cpp() for arg in args)})", calling_against.scope(), result_type)
+        r = crep.cpp_value(c_stub + function_name + f"({','.join(self.get_rep(arg).as_cpp() for arg in args)})", calling_against.scope(), result_type)
+        self._result = self.common_subexpression(call_node, r)
 
     def visit_function_ast(self, call_node):
         'Drop-in replacement for a function'
@@ -601,9 +803,93 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         # Include files and return the resulting expression
         for i in cpp_func.include_files:
             self._gc.add_include(i)
+        r = self.common_subexpression(call_node, r)
         call_node.rep = r
         return r
 
+    def common_subexpression(self, node: ast.AST, rep: crep.cpp_value) -> crep.cpp_value:
+        r'''
+        Store `rep` in a local variable, and return that instead, when that saves work:
+
+        - If `node` was marked as repeated (see `cse.mark_repeated_expressions`) the local is
+          made at the current scope.
+        - If `rep` is valid outside a loop we are in (it is loop invariant), the local is made at
+          the scope of `rep`, ahead of the loop, so it is calculated once rather than on every
+          pass through the loop.
+
+        If the same C++ expression was already stored in a local at this scope (or above), re-use
+        that one. Expressions that can't be copied into a simple local (pointers, collections)
+        are returned as they are.
+
+        node - the ast that `rep` was rendered from
+        rep - the rendered C++ expression
+        '''
+        t = rep.cpp_type()
+        if type(t) is not ctyp.terminal or t.is_pointer():
+            return rep
+        if not self._gc.current_scope().starts_with(rep.scope()):
+            return rep
+        loop_invariant = self._gc.is_in_loop_below(rep.scope())
+        if not loop_invariant and not is_repeated(node):
+            return rep
+
+        key = ('cse', rep.as_cpp())
+        v = self._gc.get_rep_at_insertion_point(key)
+        if v is None:
+            with self._gc.hoisted(rep.scope() if loop_invariant else self._gc.current_scope()):
+                v = crep.cpp_variable(unique_name('cse'), self._gc.current_scope(), cpp_type=t)
+                self._gc.declare_variable(v)
+                self._gc.add_statement(statement.set_var(v, rep))
+                self._gc.set_rep_at_insertion_point(key, v)
+        return v
+
+    def _loop_invariant_scope(self, call_node: ast.Call) -> Optional[Union[gc_scope, gc_scope_top_level]]:
+        r'''
+        If the inputs of a `CPPCodeValue` call are all valid outside a loop we are in, return the
+        scope of the deepest one - the code can be run there, once, rather than inside the loop.
+        Otherwise return None.
+        '''
+        cpp_ast_node = cast(cpp_ast.CPPCodeValue, call_node.func)
+        # Literals are valid everywhere - whatever scope their rep was made in.
+        inputs = [self.get_rep(a) for a in call_node.args if not isinstance(a, ast.Constant)]
+        if cpp_ast_node.replacement_instance_obj is not None:
+            inputs.append(self.get_rep(self.resolve_id(cpp_ast_node.replacement_instance_obj[1])))
+
+        scope: Union[gc_scope, gc_scope_top_level] = top_level_scope()
+        for r in inputs:
+            if not isinstance(r, crep.cpp_value):
+                return None
+            if r.scope().starts_with(scope):
+                scope = r.scope()
+        if not self._gc.current_scope().starts_with(scope) or not self._gc.is_in_loop_below(scope):
+            return None
+        return scope
+
+    def visit_cpp_code_value(self, call_node: ast.Call):
+        r'''
+        Run the C++ code of a `CPPCodeValue`, unless it has already been run with the same arguments:
+
+        - Identical C++ code blocks marked as repeated need only run once per scope.
+        - Event level code (like fetching a collection from the event store) is run once per event.
+          It is moved up to the outermost scope, ahead of the block we are in now, and re-used
+          everywhere after that.
+        - Code whose inputs do not change in a loop we are in is moved up ahead of the loop.
+        '''
+        cpp_ast_node = cast(cpp_ast.CPPCodeValue, call_node.func)
+        hoist_to = top_level_scope() if cpp_ast_node.event_level else self._loop_invariant_scope(call_node)
+        key = cpp_ast.cse_key(self, call_node) if hoist_to is not None or is_repeated(call_node) else None
+        r = self._gc.get_rep_at_insertion_point(key) if key is not None else None
+        if r is None:
+            with self._gc.hoisted(hoist_to) if hoist_to is not None else nullcontext():
+                r = cpp_ast.process_ast_node(self, self._gc, call_node)
+                if key is not None:
+                    self._gc.set_rep_at_insertion_point(key, r)
+        elif isinstance(r, crep.cpp_collection):
+            # Loops are cached by collection rep. Each use of a collection gets its own
+            # loop (think of a jet-jet pair loop), so each needs its own rep.
+            r = copy.copy(r)
+        return r
+
     def call_EventDataset(self, node: ast.Call, args: List[ast.AST]):
         'This has already been resolved, so return it.'
         assert hasattr(node, 'rep')
@@ -620,12 +906,15 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         elif isinstance(call_node.func, ast.Attribute):
             self.visit_Call_Member(call_node)
         elif isinstance(call_node.func, cpp_ast.CPPCodeValue):
-            self._result = cpp_ast.process_ast_node(self, self._gc, call_node)
+            with profile_phase(self._context.profiler, 'process_ast_node'):
+                self._result = self.visit_cpp_code_value(call_node)
         elif isinstance(call_node.func, FunctionAST):
             self._result = self.visit_function_ast(call_node)
         else:
             # Perhaps a method call we can normalize?
-            r = FuncADLNodeVisitor.visit_Call(self, call_node)
+            handler_name = f'call_{call_node.func.id}' if isinstance(call_node.func, ast.Name) else 'call'
+            with profile_phase(self._context.profiler, handler_name):
+                r = FuncADLNodeVisitor.visit_Call(self, call_node)
             if r is None and not hasattr(call_node, 'rep'):
                 raise Exception("Do not know how to call '{0}'".format(ast.dump(call_node.func, annotate_fields=False)))
             if r is not None:
@@ -693,13 +982,23 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
             raise Exception(f"Do not know how to translate Binary operator {ast.dump(node.op)}!")
         left = self.get_rep(node.left)
         right = self.get_rep(node.right)
-
-        best_type = most_accurate_type([left.cpp_type(), right.cpp_type()])
-        if type(node.op) is ast.Div:
+        left_cpp, left_type = left.as_cpp(), left.cpp_type()
+        right_cpp, right_type = right.as_cpp(), right.cpp_type()
+
+        # With precise types, a literal takes the type of a float on the other side, rather than
+        # turning the calculation into a double.
+        if self._context.precise_types:
+            if str(left_type) == 'float' and _is_float_literal(node.right):
+                right_cpp, right_type = f'{right_cpp}f', left_type
+            if str(right_type) == 'float' and _is_float_literal(node.left):
+                left_cpp, left_type = f'{left_cpp}f', right_type
+
+        best_type = most_accurate_type([left_type, right_type])
+        if type(node.op) is ast.Div and not (self._context.precise_types and str(best_type) == 'float'):
             best_type = ctyp.terminal('double', False)
 
         s = deepest_scope(left, right).scope()
-        r = crep.cpp_value(f"({left.as_cpp()}{_known_binary_operators[type(node.op)]}{right.as_cpp()})",
+        r = crep.cpp_value(f"({left_cpp}{_known_binary_operators[type(node.op)]}{right_cpp})",
                            s, best_type)
 
         # Cache the result to push it back further up.
@@ -738,13 +1037,22 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         if_scope = self._gc.current_scope()
 
         # Next, we do the true and false if statement.
-        self._gc.add_statement(statement.set_var(result, self.get_rep(node.body)))
+        body = self.get_rep(node.body)
+        self._gc.add_statement(statement.set_var(result, body))
         self._gc.set_scope(if_scope)
         self._gc.pop_scope()
         self._gc.add_statement(statement.elsephrase())
-        self._gc.add_statement(statement.set_var(result, self.get_rep(node.orelse)))
+        orelse = self.get_rep(node.orelse)
+        self._gc.add_statement(statement.set_var(result, orelse))
         self._gc.set_scope(current_scope)
 
+        # With precise types the result has the type of its values. A literal fits in either.
+        if self._context.precise_types:
+            values = [(n, v) for n, v in [(node.body, body), (node.orelse, orelse)]]
+            types = [v.cpp_type() for n, v in values if not _is_float_literal(n)] or [v.cpp_type() for _, v in values]
+            if all(str(t) in ['int', 'float', 'double'] for t in types):
+                result.update_type(most_accurate_type(types))
+
         # Done, the result is the rep of this node!
         node.rep = result
         self._result = result
@@ -754,6 +1062,13 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         if len(node.ops) != 1:
             raise Exception("Do not support 1 < a < 10 comparisons yet!")
 
+        # If this is a `Count()` compared to a number, the count need not go further than the number
+        # that decides the comparison.
+        for count, limit in [_count_limit(node.left, node.ops[0], node.comparators[0]),
+                             _count_limit(node.comparators[0], _mirrored_compare[type(node.ops[0])](), node.left)]:
+            if count is not None and _has_own_loop(count.args[0]):
+                count.count_limit = limit
+
         left = self.get_rep(node.left)
         right = self.get_rep(node.comparators[0])
 
@@ -796,10 +1111,53 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         node.rep = crep.cpp_value(node.n, self._gc.current_scope(), guess_type_from_number(node.n))
         self._result = node.rep
 
+    def visit_NameConstant(self, node):
+        if type(node.value) is not bool:
+            raise Exception(f"Do not know how to translate the constant {node.value}")
+        node.rep = crep.cpp_value('true' if node.value else 'false', self._gc.current_scope(), ctyp.terminal("bool"))
+        self._result = node.rep
+
     def visit_Str(self, node):
         node.rep = crep.cpp_value('"{0}"'.format(node.s), self._gc.current_scope(), ctyp.terminal("string"))
         self._result = node.rep
 
+    def reserve_for_loop(self, accumulator: crep.cpp_value, loop_scope: Union[gc_scope, gc_scope_top_level],
+                         empty_scope: Union[gc_scope, gc_scope_top_level]):
+        r'''
+        If `loop_scope` is the inside of a loop over a collection held in a variable, and the
+        loop sits directly in `empty_scope`, where `accumulator` is empty, reserve room in
+        `accumulator` for every item of the collection just before the loop. If the loop is filtered
+        this is more than is needed, but it is never too little.
+        '''
+        if loop_scope.is_top_level():
+            return
+        loop_scope = cast(gc_scope, loop_scope)
+        loop_statement = loop_scope.block()
+        if not isinstance(loop_statement, statement.loop):
+            return
+        collection = loop_statement.collection()
+        if collection is None or not collection.as_cpp().lstrip('*').isidentifier():
+            return
+        outer_scope = loop_scope.parent()
+        if outer_scope is None or not (outer_scope.starts_with(empty_scope) and outer_scope.depth() == self._scope_depth(empty_scope)):
+            return
+
+        s_orig = self._gc.current_scope()
+        self._gc.set_scope(loop_scope)
+        with self._gc.hoisted(outer_scope):
+            self._gc.add_statement(statement.container_reserve(accumulator, loop_statement.collection()))
+        self._gc.set_scope(s_orig)
+
+    def _scope_depth(self, scope: Union[gc_scope, gc_scope_top_level]) -> int:
+        'The depth of a scope, counting the top level as the outer most block'
+        return 0 if scope.is_top_level() else cast(gc_scope, scope).depth()
+
+    def _branch_type(self, rep) -> ctyp.terminal:
+        'The type of the branch `rep` is written to, given the output options'
+        t = get_ttree_type(rep)
+        options = self._context.output_options
+        return _narrowed_to_float(t) if options is not None and options.float_branches else t
+
     def code_fill_ttree(self, e_rep: crep.cpp_rep_base, e_name: crep.cpp_variable,
                         scope_fill: Union[gc_scope, gc_scope_top_level]) -> Union[gc_scope, gc_scope_top_level]:
         '''
@@ -832,21 +1190,29 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
             assert isinstance(e_rep, crep.cpp_sequence), \
                 f'Do not know how to loop over a {type(e_rep)}'
 
-            def fill_collection_levels(seq: crep.cpp_sequence, accumulator: crep.cpp_value):
+            def fill_collection_levels(seq: crep.cpp_sequence, accumulator: crep.cpp_value,
+                                       empty_scope: Union[gc_scope, gc_scope_top_level]):
+                # `accumulator` is empty each time the code at `empty_scope` runs.
+                self.reserve_for_loop(accumulator, seq.iterator_value().scope(), empty_scope)
+
                 inner = seq.sequence_value()
                 scope = seq.scope()
                 if isinstance(inner, crep.cpp_sequence):
+                    # The inner storage is a class member, so its memory is kept from one
+                    # object to the next. It is cleared once it has been copied out.
                     scope = seq.iterator_value().scope()
-                    storage = crep.cpp_variable(unique_name('ntuple'), scope, cpp_type=inner.cpp_type())
-                    assert not isinstance(scope, gc_scope_top_level)
-                    scope.declare_variable(storage)
-                    fill_collection_levels(inner, storage)
+                    storage = crep.cpp_variable(unique_name('ntuple', is_class_var=True), scope,
+                                                cpp_type=cast(ctyp.collection, accumulator.cpp_type()).element_type())
+                    self._gc.declare_class_variable(storage)
+                    fill_collection_levels(inner, storage, scope)
                     inner = storage
 
                 set_scope(scope, scope_fill)
                 self._gc.add_statement(statement.push_back(accumulator, inner))
+                if inner is not seq.sequence_value():
+                    self._gc.add_statement(statement.container_clear(inner))
 
-            fill_collection_levels(e_rep, e_name)
+            fill_collection_levels(e_rep, e_name, scope_fill)
 
         else:
             # Set the scope. Normally we want to do it where the variable was calculated
@@ -894,13 +1260,17 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         if not isinstance(seq_values, crep.cpp_tuple):
             seq_values = crep.cpp_tuple((v_rep_not_norm.sequence_value(),), scope_fill)
 
+        # The Fill must be inside any filters on a sequence of values.
+        if not any(rep_is_collection(v) for v in seq_values.values()):
+            scope_fill = self._filtered_scope(v_rep_not_norm, scope_fill)
+
         # Make sure the number of items is the same as the number of columns specified.
         if len(seq_values.values()) != len(column_names):
             raise Exception("Number of columns ({0}) is not the same as labels ({1}) in TTree creation".format(len(seq_values.values()), len(column_names)))
 
         # Next, look at each on in turn to decide if it is a vector or a simple variable.
         # Create a variable that we will fill for each one.
-        var_names = [(name, crep.cpp_variable(unique_name(name, is_class_var=True), self._gc.current_scope(), cpp_type=get_ttree_type(rep)))
+        var_names = [(name, crep.cpp_variable(unique_name(name, is_class_var=True), self._gc.current_scope(), cpp_type=self._branch_type(rep)))
                      for name, rep in zip(column_names, seq_values.values())]
 
         # For each incoming variable, we need to declare something we are going to write.
@@ -908,7 +1278,7 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
             self._gc.declare_class_variable(cv[1])
 
         # Next, emit the booking code
-        self._gc.add_book_statement(self.create_book_ttree_obj(tree_name, var_names))
+        self._gc.add_book_statement(self.create_book_ttree_obj(tree_name, var_names, self._context.output_options))
 
         # Note that the output file and tree are what we are going to return.
         # The output filename is fixed - the hose code in AnalysisBase has that hard coded.
@@ -1019,43 +1389,29 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         self._result = node.rep  # type: ignore
 
     def call_Range(self, node: ast.AST, args: List[ast.AST]):
-        'Create a collection of numbers from lower_bound'
+        r'''
+        Create a sequence of the integers from lower_bound up to (but not including) upper_bound.
+        This is a counting for loop - no collection is ever made.
+        '''
 
         if len(args) != 2:
-            raise Exception('blah blah')
-        lower_bound = args[0]
-        upper_bound = args[1]
+            raise Exception(f'Range requires two arguments (lower and upper bound), but was given {len(args)}.')
+        # The bounds may take code to calculate - which has to run before the loop's block.
+        begin_value = self.get_rep(args[0])
+        end_bound = self.get_rep(args[1])
 
         self._gc.add_statement(statement.block())
 
+        # The upper bound is only calculated once.
         element_type = ctyp.terminal("int")
-        begin_value = crep.cpp_variable(unique_name("begin"), self._gc.current_scope(), element_type, initial_value=self.get_rep(lower_bound))  # type: ignore
-        end_value = crep.cpp_variable(unique_name("end"), self._gc.current_scope(), element_type, initial_value=self.get_rep(upper_bound))  # type: ignore
-        self._gc.declare_variable(begin_value)
+        end_value = crep.cpp_variable(unique_name("end"), self._gc.current_scope(), element_type, initial_value=end_bound)  # type: ignore
         self._gc.declare_variable(end_value)
 
-        vector_value = crep.cpp_collection(unique_name("r_obj"), self._gc.current_scope(), ctyp.collection(element_type))
-        self._gc.declare_variable(crep.cpp_variable(vector_value.as_cpp(), self._gc.current_scope(),
-                                                    ctyp.collection(element_type),
-                                                    crep.cpp_value(f"{end_value.as_cpp()} - {begin_value.as_cpp()}",
-                                                                   self._gc.current_scope(),
-                                                                   ctyp.terminal("int"))))
-
-        vector_value_begin = crep.cpp_value(f"{vector_value.as_cpp()}.begin()",
-                                            self._gc.current_scope(),
-                                            ctyp.terminal(f"std::vector<{element_type}>::iterator"))
-        vector_value_end = crep.cpp_value(f"{vector_value.as_cpp()}.end()",
-                                          self._gc.current_scope(),
-                                          ctyp.terminal(f"std::vector<{element_type}>::iterator"))
-
-        c = ast.Call(func=FunctionAST("std::iota", ["numeric"], "void"),
-                     args=[vector_value_begin.as_ast(),
-                           vector_value_end.as_ast(),
-                           begin_value.as_ast()])
-
-        self._gc.add_statement(statement.arbitrary_statement(self.get_rep(c).as_cpp()))
+        iterator_value = crep.cpp_value(unique_name("i_obj"), None, element_type)  # type: ignore
+        self._gc.add_statement(statement.range_loop(iterator_value, begin_value, end_value))  # type: ignore
+        iterator_value.reset_scope(self._gc.current_scope())
 
-        seq = self.make_sequence_from_collection(vector_value)
+        seq = crep.cpp_sequence(iterator_value, iterator_value, self._gc.current_scope())
         node.rep = seq  # type: ignore
         self._result = seq
         return seq
@@ -1086,14 +1442,14 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         # Now, as long as is_first is true, we can execute things inside this statement.
         # The trick is putting the if statement in the right place. We need to locate it just one level
         # below where we defined the scope above.
-        s = statement.iftest(is_first)
-        s.add_statement(statement.set_var(is_first, crep.cpp_value('false', top_level_scope(), cpp_type=ctyp.terminal('bool'))))
-
         sv = seq.sequence_value()
-        if isinstance(sv, crep.cpp_sequence):
-            self._gc.set_scope(sv.iterator_value().scope()[-1])
-        else:
-            self._gc.set_scope(sv.scope())
+        self._gc.set_scope(self._item_scope(seq))
+
+        # Once the code for the first item has run there is no need to look at the rest. That code
+        # is only sure to be inside the if statement when the first item is a value.
+        can_break = not isinstance(sv, crep.cpp_sequence) and self._can_break_out_of(loop_scope)
+        s = statement.iftest(is_first, break_after=can_break)
+        s.add_statement(statement.set_var(is_first, crep.cpp_value('false', top_level_scope(), cpp_type=ctyp.terminal('bool'))))
         self._gc.add_statement(s)
 
         # If we just found the first sequence in a sequence, return that.
@@ -1102,3 +1458,52 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
 
         node.rep = first_value  # type: ignore
         self._result = first_value
+
+    def call_Any(self, node: ast.AST, args: List[ast.AST]):
+        'True if the predicate is true for any item of the sequence. Stops looking at the first one.'
+        return self._call_quantifier(node, args, is_any=True)
+
+    def call_All(self, node: ast.AST, args: List[ast.AST]):
+        'True if the predicate is true for every item of the sequence. Stops looking at the first failure.'
+        return self._call_quantifier(node, args, is_any=False)
+
+    def _call_quantifier(self, node: ast.AST, args: List[ast.AST], is_any: bool):
+        r'''
+        Implement Any and All: a bool, set to the answer for an empty sequence, that is flipped, and
+        the loop left, by the first item that decides the answer.
+        '''
+        name = 'Any' if is_any else 'All'
+        if len(args) != 2:
+            raise Exception(f'{name} requires a sequence and a predicate, but was given {len(args)} arguments.')
+        source = args[0]
+        predicate = args[1]
+        if not isinstance(predicate, ast.Lambda):
+            raise Exception(f'The predicate for {name} must be a lambda.')
+
+        seq = self.as_sequence(source)
+        bool_type = ctyp.terminal('bool')
+        result, result_scope = self._create_accumulator(seq, bool_type,
+                                                        initial_value=crep.cpp_value('false' if is_any else 'true', self._gc.current_scope(), bool_type))
+
+        # The test happens at the current iterator scope, as for Aggregate.
+        self._set_accumulate_scope(seq)
+        sv = seq.sequence_value()
+        test = self.get_rep(ast.Call(func=lambda_unwrap(predicate), args=[sv.as_ast()]))
+        if not is_any:
+            test = crep.cpp_value(f'!{test.as_cpp()}', self._gc.current_scope(), bool_type)
+
+        s = statement.iftest(test, break_after=self._can_break_out_of(seq.iterator_value().scope()))
+        s.add_statement(statement.set_var(result, crep.cpp_value('true' if is_any else 'false', top_level_scope(), bool_type)))
+        self._gc.add_statement(s)
+
+        self._gc.set_scope(result_scope)
+        node.rep = result  # type: ignore
+        self._result = result
+        return result
+
+    def _can_break_out_of(self, loop_scope: Union[gc_scope, gc_scope_top_level]) -> bool:
+        'True if a `break` at the current scope would leave the loop `loop_scope` is the inside of, and no other'
+        return not loop_scope.is_top_level() \
+            and isinstance(cast(gc_scope, loop_scope).block(), statement.loop) \
+            and self._gc.current_scope().starts_with(loop_scope) \
+            and not self._gc.is_in_loop_below(loop_scope)
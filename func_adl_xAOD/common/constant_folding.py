@@ -0,0 +1,210 @@
+# Constant folding and simple algebraic clean up of a query ast.
+#
+# Queries built by other tools are often full of things like `j.pt()/1000.0/1.0 > 20*1000/1000`,
+# `abs(-3)`, or `True and (j.pt() > 5)`. Left alone each of these makes it into the C++ (and an
+# `and` costs a declared bool and an if block). This pass folds them away before translation.
+#
+# Folding must not change what the C++ would have calculated, so it stays on the safe side:
+#   - Integer `/` is only folded when it is exact (C++ truncates, python does not), `%` only for
+#     non-negative integers, and integer results must fit in a C++ `int`.
+#   - An identity operation with a float (`x/1.0`, `x + 0.0`) is only dropped when `x` is already
+#     a double - otherwise it is what turns `x` into one.
+#   - A boolean operator is only replaced by one of its operands if that operand is a bool.
+import ast
+import math
+import operator
+from typing import Any, Optional
+
+_binary_operators = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+}
+
+_compare_operators = {
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+}
+
+# Functions that can be evaluated on constants. The results match their `cpp_functions` mapping.
+_functions = {
+    'abs': abs,
+    'fabs': math.fabs,
+    'sqrt': math.sqrt,
+    'exp': math.exp,
+    'log': math.log,
+    'sin': math.sin,
+    'cos': math.cos,
+    'tan': math.tan,
+}
+
+_int_min = -2**31
+_int_max = 2**31 - 1
+
+
+def _number(node: ast.AST) -> Optional[Any]:
+    'Return the value of a literal int or float, or None'
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    return None
+
+
+def _is_double(node: ast.AST) -> bool:
+    'True if `node` is sure to be a double in C++'
+    if isinstance(node, ast.Constant):
+        return type(node.value) is float
+    if isinstance(node, ast.BinOp):
+        return isinstance(node.op, ast.Div) or _is_double(node.left) or _is_double(node.right)
+    if isinstance(node, ast.UnaryOp):
+        return _is_double(node.operand)
+    return False
+
+
+def _is_bool(node: ast.AST) -> bool:
+    'True if `node` is sure to be a bool'
+    if isinstance(node, ast.Constant):
+        return type(node.value) is bool
+    return isinstance(node, (ast.Compare, ast.BoolOp)) \
+        or (isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not))
+
+
+def _fold_binary(op: ast.operator, left, right) -> Optional[Any]:
+    'Calculate `left op right` as C++ would, or return None if that is not safe to do'
+    both_int = type(left) is int and type(right) is int
+    if isinstance(op, (ast.Div, ast.Mod)) and right == 0:
+        return None
+    if isinstance(op, ast.Div) and both_int and left % right != 0:
+        return None
+    if isinstance(op, ast.Mod) and (not both_int or left < 0 or right < 0):
+        return None
+    if type(op) not in _binary_operators:
+        return None
+
+    return _checked(_binary_operators[type(op)](left, right))
+
+
+def _checked(result) -> Optional[Any]:
+    'Return `result` if it can be written as a C++ literal, otherwise None'
+    if type(result) is int and not (_int_min <= result <= _int_max):
+        return None
+    if type(result) is float and not math.isfinite(result):
+        return None
+    return result
+
+
+def _is_identity(op: ast.operator, constant, other: ast.AST) -> bool:
+    'True if `other op constant` is just `other`'
+    if isinstance(op, (ast.Add, ast.Sub)):
+        is_identity = constant == 0
+    elif isinstance(op, (ast.Mult, ast.Div)):
+        is_identity = constant == 1
+    else:
+        return False
+    if not is_identity:
+        return False
+
+    # The operation turns a bool into an int (`(j.pt() > 10)*1`, to count in a `Sum`)
+    if _is_bool(other):
+        return False
+
+    # With a float, or a divide, the operation may be what makes `other` a double
+    if type(constant) is float or isinstance(op, ast.Div):
+        return _is_double(other)
+    return True
+
+
+def _constant(value, node: ast.AST) -> ast.Constant:
+    return ast.copy_location(ast.Constant(value=value), node)
+
+
+class fold_constants(ast.NodeTransformer):
+    r'''
+    Fold constant expressions, remove identity operations, and simplify boolean operations that
+    have constant operands. Run it on the query ast before translation.
+    '''
+
+    def visit_BinOp(self, node: ast.BinOp):
+        self.generic_visit(node)
+
+        left = _number(node.left)
+        right = _number(node.right)
+        if left is not None and right is not None:
+            result = _fold_binary(node.op, left, right)
+            return node if result is None else _constant(result, node)
+
+        if right is not None and _is_identity(node.op, right, node.left):
+            return node.left
+        if left is not None and isinstance(node.op, (ast.Add, ast.Mult)) and _is_identity(node.op, left, node.right):
+            return node.right
+        return node
+
+    def visit_UnaryOp(self, node: ast.UnaryOp):
+        self.generic_visit(node)
+
+        value = _number(node.operand)
+        if value is not None and isinstance(node.op, ast.USub):
+            return _constant(-value, node)
+        if value is not None and isinstance(node.op, ast.UAdd):
+            return node.operand
+        if isinstance(node.op, ast.Not) and isinstance(node.operand, ast.Constant) and type(node.operand.value) is bool:
+            return _constant(not node.operand.value, node)
+        return node
+
+    def visit_Compare(self, node: ast.Compare):
+        self.generic_visit(node)
+
+        if len(node.ops) != 1 or type(node.ops[0]) not in _compare_operators:
+            return node
+        left = _number(node.left)
+        right = _number(node.comparators[0])
+        if left is None or right is None:
+            return node
+        return _constant(_compare_operators[type(node.ops[0])](left, right), node)
+
+    def visit_BoolOp(self, node: ast.BoolOp):
+        self.generic_visit(node)
+
+        # True is neutral in an `and`, and False decides it. The other way around for `or`.
+        is_and = isinstance(node.op, ast.And)
+        kept = []
+        for v in node.values:
+            if isinstance(v, ast.Constant) and type(v.value) is bool:
+                if v.value != is_and:
+                    return _constant(not is_and, node)
+            else:
+                kept.append(v)
+
+        if len(kept) == 0:
+            return _constant(is_and, node)
+        if len(kept) == 1:
+            return kept[0] if _is_bool(kept[0]) else node
+        node.values = kept
+        return node
+
+    def visit_Call(self, node: ast.Call):
+        self.generic_visit(node)
+
+        if not isinstance(node.func, ast.Name):
+            return node
+
+        # A filter that lets everything through does nothing.
+        if node.func.id == 'Where' and len(node.args) == 2 and isinstance(node.args[1], ast.Lambda):
+            body = node.args[1].body
+            if isinstance(body, ast.Constant) and body.value is True:
+                return node.args[0]
+
+        if node.func.id in _functions and len(node.keywords) == 0:
+            args = [_number(a) for a in node.args]
+            if len(args) > 0 and all(a is not None for a in args):
+                try:
+                    result = _checked(_functions[node.func.id](*args))
+                except (ValueError, OverflowError, TypeError):
+                    return node
+                return node if result is None else _constant(result, node)
+        return node
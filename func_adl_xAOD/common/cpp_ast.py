@@ -2,16 +2,14 @@
 #
 # This is one mechanism to allow for a leaky abstraction.
 import ast
-from typing import Callable, Optional, cast
+from typing import Callable, List, Optional, Tuple, Union, cast
 
+import func_adl_xAOD.common.cpp_types as ctyp
 import func_adl_xAOD.common.statement as statements
-from func_adl_xAOD.common.cpp_representation import cpp_value, cpp_variable
-from func_adl_xAOD.common.util_scope import gc_scope
-
-# The list of methods and the re-write functions for them. Each rewrite function
-# is called with the Call node, which includes arguments, names, etc. It should return
-# None or a cpp_ast.
-method_names = {}
+from func_adl_xAOD.common.cpp_representation import (cpp_collection, cpp_value,
+                                                     cpp_variable)
+from func_adl_xAOD.common.cpp_vars import unique_name
+from func_adl_xAOD.common.util_scope import gc_scope, top_level_scope
 
 
 class CPPCodeValue (ast.AST):
@@ -26,6 +24,14 @@ class CPPCodeValue (ast.AST):
         # Files that need to be included at the top of the generated C++ file
         self.include_files = []
 
+        # Members of the query class the code uses, as (name, C++ type, initial value) strings. The name is
+        # replaced in the code with the member's C++ name. A member is declared once per query, however many
+        # times the code runs, and is shared with any other code that asks for the same type and initial value.
+        self.class_members = []
+
+        # Files the class declaration needs for the types of `class_members`
+        self.class_include_files = []
+
         # Code that is run once at the start of each "event"
         self.initialization_code = []
 
@@ -42,18 +48,42 @@ class CPPCodeValue (ast.AST):
         # the tuple might be ("obj", "j")).
         self.replacement_instance_obj = None
 
+        # True if the result depends only on the event (e.g. it is a collection fetched by name). It is then
+        # computed once per event, at the outermost scope, no matter how many times or where it is used.
+        self.event_level = False
+
         # A string representing the result value. This must be a simple variable. It will get replaced
-        # in all the code lines above.
+        # in all the code lines above. If there is no running code, this is instead a C++ expression that is
+        # used in place, wherever the result is needed (e.g. to refer to a vector without copying it).
         self.result: Optional[str] = None
 
         # Representation to use for the resulting variable. Includes C++ type information.
-        # A lambda that takes teh scope as an argument and returns a cpp variable to hold things.
+        # A callable that takes teh scope as an argument and returns a cpp variable to hold things.
+        # Use `functools.partial` with `variable_result_rep` or `collection_result_rep` to keep it picklable.
         self.result_rep: Optional[Callable[[gc_scope], cpp_variable]] = None
 
         # We have no further fields for the ast machinery to explore, so this is empty for now.
         self.fields = []
 
 
+def variable_result_rep(base_name: str, cpp_type, scope: gc_scope, expression: Optional[str] = None) -> Union[cpp_variable, cpp_value]:
+    r'''
+    A `CPPCodeValue.result_rep` that makes a new variable named after `base_name`, or, if
+    `expression` is given, a value for the expression.
+
+    Bind the first two arguments with `functools.partial` rather than writing a lambda, so that the
+    ast stays picklable (and can be shipped to another process for translation).
+    '''
+    if expression is not None:
+        return cpp_value(expression, scope=scope, cpp_type=cpp_type)
+    return cpp_variable(unique_name(base_name), scope=scope, cpp_type=cpp_type)
+
+
+def collection_result_rep(base_name: str, collection_type, scope: gc_scope, expression: Optional[str] = None) -> cpp_collection:
+    'Like `variable_result_rep`, but the result is a collection'
+    return cpp_collection(expression if expression is not None else unique_name(base_name), scope=scope, collection_type=collection_type)
+
+
 class cpp_ast_finder(ast.NodeTransformer):
     r'''
     Look through the complete ast and replace method calls that are to a C++ plug in with a c++ ast
@@ -94,6 +124,53 @@ class cpp_ast_finder(ast.NodeTransformer):
         return node
 
 
+def _replacements(visitor, call_node: ast.Call) -> List[Tuple[str, str]]:
+    'Return the (text, C++) replacements for the instance object and the arguments of the call'
+    cpp_ast_node = cast(CPPCodeValue, call_node.func)
+
+    # Build the dictionary for replacement for the object we are calling
+    # against, if any.
+    repl_list = []
+    if cpp_ast_node.replacement_instance_obj is not None:
+        repl_list += [(cpp_ast_node.replacement_instance_obj[0], visitor.resolve_id(cpp_ast_node.replacement_instance_obj[1]).rep.as_cpp())]
+
+    # Process the arguments that are getting passed to the function
+    for arg, dest in zip(cpp_ast_node.args, call_node.args):
+        rep = visitor.get_rep(dest)
+        repl_list += [(arg, rep.as_cpp())]
+    return repl_list
+
+
+def cse_key(visitor, call_node: ast.Call) -> Tuple:
+    r'''
+    Return a key that is the same for two calls exactly when they would run the same C++ code
+    with the same arguments (and so produce the same result).
+    '''
+    cpp_ast_node = cast(CPPCodeValue, call_node.func)
+    return ('cse', tuple(cpp_ast_node.include_files), tuple(cpp_ast_node.initialization_code),
+            tuple(cpp_ast_node.class_members), tuple(cpp_ast_node.running_code), cpp_ast_node.result,
+            tuple(_replacements(visitor, call_node)))
+
+
+def _class_member_replacements(gc, cpp_ast_node: CPPCodeValue) -> List[Tuple[str, str]]:
+    'Declare the class members of the code, and return the (text, C++) replacements for them'
+    repl_list = []
+    for name, cpp_type, initial_value in cpp_ast_node.class_members:
+        member = cpp_variable(unique_name(name, is_class_var=True), top_level_scope(), ctyp.terminal(cpp_type),
+                              initial_value=cpp_value(initial_value, top_level_scope(), None))
+        member = gc.declare_class_variable(member, key=('class_member', cpp_type, initial_value))
+        repl_list += [(name, member.as_cpp())]
+    for i in cpp_ast_node.class_include_files:
+        gc.add_class_include(i)
+    return repl_list
+
+
+def _replaced(s: str, repl_list: List[Tuple[str, str]]) -> str:
+    for src, dest in repl_list:
+        s = s.replace(src, str(dest))
+    return s
+
+
 def process_ast_node(visitor, gc, call_node: ast.Call):
     r'''Inject the proper code into the output stream to deal with this C++ code.
 
@@ -107,8 +184,17 @@ def process_ast_node(visitor, gc, call_node: ast.Call):
     representation - A value that represents the output
     '''
 
-    # We write everything into a new scope to prevent conflicts. So we have to declare the result ahead of time.
     cpp_ast_node = cast(CPPCodeValue, call_node.func)
+    assert cpp_ast_node.result is not None
+
+    # With no code to run, the result is an expression we can hand back directly.
+    if len(cpp_ast_node.running_code) == 0:
+        for i in cpp_ast_node.include_files:
+            gc.add_include(i)
+        repl_list = _replacements(visitor, call_node) + _class_member_replacements(gc, cpp_ast_node)
+        return cpp_ast_node.result_rep(gc.current_scope(), expression=_replaced(cpp_ast_node.result, repl_list))
+
+    # We write everything into a new scope to prevent conflicts. So we have to declare the result ahead of time.
     result_rep = cpp_ast_node.result_rep(gc.current_scope())
 
     gc.declare_variable(result_rep)
@@ -117,29 +203,16 @@ def process_ast_node(visitor, gc, call_node: ast.Call):
     for i in cpp_ast_node.include_files:
         gc.add_include(i)
 
-    # Build the dictionary for replacement for the object we are calling
-    # against, if any.
-    repl_list = []
-    if cpp_ast_node.replacement_instance_obj is not None:
-        repl_list += [(cpp_ast_node.replacement_instance_obj[0], visitor.resolve_id(cpp_ast_node.replacement_instance_obj[1]).rep.as_cpp())]
-
-    # Process the arguments that are getting passed to the function
-    for arg, dest in zip(cpp_ast_node.args, call_node.args):
-        rep = visitor.get_rep(dest)
-        repl_list += [(arg, rep.as_cpp())]
+    repl_list = _replacements(visitor, call_node) + _class_member_replacements(gc, cpp_ast_node)
 
     # Emit the statements.
     blk = statements.block()
     visitor._gc.add_statement(blk)
 
     for s in cpp_ast_node.running_code:
-        l_s = s
-        for src, dest in repl_list:
-            l_s = l_s.replace(src, str(dest))
-        blk.add_statement(statements.arbitrary_statement(l_s))
+        blk.add_statement(statements.arbitrary_statement(_replaced(s, repl_list)))
 
     # Set the result and close the scope
-    assert cpp_ast_node.result is not None
     blk.add_statement(statements.set_var(result_rep, cpp_value(cpp_ast_node.result, gc.current_scope(), result_rep.cpp_type())))
     gc.pop_scope()
 
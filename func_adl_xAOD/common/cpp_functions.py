@@ -2,6 +2,7 @@
 # equivalent in C++.
 import ast
 from collections import namedtuple
+from typing import Any, Mapping, Optional
 
 
 class FunctionAST(ast.AST):
@@ -23,6 +24,16 @@ class FunctionAST(ast.AST):
 
 
 class find_known_functions(ast.NodeTransformer):
+    def __init__(self, functions: Optional[Mapping[str, Any]] = None):
+        '''
+        functions: Mapping from python function name to `cpp_function`. Defaults to the
+                   mappings of the active translation context.
+        '''
+        if functions is None:
+            from func_adl_xAOD.common.translation_context import current_context
+            functions = current_context().functions
+        self._functions = functions
+
     def visit_Call(self, node):
         'Look for a call to a Name function that is in our list'
         # First go one level down.
@@ -39,11 +50,11 @@ class find_known_functions(ast.NodeTransformer):
         except NameError:
             fnc_name = node.func.id
 
-        if fnc_name not in functions_to_replace:
+        if fnc_name not in self._functions:
             return node
 
         # Build the replacement.
-        info = functions_to_replace[fnc_name]
+        info = self._functions[fnc_name]
         node.func = FunctionAST(info.cpp_name, info.include_files, info.cpp_return_type)
 
         return node
@@ -57,7 +68,6 @@ def add_function_mapping(python_name, cpp_name, include_files, return_type):
     include_files: any include files that should be included in the C++ source. Can also be a single string.
     return_type: C++ return type
     '''
-    global functions_to_replace
     functions_to_replace[python_name] = cpp_function(cpp_name, include_files if type(include_files) is list else [include_files, ], return_type)
 
 
@@ -21,15 +21,16 @@ class terminal:
         return self._is_pointer
 
     def default_value(self):
-        raise NotImplementedError()
-        # if self._type == "double":
-        #     return "0.0"
-        # elif self._type == "float":
-        #     return "0.0"
-        # elif self._type == "int":
-        #     return "0"
-        # else:
-        #     raise Exception(f"Do not know a default value for the type '{self._type}'.")
+        if self._type == "double":
+            return "0.0"
+        elif self._type == "float":
+            return "0.0"
+        elif self._type == "int":
+            return "0"
+        elif self._type == "bool":
+            return "false"
+        else:
+            raise Exception(f"Do not know a default value for the type '{self._type}'.")
 
     @property
     def type(self) -> str:
@@ -1,13 +1,13 @@
 # Utility routines to help with variables
-
-# A global counter to help with unique variable numbering.
-
-unique_var_index = 0
+from func_adl_xAOD.common.translation_context import current_context
 
 
 def unique_name(name, is_class_var=False):
     r'''Will return a new C++ legal variable name that has been made unique with an index.
 
+    The index comes from the active `TranslationContext`, so names are unique within
+    a single translation.
+
     name - Base name of the variable. For example, if it is "dude", then "dude7" might be the result.
     is_class_var - If true, this is intended to be defined at the class level. A "_" is added as prefix.
 
@@ -15,8 +15,4 @@ def unique_name(name, is_class_var=False):
 
     String of a new variable number.
     '''
-
-    global unique_var_index
-    v_name = ("_" if is_class_var else "") + name + str(unique_var_index)
-    unique_var_index += 1
-    return v_name
+    return current_context().unique_name(name, is_class_var)
@@ -0,0 +1,160 @@
+# Common sub-expression elimination.
+#
+# A query like `Select(lambda j: (j.pt()/1000.0, j.pt()/1000.0 > 30))` asks for `j.pt()` twice.
+# Left alone the visitor writes `i_obj->pt()` inline at each use, and the compiled code
+# repeats the (virtual, aux store) lookup for each use, for every object in every event.
+#
+# This happens in two steps:
+#   1. Before translation, `mark_repeated_expressions` finds the calls (member calls, `FunctionAST`
+#      calls, and `CPPCodeValue` calls) that occur more than once in the query and marks them.
+#   2. During translation, the first marked call to be rendered is stored in a local variable,
+#      and later renders of the same C++ expression, at the same scope or deeper, re-use it.
+#      See `query_ast_visitor.common_subexpression`.
+#
+# Step 2 keys on the rendered C++, which is exact. Step 1 stops us from filling the code with
+# locals that are only used once: two `j.pt()` calls in different lambdas are only repeats if
+# both `j`'s are bound to the same item of the same loop (see `_binder`).
+import ast
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from func_adl_xAOD.common.aggregates import fused_group
+from func_adl_xAOD.common.cpp_ast import CPPCodeValue
+from func_adl_xAOD.common.cpp_functions import FunctionAST
+from func_adl_xAOD.common.fingerprint import canonical_text
+
+# Sequence operators that call their lambda with each item of their source. A `Where` passes
+# the items on unchanged.
+_item_operators = ['Select', 'Where', 'SelectMany']
+
+
+def is_cse_candidate(node: ast.AST) -> bool:
+    'True if `node` is a call whose result does not depend on where or how often it is evaluated'
+    return isinstance(node, ast.Call) \
+        and isinstance(node.func, (ast.Attribute, FunctionAST, CPPCodeValue))
+
+
+def is_repeated(node: ast.AST) -> bool:
+    'True if `mark_repeated_expressions` found more than one copy of `node`'
+    return getattr(node, 'is_repeated', False)
+
+
+def is_shared(node: ast.AST) -> bool:
+    r'''
+    True if `mark_repeated_expressions` found `node` itself in more than one place in the query
+    (func_adl's lambda in-lining does this). The code for a shared node is made once, and then
+    used from every place it appears.
+    '''
+    return getattr(node, 'is_shared', False)
+
+
+def _sequence_call(node: Optional[ast.AST]) -> Optional[ast.Call]:
+    'If `node` is a call to a sequence function, like `Select(source, ...)` or `Count(source)`, return it'
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and len(node.args) > 0:
+        return node
+    return None
+
+
+class _binder:
+    r'''
+    Work out what the lambda arguments are bound to.
+
+    - The argument of the lambda in `Select(source, lambda j: ...)` (or `Where`, or
+      `SelectMany`) is bound to an item of `source`.
+    - The items of a `Where` are the items of its source.
+    - The items of the collection a chain of sequence functions starts from belong to the loop
+      over it: the chain itself, or the group of fused aggregates the chain is part of.
+    - Any other lambda argument is bound to itself.
+    '''
+
+    def __init__(self, a: ast.AST):
+        self._consumer: Dict[int, ast.Call] = {}
+        for n in ast.walk(a):
+            call = _sequence_call(n)
+            if call is not None:
+                self._consumer[id(call.args[0])] = call
+
+    def _loop(self, call: ast.Call) -> Hashable:
+        'The loop the chain that `call` is part of runs in'
+        top = call
+        while id(top) in self._consumer:
+            top = self._consumer[id(top)]
+            group = fused_group(top)
+            if group is not None:
+                return id(group)
+        return id(top)
+
+    def _item(self, call: ast.Call) -> Hashable:
+        'What an item of the source of `call` is'
+        source = _sequence_call(call.args[0])
+        if source is not None and source.func.id == 'Where':  # type: ignore
+            return self._item(source)
+        if source is not None and source.func.id in _item_operators:  # type: ignore
+            return ('item', id(source))
+        return ('item', id(call.args[0]), self._loop(call))
+
+    def bindings(self, node: ast.Lambda, parent: Optional[ast.AST]) -> Dict[str, Hashable]:
+        'What each argument of `node`, a lambda found in `parent`, is bound to'
+        call = _sequence_call(parent)
+        if call is not None and call.func.id in _item_operators \
+                and len(call.args) == 2 and call.args[1] is node and len(node.args.args) == 1:  # type: ignore
+            return {node.args.args[0].arg: self._item(call)}
+        return {arg.arg: ('arg', id(node), arg.arg) for arg in node.args.args}
+
+
+class _candidate_finder(ast.NodeVisitor):
+    'Group the candidate calls by their canonical text and what the names in them are bound to'
+
+    def __init__(self, binder: _binder):
+        self.found: Dict[Tuple[str, Hashable], List[ast.AST]] = {}
+        self._binder = binder
+        self._bound: List[Dict[str, Hashable]] = []
+        self._parents: List[ast.AST] = []
+
+    def _lookup(self, name: str) -> Hashable:
+        'What `name` is bound to - None if it is not a lambda argument'
+        for frame in reversed(self._bound):
+            if name in frame:
+                return frame[name]
+        return None
+
+    def _key(self, node: ast.AST) -> Tuple[str, Hashable]:
+        names = sorted({n.id for n in ast.walk(node) if isinstance(n, ast.Name)})
+        return canonical_text(node), tuple((name, self._lookup(name)) for name in names)
+
+    def generic_visit(self, node):
+        if is_cse_candidate(node):
+            self.found.setdefault(self._key(node), []).append(node)
+
+        is_lambda = isinstance(node, ast.Lambda)
+        if is_lambda:
+            self._bound.append(self._binder.bindings(node, self._parents[-1] if len(self._parents) > 0 else None))
+        self._parents.append(node)
+        super().generic_visit(node)
+        self._parents.pop()
+        if is_lambda:
+            self._bound.pop()
+
+
+def mark_repeated_expressions(a: ast.AST) -> ast.AST:
+    r'''
+    Mark each candidate call in `a` that has an identical copy elsewhere in `a`, working on the
+    same objects, by setting its `is_repeated` attribute, and each node that appears more than
+    once in `a`, by setting its `is_shared` attribute. Returns `a`.
+    '''
+    # Only expressions: python's parser shares a single instance of each operator and context.
+    seen = set()
+    for n in ast.walk(a):
+        if isinstance(n, ast.expr):
+            if id(n) in seen:
+                n.is_shared = True  # type: ignore
+            seen.add(id(n))
+
+    finder = _candidate_finder(_binder(a))
+    finder.visit(a)
+    for nodes in finder.found.values():
+        # A shared node is visited once for each place it appears, but is still only one call.
+        distinct = {id(n): n for n in nodes}
+        if len(distinct) > 1:
+            for n in distinct.values():
+                n.is_repeated = True  # type: ignore
+    return a
@@ -2,11 +2,10 @@
 import ast
 import copy
 from abc import ABC, abstractmethod
+from functools import partial
 
 import func_adl_xAOD.common.cpp_ast as cpp_ast
-import func_adl_xAOD.common.cpp_representation as crep
 import func_adl_xAOD.common.cpp_types as ctyp
-from func_adl_xAOD.common.cpp_vars import unique_name
 from func_adl_xAOD.common.math_utils import get_math_methods
 
 
@@ -65,12 +64,13 @@ class event_collections(ABC):
 
         r.running_code += self.get_running_code(info['container_type'])
         r.result = 'result'
+        r.event_level = True
 
         is_collection = info['is_collection'] if 'is_collection' in info else True
         if is_collection:
-            r.result_rep = lambda scope: crep.cpp_collection(unique_name(info['function_name'].lower()), scope=scope, collection_type=info['container_type'])  # type: ignore
+            r.result_rep = partial(cpp_ast.collection_result_rep, info['function_name'].lower(), info['container_type'])
         else:
-            r.result_rep = lambda scope: crep.cpp_variable(unique_name(info['function_name'].lower()), scope=scope, cpp_type=info['container_type'])
+            r.result_rep = partial(cpp_ast.variable_result_rep, info['function_name'].lower(), info['container_type'])
 
         # Replace it as the function that is going to get called.
         call_node.func = r
@@ -80,7 +80,7 @@ class event_collections(ABC):
     # Config everything.
     def create_higher_order_function(self, info):
         'Creates a higher-order function because python scoping is broken'
-        return lambda call_node: self.get_collection(info, call_node)
+        return partial(self.get_collection, info)
 
     def get_method_names(self):
         method_names = {}
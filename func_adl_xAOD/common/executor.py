@@ -1,24 +1,47 @@
 # Drive the translate of the AST from start into a set of files, which one can then do whatever
 # is needed to.
 import ast
+import hashlib
 import os
 import sys
+import threading
 from abc import ABC, abstractmethod
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing.context import BaseContext
 from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
 
 import func_adl_xAOD.common.cpp_ast as cpp_ast
+import func_adl_xAOD.common.cpp_functions as cpp_functions
 import func_adl_xAOD.common.cpp_representation as crep
+import func_adl_xAOD.common.cpp_types as ctyp
+import func_adl_xAOD.common.translation_cache as tcache
 import jinja2
-from func_adl.ast.aggregate_shortcuts import aggregate_node_transformer
-from func_adl.ast.func_adl_ast_utils import change_extension_functions_to_calls
+from func_adl.ast.func_adl_ast_utils import (change_extension_functions_to_calls,
+                                             default_list_of_functions)
 from func_adl.ast.function_simplifier import simplify_chained_calls
+from func_adl_xAOD.common.aggregates import fuse_aggregates, normalize_aggregates
 from func_adl_xAOD.common.ast_to_cpp_translator import query_ast_visitor
 from func_adl_xAOD.common.cpp_functions import find_known_functions
+from func_adl_xAOD.common.constant_folding import fold_constants
+from func_adl_xAOD.common.cse import mark_repeated_expressions
+from func_adl_xAOD.common.fingerprint import ast_fingerprint
+from func_adl_xAOD.common.math_utils import square_deltar_comparisons
+from func_adl_xAOD.common.output_options import ttree_output_options
+from func_adl_xAOD.common.predicate_reordering import reorder_conjuncts
+from func_adl_xAOD.common.profiling import (profile_phase, profile_record,
+                                            translation_profiler)
+from func_adl_xAOD.common.result_ttree import cpp_ttree_rep
+from func_adl_xAOD.common.translation_context import TranslationContext
 from func_adl_xAOD.common.util_scope import top_level_scope
 
 ExecutionInfo = namedtuple('ExecutionInfo', 'result_rep output_path main_script all_filenames')
 
+# The sequence functions that can be written as methods (`jets.Any(lambda j: ...)`).
+sequence_functions = default_list_of_functions + ['Any', 'All']
+
 
 class _cpp_source_emitter:
     r'''
@@ -59,6 +82,86 @@ def _find_dir(path):
     return _find(path, matchFunc=os.path.isdir)
 
 
+# The template registry: one jinja2 environment per template directory, kept for the life of
+# the process. The directory is found once, and each environment keeps its compiled templates
+# in memory. Templates are not checked for changes on disk (`auto_reload`), as they are part of
+# the installed package. Compiled templates can also be cached on disk, so a new process does
+# not have to compile them again - see `set_template_bytecode_cache`.
+_j2_environments: Dict[str, jinja2.Environment] = {}
+_j2_environments_lock = threading.Lock()
+_j2_bytecode_cache_dir: Optional[str] = os.environ.get('FUNC_ADL_TEMPLATE_BYTECODE_CACHE')
+
+
+def set_template_bytecode_cache(cache_dir: Optional[Path]):
+    r'''
+    Cache compiled templates in `cache_dir` (or turn that off with None). The environment
+    variable FUNC_ADL_TEMPLATE_BYTECODE_CACHE sets the initial value.
+    '''
+    global _j2_bytecode_cache_dir
+    with _j2_environments_lock:
+        _j2_bytecode_cache_dir = None if cache_dir is None else str(cache_dir)
+        _j2_environments.clear()
+
+
+def _template_dir(template_dir_name: str) -> str:
+    r'''
+    Find the template directory. `template_dir_name` starts with the package name, so look
+    next to the installed package first, and only then search the python path.
+    '''
+    package_parent = Path(__file__).resolve().parent.parent.parent
+    candidate = package_parent / template_dir_name
+    if candidate.is_dir():
+        return str(candidate)
+    return _find_dir(template_dir_name)
+
+
+def _j2_environment(template_dir_name: str) -> jinja2.Environment:
+    'Return the (cached) jinja2 environment for the template directory'
+    j2_env = _j2_environments.get(template_dir_name)
+    if j2_env is None:
+        with _j2_environments_lock:
+            j2_env = _j2_environments.get(template_dir_name)
+            if j2_env is None:
+                bytecode_cache = None
+                if _j2_bytecode_cache_dir is not None:
+                    Path(_j2_bytecode_cache_dir).mkdir(parents=True, exist_ok=True)
+                    bytecode_cache = jinja2.FileSystemBytecodeCache(_j2_bytecode_cache_dir)
+                j2_env = jinja2.Environment(loader=jinja2.FileSystemLoader(_template_dir(template_dir_name)),
+                                            auto_reload=False,
+                                            bytecode_cache=bytecode_cache)
+                _j2_environments[template_dir_name] = j2_env
+    return j2_env
+
+
+# The executor a batch worker process translates with. Sent once, when the worker starts.
+_batch_executor: Optional['executor'] = None
+
+
+def _init_batch_worker(exe: 'executor', method_types: Dict[str, Dict[str, object]], functions: Dict[str, object]):
+    r'''
+    Set up a batch worker process. A spawned worker starts from a fresh import, so the method
+    types and function mappings added at run time in the parent are copied in as well.
+    '''
+    global _batch_executor
+    _batch_executor = exe
+    for type_string, methods in method_types.items():
+        ctyp.g_method_type_dict.setdefault(type_string, {}).update(methods)
+    cpp_functions.functions_to_replace.update(functions)
+
+
+def _run_batch_worker(a: ast.AST, output_path: Path) -> ExecutionInfo:
+    r'''
+    Translate one query in a batch worker process. The result rep is rebuilt at the top level
+    scope so the generated code tree does not have to be pickled back to the parent.
+    '''
+    assert _batch_executor is not None
+    info = _batch_executor.write_cpp_files(a, output_path)
+    result_rep = info.result_rep
+    if isinstance(result_rep, cpp_ttree_rep):
+        result_rep = cpp_ttree_rep(result_rep.filename, result_rep.treename, top_level_scope())
+    return info._replace(result_rep=result_rep)
+
+
 def _is_format_request(a: ast.AST) -> bool:
     '''Return true if the top level ast is a call to generate a ROOT file output.
 
@@ -76,15 +179,61 @@ def _is_format_request(a: ast.AST) -> bool:
 
 
 class executor(ABC):
-    def __init__(self, file_names: list, runner_name: str, template_dir_name: str, method_names: dict):
+    def __init__(self, file_names: list, runner_name: str, template_dir_name: str, method_names: dict,
+                 translation_cache: Optional[tcache.translation_cache] = None,
+                 reorder_predicates: bool = False,
+                 output_options: Optional[ttree_output_options] = None,
+                 precise_types: bool = False):
+        r'''
+        translation_cache: Re-use the C++ of queries that have been translated before.
+        reorder_predicates: Evaluate the cheapest tests of a filter first, rather than in the
+                            order they were written. See `predicate_reordering`.
+        output_options: Compression, basket size, and auto-flush for the output TTree.
+        precise_types: Keep calculations on float values in float, rather than letting a double
+                       literal (like the `1000.0` in `j.pt()/1000.0`) promote them to double.
+        '''
         self._file_names = file_names
         self._runner_name = runner_name
         self._template_dir_name = template_dir_name
         self._method_names = method_names
-
-    def _copy_template_file(self, j2_env, info, template_file, final_dir: Path):
-        'Copy a file to a final directory'
-        j2_env.get_template(template_file).stream(info).dump(str(final_dir / template_file))
+        self._translation_cache = translation_cache
+        self._reorder_predicates = reorder_predicates
+        self._output_options = output_options
+        self._precise_types = precise_types
+        self._profiler: Optional[translation_profiler] = None
+
+    def __getstate__(self):
+        'A profiler stays in the process that attached it (its callback may not even pickle)'
+        state = self.__dict__.copy()
+        state['_profiler'] = None
+        return state
+
+    @contextmanager
+    def profile(self, callback: Optional[Callable[[profile_record], None]] = None):
+        r'''
+        Profile the translations run inside the `with` block. Yields a `translation_profiler`
+        which collects a `profile_record` for each phase of `apply_ast_transformations` and
+        `write_cpp_files` (transform, visit, emit, render, write) and for each visitor handler
+        (`call_Select`, `process_ast_node`, etc.). `callback`, if given, is called with
+        each record as it is made.
+        '''
+        old_profiler = self._profiler
+        self._profiler = translation_profiler(callback)
+        try:
+            yield self._profiler
+        finally:
+            self._profiler = old_profiler
+
+    def _bundle_hash(self, j2_env, rendered: Dict[str, str]) -> str:
+        'Hash of the rendered source files and the runner template, which together determine the build'
+        h = hashlib.sha256()
+        for file_name, text in rendered.items():
+            h.update(file_name.encode())
+            h.update(b'\0')
+            h.update(text.encode())
+        runner_source, _, _ = j2_env.loader.get_source(j2_env, self._runner_name)
+        h.update(runner_source.encode())
+        return h.hexdigest()
 
     def apply_ast_transformations(self, a: ast.AST):
         r'''
@@ -92,14 +241,34 @@ class executor(ABC):
         Return a (possibly) modified ast.
         '''
 
-        # Do tuple resolutions. This might eliminate a whole bunch fo code!
-        a = change_extension_functions_to_calls(a)
-        a = aggregate_node_transformer().visit(a)
-        a = simplify_chained_calls().visit(a)
-        a = find_known_functions().visit(a)
-
-        # Any C++ custom code needs to be threaded into the ast
-        a = cpp_ast.cpp_ast_finder(self._method_names).visit(a)
+        with profile_phase(self._profiler, 'transform'):
+            # Do tuple resolutions. This might eliminate a whole bunch fo code!
+            with profile_phase(self._profiler, 'transform.func_adl'):
+                a = change_extension_functions_to_calls(a, sequence_functions)
+                a = normalize_aggregates().visit(a)
+                a = simplify_chained_calls().visit(a)
+            with profile_phase(self._profiler, 'transform.fold_constants'):
+                a = fold_constants().visit(a)
+            with profile_phase(self._profiler, 'transform.square_deltar_comparisons'):
+                a = square_deltar_comparisons(a)
+            with profile_phase(self._profiler, 'transform.find_known_functions'):
+                a = find_known_functions().visit(a)
+
+            # Any C++ custom code needs to be threaded into the ast
+            with profile_phase(self._profiler, 'transform.cpp_ast_finder'):
+                a = cpp_ast.cpp_ast_finder(self._method_names).visit(a)
+
+            if self._reorder_predicates:
+                with profile_phase(self._profiler, 'transform.reorder_predicates'):
+                    a = reorder_conjuncts().visit(a)
+
+            # Aggregates over the same collection can share a loop.
+            with profile_phase(self._profiler, 'transform.fuse_aggregates'):
+                a = fuse_aggregates(a)
+
+            # Find the calls that are made more than once, so the C++ only does them once.
+            with profile_phase(self._profiler, 'transform.cse'):
+                a = mark_repeated_expressions(a)
 
         # And return the modified ast
         return a
@@ -108,11 +277,48 @@ class executor(ABC):
     def get_visitor_obj(self) -> query_ast_visitor:
         pass
 
-    def write_cpp_files(self, ast: ast.AST, output_path: Path) -> ExecutionInfo:
+    def fingerprint(self, a: ast.AST) -> str:
+        r'''
+        Return a digest of the transformed ast `a` that identifies the C++ this executor will
+        generate for it. Queries that differ only by lambda argument names, or by the way a constant
+        is written, get the same fingerprint. Besides the query itself, the output depends on the
+        backend templates, the version of this package, and the output and type options, so those are
+        folded in too.
+        '''
+        h = hashlib.sha256()
+        items = [ast_fingerprint(a), self._template_dir_name, tcache.package_version()]
+        if self._output_options is not None:
+            items.append(repr(self._output_options))
+        if self._precise_types:
+            items.append('precise_types')
+        for item in items:
+            h.update(item.encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def write_cpp_files(self, ast: ast.AST, output_path: Path,
+                        context: Optional[TranslationContext] = None) -> ExecutionInfo:
         r"""
         Given the AST generate the C++ files that need to run. Return them along with
         the input files.
+
+        The translation runs in `context`, or in a new `TranslationContext` if none is given.
+        With a new context each query numbers its variables from zero, and it is safe to call
+        this from several threads at once. A new context gets this executor's output options; a
+        context that is passed in brings its own.
+
+        If a translation cache was given, and it has already seen this query, the files are
+        copied from there instead. The cache is not used with a context that is passed in: its
+        options, method types, and functions can change the C++, and are not in the cache key.
         """
+        cache = self._translation_cache if context is None else None
+        if cache is not None:
+            key = self.fingerprint(ast)
+            metadata = cache.lookup(key, output_path)
+            if metadata is not None:
+                (output_path / self._runner_name).chmod(0o755)
+                result_rep = cpp_ttree_rep(metadata['filename'], metadata['treename'], top_level_scope())
+                return ExecutionInfo(result_rep, output_path, self._runner_name, self._file_names)
 
         # Find the base file dataset and mark it.
         from func_adl import find_EventDataset
@@ -122,17 +328,21 @@ class executor(ABC):
 
         # Visit the AST to generate the code structure and find out what the
         # result is going to be.
-        qv = self.get_visitor_obj()
-        result_rep = qv.get_rep(ast) if _is_format_request(ast) \
-            else qv.get_as_ROOT(ast)
-
-        # Emit the C++ code into our dictionaries to be used in template generation below.
-        query_code = _cpp_source_emitter()
-        qv.emit_query(query_code)
-        book_code = _cpp_source_emitter()
-        qv.emit_book(book_code)
-        class_decl_code = qv.class_declaration_code()
-        includes = qv.include_files()
+        with (context if context is not None else TranslationContext(self._profiler, self._output_options, self._precise_types)):
+            with profile_phase(self._profiler, 'visit'):
+                qv = self.get_visitor_obj()
+                result_rep = qv.get_rep(ast) if _is_format_request(ast) \
+                    else qv.get_as_ROOT(ast)
+
+            # Emit the C++ code into our dictionaries to be used in template generation below.
+            with profile_phase(self._profiler, 'emit'):
+                query_code = _cpp_source_emitter()
+                qv.emit_query(query_code)
+                book_code = _cpp_source_emitter()
+                qv.emit_book(book_code)
+                class_decl_code = qv.class_declaration_code()
+                includes = qv.include_files()
+                class_includes = qv.class_include_files()
 
         # The replacement dict to pass to the template generator can now be filled
         info = {}
@@ -140,16 +350,51 @@ class executor(ABC):
         info['class_decl'] = class_decl_code
         info['book_code'] = book_code.lines_of_query_code()
         info['include_files'] = includes
+        info['class_include_files'] = class_includes
+
+        # We use jinja2 templates. Render everything.
+        with profile_phase(self._profiler, 'render'):
+            j2_env = _j2_environment(self._template_dir_name)
 
-        # We use jinja2 templates. Write out everything.
-        template_dir = _find_dir(self._template_dir_name)
-        j2_env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(template_dir))
+            # The runner carries a hash of everything that goes into the build, so it can
+            # cache the build products. So it must be rendered last.
+            rendered = {f: j2_env.get_template(f).render(info) for f in self._file_names if f != self._runner_name}
+            info['bundle_hash'] = self._bundle_hash(j2_env, rendered)
+            rendered[self._runner_name] = j2_env.get_template(self._runner_name).render(info)
 
-        for file_name in self._file_names:
-            self._copy_template_file(j2_env, info, file_name, output_path)
+        # And write it out
+        with profile_phase(self._profiler, 'write'):
+            for file_name, text in rendered.items():
+                (output_path / file_name).write_text(text)
+            (output_path / self._runner_name).chmod(0o755)
 
-        (output_path / self._runner_name).chmod(0o755)
+        if cache is not None and isinstance(result_rep, cpp_ttree_rep):
+            cache.store(key, output_path, self._file_names,
+                        {'filename': result_rep.filename, 'treename': result_rep.treename})
 
         # Build the return object.
         return ExecutionInfo(result_rep, output_path, self._runner_name, self._file_names)
+
+    def write_cpp_files_many(self, asts: Sequence[ast.AST], output_dirs: Sequence[Path],
+                             max_workers: Optional[int] = None,
+                             mp_context: Optional[BaseContext] = None) -> List[ExecutionInfo]:
+        r"""
+        Translate a batch of queries in a pool of worker processes. Each ast (already transformed,
+        as for `write_cpp_files`) is written into the matching directory in `output_dirs`.
+
+        The executor is sent to each worker once, along with the method types and function
+        mappings (see `cpp_types.add_method_type_info` and `cpp_functions.add_function_mapping`),
+        and each worker keeps its jinja2 environment for the whole batch. The `ExecutionInfo`
+        objects are returned in the order of `asts`. `mp_context` picks how the workers are
+        started, as for `ProcessPoolExecutor`.
+        """
+        if len(asts) != len(output_dirs):
+            raise ValueError(f'Got {len(asts)} queries but {len(output_dirs)} output directories.')
+        if len(asts) == 0:
+            return []
+
+        method_types = {type_string: dict(methods) for type_string, methods in ctyp.g_method_type_dict.items()}
+        functions = dict(cpp_functions.functions_to_replace)
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, initializer=_init_batch_worker,
+                                 initargs=(self, method_types, functions)) as pool:
+            return list(pool.map(_run_batch_worker, asts, output_dirs))
@@ -0,0 +1,94 @@
+# Canonical fingerprint of a query ast.
+#
+# Two queries that differ only in the names of their lambda arguments, or in how a constant
+# happened to be spelled in the ast, generate the same C++. The fingerprint is built so that
+# they also get the same digest, which makes it a good key for anything cached downstream.
+import ast
+import hashlib
+from typing import Any, Dict, List
+
+from func_adl_xAOD.common.cpp_ast import CPPCodeValue
+from func_adl_xAOD.common.cpp_functions import FunctionAST
+
+
+class _canonical_renderer:
+    r'''
+    Render an ast as text that captures everything the C++ translation depends on.
+
+    - `CPPCodeValue` and `FunctionAST` nodes carry their C++ payload outside of `_fields`, so
+      `ast.dump` would make two different method calls look the same. Their payload is rendered.
+    - Lambda arguments are renamed by the order in which they are bound.
+    - Constants are rendered by python type and value, whatever ast node spelled them.
+    '''
+
+    def __init__(self):
+        self._bound: List[Dict[str, str]] = []
+        self._n_bound = 0
+
+    def _lookup(self, name: str) -> str:
+        'Return the canonical name for `name` - itself if it is not a lambda argument'
+        for frame in reversed(self._bound):
+            if name in frame:
+                return frame[name]
+        return name
+
+    def render(self, a: Any) -> str:
+        constant = _constant_value(a)
+        if constant is not _not_a_constant:
+            return f'Constant({type(constant).__name__}:{constant!r})'
+
+        if isinstance(a, ast.Lambda):
+            frame = {}
+            for arg in a.args.args:
+                frame[arg.arg] = f'_a{self._n_bound}'
+                self._n_bound += 1
+            self._bound.append(frame)
+            try:
+                return f'Lambda([{", ".join(frame.values())}], {self.render(a.body)})'
+            finally:
+                self._bound.pop()
+        if isinstance(a, ast.Name):
+            return f'Name({self._lookup(a.id)})'
+        if isinstance(a, CPPCodeValue):
+            instance_obj = None
+            if a.replacement_instance_obj is not None:
+                instance_obj = (a.replacement_instance_obj[0], self._lookup(a.replacement_instance_obj[1]))
+            return 'CPPCodeValue(' + ', '.join(self.render(v) for v in [
+                a.include_files, a.class_members, a.initialization_code, a.running_code, a.args,
+                instance_obj, a.result, a.event_level,
+            ]) + ')'
+        if isinstance(a, FunctionAST):
+            return 'FunctionAST(' + ', '.join(self.render(v) for v in [
+                a.cpp_name, a.include_files, a.cpp_return_type,
+            ]) + ')'
+        if isinstance(a, ast.AST):
+            fields = ', '.join(f'{name}={self.render(value)}' for name, value in ast.iter_fields(a)
+                               if not isinstance(value, ast.expr_context))
+            return f'{type(a).__name__}({fields})'
+        if isinstance(a, (list, tuple)):
+            return '[' + ', '.join(self.render(v) for v in a) + ']'
+        return repr(a)
+
+
+_not_a_constant = object()
+
+
+def _constant_value(a: Any) -> Any:
+    'If `a` is a literal number, string, or bool (including a negated number) return its value'
+    if isinstance(a, ast.Constant):
+        return a.value
+    if isinstance(a, ast.UnaryOp) and isinstance(a.op, ast.USub):
+        v = _constant_value(a.operand)
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
+            return -v
+    return _not_a_constant
+
+
+def canonical_text(a: ast.AST) -> str:
+    'Return the text the fingerprint of `a` is computed from'
+    return _canonical_renderer().render(a)
+
+
+def ast_fingerprint(a: ast.AST) -> str:
+    'Return a hex digest of the ast that is stable between processes and ignores lambda argument names'
+    return hashlib.sha256(canonical_text(a).encode()).hexdigest()
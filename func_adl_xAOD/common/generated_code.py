@@ -1,7 +1,8 @@
 # Hold onto the generated code
-from typing import Union
+from contextlib import contextmanager
+from typing import Optional, Union, cast
 
-from func_adl_xAOD.common.statement import block
+from func_adl_xAOD.common.statement import block, loop
 from func_adl_xAOD.common.util_scope import gc_scope, gc_scope_top_level
 
 
@@ -10,25 +11,113 @@ class generated_code:
         self._block = block()
         self._book_block = block()
         self._class_vars = []
-        self._scope_stack = (self._block,)
+        self._class_vars_by_key = {}
+        self._root_scope = gc_scope(self._block)
+        self._scope = self._root_scope
         self._include_files = []
+        self._class_include_files = []
 
-    def declare_class_variable(self, var):
-        'Declare a variable as an instance of the query class. var must be a cpp_rep'
+    def declare_class_variable(self, var, key=None):
+        r'''
+        Declare a variable as an instance of the query class. var must be a cpp_rep. If `key` is
+        given, and a variable was already declared with the same key, that variable is returned
+        and `var` is not declared. Otherwise `var` is returned.
+        '''
+        if key is not None:
+            if key in self._class_vars_by_key:
+                return self._class_vars_by_key[key]
+            self._class_vars_by_key[key] = var
         self._class_vars += [var]
+        return var
 
     def declare_variable(self, v):
         'Declare a variable at the current scope'
-        self._scope_stack[-1].declare_variable(v)
+        self._scope.declare_variable(v)
 
     def get_rep(self, name):
         'Get a representation that has been defined on the stack'
-        items = (rep for rep in (s.get_rep(name) for s in reversed(self._scope_stack)) if rep is not None)
-        return next(items, None)
+        s = self._scope
+        while s is not None:
+            rep = s.block().get_rep(name)
+            if rep is not None:
+                return rep
+            s = s.parent()
+        return None
 
     def set_rep(self, name, value):
         'Set a representation for later recall'
-        self._scope_stack[-1].set_rep(name, value)
+        self._scope.block().set_rep(name, value)
+
+    def set_rep_at_insertion_point(self, name, value):
+        r'''
+        Like `set_rep`, but `value` is only good for code added after this point in the current
+        block (e.g. it is a variable that is set by the last statement). Look it up with
+        `get_rep_at_insertion_point`. Setting it again replaces the old value.
+        '''
+        b = self._scope.block()
+        after = b._statements[-1] if len(b._statements) > 0 else None
+        b._rep_dict[name] = (value, after)
+
+    def get_rep_at_insertion_point(self, name):
+        r'''
+        Get a representation set by `set_rep_at_insertion_point` in this scope or one
+        above it. Returns None if there is none, or if the nearest one was set after the
+        block we are in now was started - it is not good for code added here.
+        '''
+        s = self._scope
+        inner = None
+        while s is not None:
+            r = s.block().get_rep(name)
+            if r is not None:
+                value, after = r
+                if inner is None or after is None:
+                    return value
+                return value if _index_of(s.block(), inner.block()) > _index_of(s.block(), after) else None
+            inner = s
+            s = s.parent()
+        return None
+
+    def is_in_loop_below(self, scope_info: Union[gc_scope, gc_scope_top_level]) -> bool:
+        'True if the current scope is inside a loop that `scope_info`, which contains it, is outside of'
+        target = self._root_scope if scope_info.is_top_level() else scope_info
+        in_loop = False
+        s: Optional[gc_scope] = self._scope
+        while s is not None and s is not target:
+            in_loop = in_loop or isinstance(s.block(), loop)
+            s = s.parent()
+        return in_loop and s is not None
+
+    @contextmanager
+    def hoisted(self, scope_info: Union[gc_scope, gc_scope_top_level]):
+        r'''
+        Add code to an outer scope, ahead of the current point of insertion. In the `with` block
+        `scope_info`, which must contain the current scope, is the current scope. The statements
+        added to it are moved up to just before the block we are in now, so they run before it. The
+        current scope is restored afterwards.
+        '''
+        current = self._scope
+        target = self._root_scope if scope_info.is_top_level() else cast(gc_scope, scope_info)
+
+        # The block in the target scope that we are in now
+        inner = None
+        s: Optional[gc_scope] = current
+        while s is not None and s is not target:
+            inner, s = s, s.parent()
+        if s is None:
+            raise Exception("Internal Error: Can only hoist code to a scope that contains the current one.")
+
+        b = target.block()
+        n_statements = len(b._statements)
+        self._scope = target
+        try:
+            yield
+        finally:
+            self._scope = current
+            if inner is not None:
+                added = b._statements[n_statements:]
+                del b._statements[n_statements:]
+                index = _index_of(b, inner.block())
+                b._statements[index:index] = added
 
     def add_statement(self, st, below=None):
         '''
@@ -42,9 +131,9 @@ class generated_code:
                 current point of insertion is not affected.
         '''
         if below is None:
-            self._scope_stack[-1].add_statement(st)
+            self._scope.block().add_statement(st)
             if isinstance(st, block):
-                self._scope_stack = self._scope_stack + (st,)
+                self._scope = self._scope.child(st)
         else:
             if not isinstance(below, block):
                 raise Exception("Internal Error: Can't a statement below a statement that isn't a scoping block.")
@@ -61,12 +150,20 @@ class generated_code:
     def include_files(self):
         return self._include_files
 
+    def add_class_include(self, path):
+        'Add an include file needed by the class declaration'
+        if path not in self._class_include_files:
+            self._class_include_files += [path]
+
+    def class_include_files(self):
+        return self._class_include_files
+
     def pop_scope(self):
-        self._scope_stack = self._scope_stack[:-1]
+        self._scope = self._scope.parent()
 
     def current_scope(self):
         'Return a token that can be later used to set the scoping'
-        return gc_scope(self._scope_stack)
+        return self._scope
 
     def set_scope(self, scope_info: Union[gc_scope, gc_scope_top_level]):
         'Set the scope to a previously cached value'
@@ -74,12 +171,12 @@ class generated_code:
             raise Exception("Scope can't be set to null")
         if scope_info.is_top_level():
             # Special case this guy as it is a unicorn.
-            self._scope_stack = self._scope_stack[:1]
+            self._scope = self._root_scope
             return
 
         # Restore it to whatever it was.
         assert isinstance(scope_info, gc_scope)
-        self._scope_stack = scope_info._scope_stack  # type: ignore
+        self._scope = scope_info
 
     def add_book_statement(self, st, below=None):
         self._book_block.add_statement(st)
@@ -96,6 +193,14 @@ class generated_code:
         'Return the class variable decls'
         s = []
         for v in self._class_vars:
-            s += ["{0} {1};\n".format(v.cpp_type(), v.as_cpp())]
+            if v.initial_value() is None:
+                s += ["{0} {1};\n".format(v.cpp_type(), v.as_cpp())]
+            else:
+                s += ["{0} {1}{{{2}}};\n".format(v.cpp_type(), v.as_cpp(), v.initial_value().as_cpp())]
 
         return s
+
+
+def _index_of(b: block, st) -> int:
+    'Index of the statement `st` in block `b`'
+    return next(i for i, s in enumerate(b._statements) if s is st)
@@ -1,43 +1,127 @@
 # Some math utilities
+#
+# The kinematic functions are implemented in `func_adl_kinematics.h`, a header that ships with each
+# backend's templates. The generated code just calls them.
+import ast
+from collections import Counter
+from functools import partial
+from typing import Dict, List, cast
+
 import func_adl_xAOD.common.cpp_ast as cpp_ast
-from func_adl_xAOD.common.cpp_representation import cpp_variable
-from func_adl_xAOD.common.cpp_vars import unique_name
+from func_adl_xAOD.common.fingerprint import canonical_text
+
+# The header, in the template directories, that holds the C++ for the kinematic functions.
+kinematics_header = 'func_adl_kinematics.h'
 
 
-def DeltaRAst(call_node):
+def _kinematics_call(name: str, arg_names: List[str], result_name: str, call_node):
     r'''
-    User is trying to call DeltaR (eta1, phi1, eta2, phi2). We turn this into a call
-    into a call into ROOT that does the phi subtraction (I can never get that crap right).
+    Turn a call to `name` into a call into the kinematics header. The call must have
+    one argument for each of `arg_names`.
     '''
+    if len(call_node.args) != len(arg_names):
+        raise ValueError(f"Calling {name}({', '.join(arg_names)}) has incorrect number of arguments")
 
-    if len(call_node.args) != 4:
-        raise ValueError("Calling DeltaR(eta1, phi1, eta2, phi2) has incorrect number of arguments")
-
-    # Create an AST to hold onto all of this.
     r = cpp_ast.CPPCodeValue()
-    # We need TVector2 included here
-    r.include_files += ['TVector2.h', 'math.h']
-
-    # We need all four arguments pushed through.
-    r.args = ['eta1', 'phi1', 'eta2', 'phi2']
-
-    # The code is three steps
-    r.running_code += ['auto d_eta = eta1 - eta2;']
-    r.running_code += ['auto d_phi = TVector2::Phi_mpi_pi(phi1-phi2);']
-    r.running_code += ['auto result = sqrt(d_eta*d_eta + d_phi*d_phi);']
+    r.include_files += [kinematics_header]
+    r.args = arg_names
+    r.running_code += [f"auto result = func_adl::{name}({', '.join(arg_names)});"]
     r.result = 'result'
-    r.result_rep = lambda scope: cpp_variable(unique_name('delta_r'), scope=scope, cpp_type='double')
+    r.result_rep = partial(cpp_ast.variable_result_rep, result_name, 'double')
 
     call_node.func = r
     return call_node
 
 
+DeltaRAst = partial(_kinematics_call, 'DeltaR', ['eta1', 'phi1', 'eta2', 'phi2'], 'delta_r')
+DeltaR2Ast = partial(_kinematics_call, 'DeltaR2', ['eta1', 'phi1', 'eta2', 'phi2'], 'delta_r2')
+DeltaPhiAst = partial(_kinematics_call, 'DeltaPhi', ['phi1', 'phi2'], 'delta_phi')
+InvariantMassAst = partial(_kinematics_call, 'InvariantMass',
+                           ['pt1', 'eta1', 'phi1', 'm1', 'pt2', 'eta2', 'phi2', 'm2'], 'inv_mass')
+
+
 def DeltaR(eta1, phi1, eta2, phi2):
     'Calculate the DeltaR between two eta,phi specified vectors'
     raise NotImplementedError('DeltaR should never be called in python!')
 
 
+def DeltaR2(eta1, phi1, eta2, phi2):
+    'Calculate the square of the DeltaR between two eta,phi specified vectors'
+    raise NotImplementedError('DeltaR2 should never be called in python!')
+
+
+def DeltaPhi(phi1, phi2):
+    'Calculate phi1 - phi2, wrapped into the range -pi to pi'
+    raise NotImplementedError('DeltaPhi should never be called in python!')
+
+
+def InvariantMass(pt1, eta1, phi1, m1, pt2, eta2, phi2, m2):
+    'Calculate the invariant mass of two (pt, eta, phi, m) specified vectors'
+    raise NotImplementedError('InvariantMass should never be called in python!')
+
+
+_ordering_operators = (ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+
+
+def _is_deltar(node: ast.AST) -> bool:
+    return isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'DeltaR' \
+        and len(node.args) == 4 and len(node.keywords) == 0
+
+
+def _is_distance(node: ast.AST) -> bool:
+    'A constant that `DeltaR` can be compared to by its square'
+    return isinstance(node, ast.Constant) and type(node.value) in (int, float) and node.value >= 0
+
+
+def _is_squarable(node: ast.Compare) -> bool:
+    'True if `node` orders `DeltaR` calls and non-negative constants, so it can compare their squares'
+    operands = [node.left] + node.comparators
+    return all(isinstance(op, _ordering_operators) for op in node.ops) \
+        and all(_is_deltar(v) or _is_distance(v) for v in operands) \
+        and any(_is_deltar(v) for v in operands)
+
+
+def _squared(node: ast.AST) -> ast.AST:
+    if _is_deltar(node):
+        call = cast(ast.Call, node)
+        return ast.copy_location(ast.Call(func=ast.Name(id='DeltaR2', ctx=ast.Load()), args=call.args, keywords=[]), node)
+    # Round off the last bits, so `0.4` becomes `0.16`, not `0.16000000000000003`, in the C++.
+    value = cast(ast.Constant, node).value
+    square = value * value if type(value) is int else float(f'{value * value:.15g}')
+    return ast.copy_location(ast.Constant(value=square, kind=None), node)
+
+
+def square_deltar_comparisons(a: ast.AST) -> ast.AST:
+    r'''
+    Rewrite comparisons of `DeltaR` to a constant, like `DeltaR(eta1, phi1, eta2, phi2) < 0.4`,
+    to compare the squares instead: `DeltaR2(eta1, phi1, eta2, phi2) < 0.16`. This saves a `sqrt`
+    for each test, and the test is often in a loop over pairs of objects. Returns `a`.
+
+    A `DeltaR` whose value is also used elsewhere in the query is left alone, as the C++ for it is
+    only run once (see `cse`), and the comparison then costs nothing extra. Run this after
+    `fold_constants` and before `cpp_ast_finder`.
+    '''
+    comparisons = [n for n in ast.walk(a) if isinstance(n, ast.Compare) and _is_squarable(n)]
+
+    # The DeltaR calls whose every use is in one of the comparisons
+    uses = Counter(canonical_text(n) for n in ast.walk(a) if _is_deltar(n))
+    compared = Counter(canonical_text(v) for c in comparisons for v in [c.left] + c.comparators if _is_deltar(v))
+    only_compared = {text for text, count in compared.items() if uses[text] == count}
+
+    # A shared node is found once for each place it appears, but must only be rewritten once.
+    unique: Dict[int, ast.Compare] = {id(c): c for c in comparisons}
+    for c in unique.values():
+        operands = [c.left] + c.comparators
+        if all(canonical_text(v) in only_compared for v in operands if _is_deltar(v)):
+            c.left = _squared(c.left)
+            c.comparators = [_squared(v) for v in c.comparators]
+    return a
+
+
 def get_math_methods():
     return {
-        'DeltaR': DeltaRAst
+        'DeltaR': DeltaRAst,
+        'DeltaR2': DeltaR2Ast,
+        'DeltaPhi': DeltaPhiAst,
+        'InvariantMass': InvariantMassAst,
     }
@@ -0,0 +1,58 @@
+# Options for how the output TTree is written.
+#
+# ROOT's defaults are not always the right trade off: LZ4 reads much faster than ZLIB, and ZSTD
+# makes smaller files, for example. These are set on the executor, and end up in the C++ that
+# books the tree.
+from typing import Optional
+
+
+# ROOT's compression algorithm numbers, and the level ROOT recommends for each.
+_compression_algorithms = {
+    'zlib': (1, 1),
+    'lzma': (2, 7),
+    'lz4': (4, 4),
+    'zstd': (5, 5),
+}
+
+
+class ttree_output_options:
+    r'''
+    How the output TTree is written. Anything left as None keeps ROOT's default.
+
+    compression:    The compression algorithm for the branches: 'zlib', 'lzma', 'lz4', or 'zstd'.
+    level:          The compression level, 0 (none) to 9. Defaults to ROOT's recommendation for
+                    the algorithm. Only used with `compression`.
+    basket_size:    The size, in bytes, of each branch's buffer.
+    auto_flush:     Passed to `TTree::SetAutoFlush`: a positive number of entries, or a negative
+                    number of bytes, per cluster.
+    float_branches: Write double values as float. Halves the size of those branches, at the
+                    cost of precision few physics quantities have.
+    '''
+
+    def __init__(self, compression: Optional[str] = None, level: Optional[int] = None,
+                 basket_size: Optional[int] = None, auto_flush: Optional[int] = None,
+                 float_branches: bool = False):
+        if compression is not None and compression not in _compression_algorithms:
+            raise ValueError(f"Unknown compression algorithm '{compression}'. Known ones are {', '.join(_compression_algorithms)}.")
+        if level is not None and compression is None:
+            raise ValueError('A compression level needs a compression algorithm.')
+        if level is not None and not (0 <= level <= 9):
+            raise ValueError(f'The compression level must be from 0 to 9, not {level}.')
+        if basket_size is not None and basket_size <= 0:
+            raise ValueError(f'The basket size must be positive, not {basket_size}.')
+        self.compression = compression
+        self.level = level
+        self.basket_size = basket_size
+        self.auto_flush = auto_flush
+        self.float_branches = float_branches
+
+    def compression_settings(self) -> Optional[int]:
+        'The number to hand to `SetCompressionSettings`, or None to leave the compression alone'
+        if self.compression is None:
+            return None
+        algorithm, default_level = _compression_algorithms[self.compression]
+        return algorithm * 100 + (self.level if self.level is not None else default_level)
+
+    def __repr__(self):
+        return f'ttree_output_options(compression={self.compression!r}, level={self.level!r}, ' \
+            f'basket_size={self.basket_size!r}, auto_flush={self.auto_flush!r}, float_branches={self.float_branches!r})'
@@ -0,0 +1,128 @@
+# Reorder the tests in a filter so the cheap ones run first.
+#
+# The C++ for `a and b` short-circuits, but in the order the query was written. Something like
+# `Where(lambda j: DeltaR(...) < 0.4 and j.pt() > 30000)` does the expensive test for every jet,
+# even for the ones the cheap `pt` test would have thrown away. This pass gives each operand of
+# an `and` a rough, static, cost, and sorts them from cheapest to most expensive.
+#
+# It is opt-in (see the `reorder_predicates` argument of `executor`), because it changes the
+# order the user asked for. An operand is only moved if it can be evaluated safely whatever the
+# other operands say: anything that looks like it could be guarded by an earlier test (`First`,
+# an index, a division by something other than a constant) stays where it is, and the operands
+# on either side of it are only sorted amongst themselves.
+import ast
+from typing import List
+
+from func_adl_xAOD.common.cpp_ast import CPPCodeValue
+from func_adl_xAOD.common.cpp_functions import FunctionAST
+
+# Rough relative costs. Only their order matters.
+_operator_cost = 1
+_function_cost = 5
+_member_call_cost = 10
+_cpp_code_cost = 20
+
+# A nested sequence is a loop. Guess at how many items it runs over.
+_sequence_length = 10
+
+# Sequence operators that might not be able to produce a value.
+_unsafe_sequence_operators = ['First', 'ElementAt']
+
+
+def expression_cost(node: ast.AST) -> int:
+    r'''
+    Return a rough estimate of the cost of evaluating `node` once in C++. Run this after the
+    `find_known_functions` and `cpp_ast_finder` passes, so C++ functions and code can be
+    told apart from member calls.
+    '''
+    if isinstance(node, ast.Lambda):
+        return expression_cost(node.body)
+
+    if isinstance(node, ast.Call):
+        args_cost = sum(expression_cost(a) for a in node.args)
+        if isinstance(node.func, CPPCodeValue):
+            return _cpp_code_cost + args_cost
+        if isinstance(node.func, FunctionAST):
+            return _function_cost + args_cost
+        if isinstance(node.func, ast.Attribute):
+            return _member_call_cost + expression_cost(node.func.value) + args_cost
+        if isinstance(node.func, ast.Name) and len(node.args) > 0:
+            # A sequence operator: a loop over the source, fetching each item and running any
+            # lambdas on it.
+            per_item = sum(expression_cost(a) for a in node.args[1:])
+            return expression_cost(node.args[0]) + _sequence_length * (_member_call_cost + per_item)
+        return _member_call_cost + args_cost
+
+    return sum((expression_cost(c) for c in ast.iter_child_nodes(node)),
+               _operator_cost if isinstance(node, (ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare)) else 0)
+
+
+def _is_nonzero_constant(node: ast.AST) -> bool:
+    return isinstance(node, ast.Constant) and type(node.value) in (int, float) and node.value != 0
+
+
+def is_movable(node: ast.AST) -> bool:
+    'True if `node` can be evaluated no matter what the tests around it found'
+    for n in ast.walk(node):
+        if isinstance(n, ast.Subscript):
+            return False
+        if isinstance(n, ast.BinOp) and isinstance(n.op, (ast.Div, ast.Mod)) \
+                and not _is_nonzero_constant(n.right):
+            return False
+        if isinstance(n, ast.Call) and isinstance(n.func, ast.Name) and n.func.id in _unsafe_sequence_operators:
+            return False
+    return True
+
+
+def _sorted_by_cost(values: List[ast.AST]) -> List[ast.AST]:
+    'Sort the movable runs in `values` by cost. Operands that are not movable stay put.'
+    result: List[ast.AST] = []
+    run: List[ast.AST] = []
+    for v in values:
+        if is_movable(v):
+            run.append(v)
+        else:
+            result += sorted(run, key=expression_cost) + [v]
+            run = []
+    return result + sorted(run, key=expression_cost)
+
+
+class reorder_conjuncts(ast.NodeTransformer):
+    r'''
+    Sort the operands of each `and`, and each pair of consecutive `Where` calls, from cheapest
+    to most expensive. The sort is stable, so operands of equal cost keep their order.
+    '''
+
+    def visit_BoolOp(self, node: ast.BoolOp):
+        self.generic_visit(node)
+        if not isinstance(node.op, ast.And):
+            return node
+
+        # `a and (b and c)` is one list of tests.
+        values: List[ast.AST] = []
+        for v in node.values:
+            if isinstance(v, ast.BoolOp) and isinstance(v.op, ast.And):
+                values += v.values
+            else:
+                values.append(v)
+        node.values = _sorted_by_cost(values)
+        return node
+
+    def visit_Call(self, node: ast.Call):
+        self.generic_visit(node)
+
+        # Where(Where(seq, f), g) => Where(Where(seq, g), f) if g is the cheaper test.
+        if _is_where(node) and _is_where(node.args[0]):
+            inner = node.args[0]
+            outer_filter = node.args[1]
+            inner_filter = inner.args[1]
+            if is_movable(outer_filter) and is_movable(inner_filter) \
+                    and expression_cost(outer_filter) < expression_cost(inner_filter):
+                inner.args[1] = outer_filter
+                node.args[1] = inner_filter
+        return node
+
+
+def _is_where(node: ast.AST) -> bool:
+    return isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'Where' \
+        and len(node.args) == 2
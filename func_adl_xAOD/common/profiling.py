@@ -0,0 +1,67 @@
+# Opt-in timing of the phases of a translation.
+#
+# Attach a `translation_profiler` with `executor.profile()`. Each phase of the translation
+# (transform, visit, emit, render, write), and each `call_*` handler the visitor dispatches
+# to, is then timed and reported.
+import sys
+import time
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, List, Optional
+
+# One timed phase or handler invocation.
+#   name                Phase name (`transform`, `visit`, ...) or visitor handler (`call_Select`, `process_ast_node`, ...)
+#   wall_time           Elapsed wall clock time, in seconds
+#   cpu_time            CPU time used by the process, in seconds
+#   allocated_blocks    Change in the number of memory blocks python has allocated
+profile_record = namedtuple('profile_record', 'name wall_time cpu_time allocated_blocks')
+
+
+class translation_profiler:
+    r'''
+    Collects a `profile_record` for each phase. If a callback is given it is called with each
+    record as soon as the phase is done (e.g. to feed a metrics system).
+
+    Visitor handlers nest (a `call_Select` will usually visit a `call_Where` below it), so their
+    times are inclusive of any handlers they call.
+    '''
+
+    def __init__(self, callback: Optional[Callable[[profile_record], None]] = None):
+        self._callback = callback
+        self.records: List[profile_record] = []
+
+    @contextmanager
+    def phase(self, name: str):
+        'Time the code in the `with` block as phase `name`'
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        blocks_start = sys.getallocatedblocks()
+        try:
+            yield
+        finally:
+            record = profile_record(name,
+                                    time.perf_counter() - wall_start,
+                                    time.process_time() - cpu_start,
+                                    sys.getallocatedblocks() - blocks_start)
+            self.records.append(record)
+            if self._callback is not None:
+                self._callback(record)
+
+    def totals(self) -> Dict[str, profile_record]:
+        'Sum the records by name'
+        result: Dict[str, profile_record] = {}
+        for r in self.records:
+            old = result.get(r.name)
+            if old is None:
+                result[r.name] = r
+            else:
+                result[r.name] = profile_record(r.name,
+                                                old.wall_time + r.wall_time,
+                                                old.cpu_time + r.cpu_time,
+                                                old.allocated_blocks + r.allocated_blocks)
+        return result
+
+
+def profile_phase(profiler: Optional[translation_profiler], name: str):
+    'Time phase `name` with `profiler` - or do nothing if there is no profiler'
+    return nullcontext() if profiler is None else profiler.phase(name)
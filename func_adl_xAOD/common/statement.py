@@ -1,8 +1,9 @@
 # Statements
 from abc import ABC, abstractmethod  # For declaring abstract base class
-from typing import Any
+from typing import Any, Optional
 
 import func_adl_xAOD.common.cpp_representation as crep
+from func_adl_xAOD.common.output_options import ttree_output_options
 
 
 class BlockException (Exception):
@@ -32,10 +33,14 @@ class block:
         for v in self._variables:
             init_value = "" if not isinstance(v, crep.cpp_variable) or not v.initial_value() else " ({0})".format(v.initial_value().as_cpp())
             e.add_line("{0} {1}{2};".format(v.cpp_type(), v.as_cpp(), init_value))
-        for s in self._statements:
+        for s in self._statements_to_emit():
             s.emit(e)
         e.add_line("}")
 
+    def _statements_to_emit(self):
+        'The statements in the block, in the order they are to be emitted'
+        return self._statements
+
     def get_rep(self, name: Any) -> Any:
         '''Return the representation for some object. If we do not know its value
         then ask our parent for the value. Return None if we can't find it.
@@ -80,6 +85,10 @@ class loop(block):
         self._is_loop_var_a_pointer = is_loop_var_a_pntr
         self._is_loop_var_a_reference = is_loop_var_a_ref
 
+    def collection(self) -> Optional[crep.cpp_collection]:
+        'The collection the loop runs over, or None if it is not over a collection'
+        return self._collection
+
     def emit(self, e):
         'Emit a for loop enclosed by a block of code'
         e.add_line("for (auto {0}{1} : {2})".format(
@@ -89,17 +98,44 @@ class loop(block):
         block.emit(self, e)
 
 
+class range_loop(loop):
+    'A for loop that counts from begin up to (but not including) end'
+
+    def __init__(self, loop_var_rep: crep.cpp_value, begin_rep: crep.cpp_value, end_rep: crep.cpp_value):
+        r'''
+        loop_var_rep: The integer loop variable, declared by the loop
+        begin_rep, end_rep: The first value, and the value to stop before
+        '''
+        loop.__init__(self, loop_var_rep, None)  # type: ignore
+        self._begin = begin_rep
+        self._end = end_rep
+
+    def emit(self, e):
+        'Emit a counting for loop enclosed by a block of code'
+        v = self._loop_variable.as_cpp()
+        e.add_line(f"for (int {v} = {self._begin.as_cpp()}; {v} < {self._end.as_cpp()}; {v}++)")
+        block.emit(self, e)
+
+
 class iftest(block):
     'An if statement'
 
-    def __init__(self, if_expr):
+    def __init__(self, if_expr, break_after: bool = False):
+        r'''
+        if_expr: The test
+        break_after: Once the code in the if statement has run, break out of the enclosing loop
+        '''
         block.__init__(self)
         self._expr = if_expr
+        self._break_after = break_after
 
     def emit(self, e):
         e.add_line('if ({0})'.format(self._expr.as_cpp()))
         block.emit(self, e)
 
+    def _statements_to_emit(self):
+        return self._statements + [break_loop()] if self._break_after else self._statements
+
 
 class elsephrase(block):
     'An else statement. Must come after you pop and if statement off'
@@ -117,9 +153,10 @@ class elsephrase(block):
 class book_ttree(ABC):
     'Book a TTree for writing out. Meant to be in the Book method'
 
-    def __init__(self, tree_name, leaves):
+    def __init__(self, tree_name, leaves, options: Optional[ttree_output_options] = None):
         self._tree_name = tree_name
         self._leaves = leaves
+        self._options = options if options is not None else ttree_output_options()
 
     @abstractmethod
     def emit(self, e):
@@ -127,6 +164,16 @@ class book_ttree(ABC):
         # implemented before being used
         pass
 
+    def emit_branches(self, e, tree: str):
+        'Emit the branches of the tree, called `tree` in the C++, and apply the output options'
+        basket_size = f', {self._options.basket_size}' if self._options.basket_size is not None else ''
+        compression = self._options.compression_settings()
+        set_compression = f'->SetCompressionSettings({compression})' if compression is not None else ''
+        for var_pair in self._leaves:
+            e.add_line(f'{tree}->Branch("{var_pair[0]}", &{var_pair[1].as_cpp()}{basket_size}){set_compression};')
+        if self._options.auto_flush is not None:
+            e.add_line(f'{tree}->SetAutoFlush({self._options.auto_flush});')
+
 
 class ttree_fill(ABC):
     'Fill a TTree'
@@ -180,6 +227,31 @@ class container_clear:
         e.add_line('{0}.clear();'.format(self._collection.as_cpp()))
 
 
+class container_reserve:
+    'reserve room in a vector for the items of another collection'
+
+    def __init__(self, collection, source_collection):
+        r'''
+        collection: the vector to reserve room in
+        source_collection: the collection whose size is reserved
+        '''
+        self._collection = collection
+        self._source = source_collection
+
+    def emit(self, e):
+        source = self._source.as_cpp()
+        if source.startswith('*'):
+            source = f'({source})'
+        e.add_line(f'{self._collection.as_cpp()}.reserve({source}.size());')
+
+
+class break_loop:
+    'Leave the enclosing loop'
+
+    def emit(self, e):
+        e.add_line('break;')
+
+
 class arbitrary_statement:
     'An arbitrary line of C++ code. Avoid if possible, as it makes analysis impossible'
 
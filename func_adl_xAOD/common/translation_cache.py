@@ -0,0 +1,134 @@
+# A disk cache of rendered C++ bundles, keyed by a hash of the (transformed) query ast.
+#
+# Translation (visiting the ast and rendering the templates) is pure: the same query on the same
+# backend and package version always produces the same set of files. So we can store those files
+# and copy them back out the next time the query arrives.
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+_metadata_file_name = 'translation.json'
+
+
+def _installed_version() -> Optional[str]:
+    'The version of the installed distribution of this package, or None if it can not be found'
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+    except ImportError:
+        try:
+            from importlib_metadata import PackageNotFoundError, version  # type: ignore
+        except ImportError:
+            version = None  # type: ignore
+    if version is not None:
+        try:
+            return version('func_adl_xAOD')
+        except PackageNotFoundError:
+            return None
+
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('func_adl_xAOD').version
+    except Exception:
+        return None
+
+
+def _source_hash() -> str:
+    'A hash of the files (python source and templates) of this package'
+    package_dir = Path(__file__).resolve().parent.parent
+    h = hashlib.sha256()
+    for f in sorted(p for p in package_dir.rglob('*') if p.is_file() and '__pycache__' not in p.parts):
+        h.update(str(f.relative_to(package_dir)).encode())
+        h.update(b'\0')
+        h.update(f.read_bytes())
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def package_version() -> str:
+    r'''
+    Return the installed version of this package. If the version can not be found, return a
+    hash of the package's files instead, so the C++ cached from another copy of the package is
+    never re-used.
+    '''
+    v = _installed_version()
+    return v if v is not None else f'source-{_source_hash()}'
+
+
+class translation_cache:
+    r'''
+    A directory of previously rendered C++ bundles. Each entry is a sub-directory named
+    by its key, holding the rendered files and a small json metadata file. The metadata file's
+    modification time is bumped on every hit and serves as the LRU clock. When the total size of
+    the cache grows past `max_size` bytes the least recently used entries are removed.
+    '''
+
+    def __init__(self, cache_dir: Path, max_size: int = 100 * 1024 * 1024):
+        self._cache_dir = Path(cache_dir)
+        self._max_size = max_size
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def lookup(self, key: str, output_path: Path) -> Optional[Dict[str, Any]]:
+        r'''
+        Look for a bundle with key `key`. If found, copy its files into `output_path`
+        and return the metadata stored with it. Otherwise return None.
+        '''
+        entry = self._cache_dir / key
+        metadata_file = entry / _metadata_file_name
+        try:
+            metadata = json.loads(metadata_file.read_text())
+            for file_name in metadata['files']:
+                shutil.copy(entry / file_name, output_path / file_name)
+            os.utime(metadata_file)
+        except (OSError, ValueError, KeyError):
+            # Missing, half-written, or evicted from under us - all just a miss.
+            return None
+        return metadata
+
+    def store(self, key: str, source_path: Path, file_names: List[str], metadata: Dict[str, Any]):
+        r'''
+        Save the files `file_names` found in `source_path` under `key`, along with `metadata`
+        (which must be json serializable). The entry is built in a temporary directory and
+        renamed into place, so a concurrent `lookup` never sees a partial bundle.
+        '''
+        entry = self._cache_dir / key
+        if entry.exists():
+            return
+
+        tmp_dir = Path(tempfile.mkdtemp(dir=self._cache_dir, prefix='.tmp-'))
+        try:
+            for file_name in file_names:
+                shutil.copy(source_path / file_name, tmp_dir / file_name)
+            (tmp_dir / _metadata_file_name).write_text(json.dumps(dict(metadata, files=file_names)))
+            os.rename(tmp_dir, entry)
+        except OSError:
+            # Someone else stored the same key first.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        self._evict()
+
+    def _evict(self):
+        'Remove least recently used entries until we are under the size limit'
+        entries = []
+        total = 0
+        for entry in self._cache_dir.iterdir():
+            if entry.name.startswith('.'):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in entry.iterdir())
+                last_used = (entry / _metadata_file_name).stat().st_mtime
+            except OSError:
+                continue
+            entries.append((last_used, size, entry))
+            total += size
+
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total <= self._max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
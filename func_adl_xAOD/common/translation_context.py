@@ -0,0 +1,78 @@
+# State that belongs to a single translation of a query into C++.
+#
+# The variable counter, and any method return types or function mappings that are only
+# good for one query, live here rather than in module globals. That way many queries can
+# be translated at once (on a thread pool, for example) without stepping on each other,
+# and each one numbers its variables from zero.
+import contextvars
+from collections import ChainMap
+from typing import Any, Dict, List, Optional
+
+import func_adl_xAOD.common.cpp_functions as cpp_functions
+import func_adl_xAOD.common.cpp_types as ctyp
+from func_adl_xAOD.common.profiling import translation_profiler
+from func_adl_xAOD.common.output_options import ttree_output_options
+
+
+class TranslationContext:
+    r'''
+    Holds the mutable state for one translation.
+
+    - A counter for unique variable names.
+    - Method return types. Look ups go to the types added to this context first, and then to
+      the process wide defaults registered with `cpp_types.add_method_type_info`.
+    - Python to C++ function mappings, layered the same way over `cpp_functions.functions_to_replace`.
+    - An optional profiler, which times the visitor's handlers.
+    - Optional `ttree_output_options`, for the compression and buffering of the output TTree.
+    - Whether to use precise types: keep float calculations in float, rather than promoting
+      them to double as C++ does for a double literal.
+
+    Activate it with a `with` statement. Code that asks for `current_context()` (including
+    `cpp_vars.unique_name`) will then get this context, on this thread only.
+    '''
+
+    def __init__(self, profiler: Optional[translation_profiler] = None,
+                 output_options: Optional[ttree_output_options] = None,
+                 precise_types: bool = False):
+        self.profiler = profiler
+        self.output_options = output_options
+        self.precise_types = precise_types
+        self._var_index = 0
+        self._method_types: Dict[str, Dict[str, Any]] = {}
+        self.functions = ChainMap({}, cpp_functions.functions_to_replace)
+        self._tokens: List[contextvars.Token] = []
+
+    def unique_name(self, name: str, is_class_var: bool = False) -> str:
+        'Return a new, numbered, C++ variable name. See `cpp_vars.unique_name`.'
+        v_name = ("_" if is_class_var else "") + name + str(self._var_index)
+        self._var_index += 1
+        return v_name
+
+    def add_method_type_info(self, type_string: str, method_name: str, t):
+        'Define the return type of a method for this translation only'
+        self._method_types.setdefault(type_string, {})[method_name] = t
+
+    def method_type_info(self, type_string: str, method_name: str):
+        'Return the type of the method, or None if it is not known'
+        t = self._method_types.get(type_string, {}).get(method_name)
+        if t is not None:
+            return t
+        return ctyp.method_type_info(type_string, method_name)
+
+    def __enter__(self):
+        self._tokens.append(_current_context.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_context.reset(self._tokens.pop())
+
+
+# Used when no context has been activated - this behaves like the old globals did.
+_default_context = TranslationContext()
+_current_context: contextvars.ContextVar[TranslationContext] = \
+    contextvars.ContextVar('func_adl_xAOD_translation_context', default=_default_context)
+
+
+def current_context(context: Optional[TranslationContext] = None) -> TranslationContext:
+    'Return `context` if given, otherwise the active translation context'
+    return context if context is not None else _current_context.get()
@@ -1,7 +1,7 @@
 # Scope related utilities
 # see https://stackoverflow.com/questions/33533148/how-do-i-specify-that-the-return-type-of-a-method-is-the-same-as-the-class-itsel
 # for info on this next line. Already looking forward to python 4...
-import copy
+from typing import Dict, Optional
 
 
 def top_level_scope():
@@ -12,9 +12,46 @@ def top_level_scope():
 
 
 class gc_scope:
-    'Internal class to track the scope of a statement or variable.'
-    def __init__(self, scope_stack):
-        self._scope_stack = copy.copy(scope_stack)
+    r'''
+    Internal class to track the scope of a statement or variable.
+
+    A scope is a block plus the scope it sits in (its parent). Scopes are interned: asking a
+    scope for the `child` scope of a block always returns the same object. So two scopes are the
+    same exactly when they are the same object, and an ancestry check is a walk up the parent
+    links by the difference in depth - no copying of scope stacks.
+    '''
+    def __init__(self, block, parent: Optional['gc_scope'] = None):
+        self._block = block
+        self._parent = parent
+        self._depth = 0 if parent is None else parent._depth + 1
+        self._children: Dict[int, 'gc_scope'] = {}
+
+    def child(self, block) -> 'gc_scope':
+        'Return the scope for `block` sitting inside this scope'
+        c = self._children.get(id(block))
+        if c is None:
+            c = gc_scope(block, self)
+            self._children[id(block)] = c
+        return c
+
+    def block(self):
+        'The block of statements for this scope'
+        return self._block
+
+    def parent(self) -> Optional['gc_scope']:
+        'The scope this one sits in, or None for the outer most scope'
+        return self._parent
+
+    def depth(self) -> int:
+        'Number of scopes above this one'
+        return self._depth
+
+    def _up(self, n: int) -> 'gc_scope':
+        'Return the scope n levels up'
+        s = self
+        for _ in range(n):
+            s = s._parent  # type: ignore
+        return s
 
     def __getitem__(self, key: int):
         '''
@@ -22,34 +59,36 @@ class gc_scope:
         array slicing in python. If you do 0 you'll get back the top level. If you do -1
         you will get back everything but the last thing. -2 last two things, etc.
         '''
-        if len(self._scope_stack[:key]) == 0:
+        length = self._depth + 1
+        new_length = len(range(length)[:key])
+        if new_length == 0:
             raise RuntimeError("Winding up at the top level scope is not yet supported")
 
-        return gc_scope(self._scope_stack[:key])
+        return self._up(length - new_length)
 
     def frame_statements(self, key):
         'Return the nth frame block. -1 means the last one, 0 means the deepest (top) one.'
-        return self._scope_stack[key]
+        length = self._depth + 1
+        index = range(length)[key]
+        return self._up(length - 1 - index)._block
 
     def declare_variable(self, var) -> None:
         'Declare a class at the scope level'
-        self._scope_stack[-1].declare_variable(var)
+        self._block.declare_variable(var)
 
     def starts_with(self, c):
         '''
         Return true if the scope c matches the first part of our scope. False otherwise.
         '''
-        if c.is_top_level() and self.is_top_level():
-            return True
         if c.is_top_level():
             return True
         if self.is_top_level():
             return False
 
-        if len(c._scope_stack) > len(self._scope_stack):
+        if c._depth > self._depth:
             return False
 
-        return all([a is b for a, b in zip(self._scope_stack, c._scope_stack[:len(self._scope_stack)])])
+        return self._up(self._depth - c._depth) is c
 
     def is_top_level(self):
         return False
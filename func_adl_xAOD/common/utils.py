@@ -3,6 +3,7 @@ from typing import Dict, List
 import func_adl_xAOD.common.cpp_types as ctyp
 
 _type_priority: Dict[str, int] = {
+    'bool': 0,
     'int': 0,
     'float': 1,
     'double': 2,
@@ -12,6 +13,7 @@ _type_priority: Dict[str, int] = {
 def most_accurate_type(type_list: List[ctyp.terminal]) -> ctyp.terminal:
     '''
     Return the best type we can for most accurate sum. So if one is floating or double, return that.
+    A bool is counted as an int, as C++ does in arithmetic.
 
     We only deal with terminals we know about.
     '''
@@ -20,4 +22,4 @@ def most_accurate_type(type_list: List[ctyp.terminal]) -> ctyp.terminal:
         f'Not all types ({", ".join(t.type for t in type_list)}) are known (known: {", ".join(_type_priority.keys())})'
 
     ordered = sorted(type_list, key=lambda t: _type_priority[t.type], reverse=True)
-    return ordered[0]
+    return ordered[0] if ordered[0].type != 'bool' else ctyp.terminal('int', False)
@@ -0,0 +1,48 @@
+#ifndef func_adl_kinematics_H
+#define func_adl_kinematics_H
+
+// Kinematic helpers for the generated query code (DeltaR, invariant mass, ...).
+//
+// Everything is inline, so the compiler sees the arithmetic at each call site, and the
+// generated code only has to call a function rather than spell the calculation out.
+
+#include <cmath>
+
+namespace func_adl {
+
+  // phi1 - phi2, wrapped into [-pi, pi].
+  inline double DeltaPhi(double phi1, double phi2)
+  {
+    return std::remainder(phi1 - phi2, 2.0 * M_PI);
+  }
+
+  // The square of the distance between two objects in (eta, phi).
+  inline double DeltaR2(double eta1, double phi1, double eta2, double phi2)
+  {
+    const double d_eta = eta1 - eta2;
+    const double d_phi = DeltaPhi(phi1, phi2);
+    return d_eta * d_eta + d_phi * d_phi;
+  }
+
+  // The distance between two objects in (eta, phi).
+  inline double DeltaR(double eta1, double phi1, double eta2, double phi2)
+  {
+    return std::sqrt(DeltaR2(eta1, phi1, eta2, phi2));
+  }
+
+  // The invariant mass of two objects, each given as (pt, eta, phi, m).
+  inline double InvariantMass(double pt1, double eta1, double phi1, double m1,
+                              double pt2, double eta2, double phi2, double m2)
+  {
+    const double p_z1 = pt1 * std::sinh(eta1);
+    const double p_z2 = pt2 * std::sinh(eta2);
+    const double e1 = std::sqrt(pt1 * pt1 + p_z1 * p_z1 + m1 * m1);
+    const double e2 = std::sqrt(pt2 * pt2 + p_z2 * p_z2 + m2 * m2);
+    const double p1_dot_p2 = pt1 * pt2 * std::cos(phi1 - phi2) + p_z1 * p_z2;
+    const double m_squared = m1 * m1 + m2 * m2 + 2.0 * (e1 * e2 - p1_dot_p2);
+    return m_squared > 0.0 ? std::sqrt(m_squared) : 0.0;
+  }
+
+}
+
+#endif
@@ -1,7 +1,8 @@
 #ifndef analysis_query_H
 #define analysis_query_H
 
-#include <AnaAlgorithm/AnaAlgorithm.h>
+#include <AnaAlgorithm/AnaAlgorithm.h>{% for i in class_include_files %}
+#include "{{i}}"{% endfor %}
 
 class query : public EL::AnaAlgorithm
 {
@@ -15,12 +15,21 @@ input_file=""
 compile=1
 run=1
 
-while getopts "d:o:cr" opt; do
+# Built releases are kept in an artifact cache (if one is given), keyed by the hash of the
+# generated source files. A query that has been built before skips cmake/make.
+bundle_hash="{{bundle_hash}}"
+artifact_cache="${FUNC_ADL_ARTIFACT_CACHE:-}"
+artifact_cache_entries="${FUNC_ADL_ARTIFACT_CACHE_ENTRIES:-20}"
+
+while getopts "d:o:a:cr" opt; do
     case "$opt" in
     d)
         input_method="cmd"
         input_file=$OPTARG
         ;;
+    a)
+        artifact_cache=$OPTARG
+        ;;
     c)
         run=0
         ;;
@@ -49,8 +58,50 @@ source /home/atlas/release_setup.sh
 DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 local=`pwd`
 
+# cmake bakes absolute paths into the build, so a cached release can only be restored
+# into the directory it was built in.
+artifact_entry=""
+if [ -n "$artifact_cache" ]; then
+   artifact_entry="$artifact_cache/$bundle_hash"
+fi
+
+restore_artifacts() {
+   if [ -z "$artifact_entry" ] || [ ! -e "$artifact_entry/rel.tgz" ]; then
+      return 1
+   fi
+   if [ "$(cat "$artifact_entry/origin")" != "$local" ]; then
+      return 1
+   fi
+   if ! tar -xzf "$artifact_entry/rel.tgz" -C "$local"; then
+      rm -rf "$local/rel"
+      return 1
+   fi
+   touch "$artifact_entry"
+}
+
+# Saving the build is best effort: a full disk or a read-only cache must not fail a good run.
+save_artifacts() {
+   if [ -z "$artifact_entry" ]; then
+      return 0
+   fi
+   mkdir -p "$artifact_cache" || return 1
+   tmp_entry=$(mktemp -d "$artifact_cache/.tmp-XXXXXX") || return 1
+   if ! tar -czf "$tmp_entry/rel.tgz" -C "$local" rel || ! echo "$local" > "$tmp_entry/origin"; then
+      rm -rf "$tmp_entry"
+      return 1
+   fi
+   rm -rf "$artifact_entry"
+   mv "$tmp_entry" "$artifact_entry" || rm -rf "$tmp_entry"
+
+   # Evict the least recently used builds
+   ls -1td "$artifact_cache"/*/ | tail -n +$((artifact_cache_entries + 1)) | xargs -r rm -rf
+}
+
 # Create a release directory
-if [ $compile = 1 ]; then
+if [ $compile = 1 ] && restore_artifacts; then
+   echo "Restored build $bundle_hash from $artifact_cache"
+   cd rel/build
+elif [ $compile = 1 ]; then
    mkdir rel
    cd rel
    mkdir source
@@ -130,6 +181,7 @@ EOF
    # Next, copy over the algorithm. The source directory needs to be correctly mounted.
    cp $DIR/query.h analysis/analysis
    cp $DIR/query.cxx analysis/Root
+   cp $DIR/func_adl_kinematics.h analysis/Root
    cp $DIR/ATestRun_eljob.py analysis/share
    chmod +x analysis/share/ATestRun_eljob.py
 
@@ -161,6 +213,7 @@ EOF
    cd ../build
    cmake ../source
    make
+   save_artifacts || echo "warning: unable to save the build to $artifact_cache"
 else
    cd rel/build
 fi
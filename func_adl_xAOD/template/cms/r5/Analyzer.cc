@@ -17,7 +17,8 @@
 // extra headers
 {% for i in include_files %}
 #include "{{i}}"
-{% endfor %}
+{% endfor %}{% for i in class_include_files %}
+#include "{{i}}"{% endfor %}
 
 
 #include "TTree.h"
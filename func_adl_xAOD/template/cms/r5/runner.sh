@@ -11,12 +11,21 @@ input_file=""
 compile=1
 run=1
 
-while getopts "d:o:cr" opt; do
+# Built analyzers are kept in an artifact cache (if one is given), keyed by the hash of the
+# generated source files. A query that has been built before skips scram.
+bundle_hash="{{bundle_hash}}"
+artifact_cache="${FUNC_ADL_ARTIFACT_CACHE:-}"
+artifact_cache_entries="${FUNC_ADL_ARTIFACT_CACHE_ENTRIES:-20}"
+
+while getopts "d:o:a:cr" opt; do
     case "$opt" in
     d)
         input_method="cmd"
         input_file=$OPTARG
         ;;
+    a)
+        artifact_cache=$OPTARG
+        ;;
     c)
         run=0
         ;;
@@ -47,8 +56,61 @@ fi
 DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 local=`pwd`
 
+# scram writes the plugin library into $CMSSW_BASE/lib, so it is cached along with the
+# package. Only this analyzer's files are taken (the library, and its .edmplugin and .rootmap
+# entries): the rest of lib belongs to other packages in the release area. Both are only
+# restored into the area they were built in.
+artifact_entry=""
+if [ -n "$artifact_cache" ]; then
+    artifact_entry="$artifact_cache/$bundle_hash"
+fi
+
+analyzer_lib_files() {
+    (cd "$CMSSW_BASE" && ls -d lib/*/*analysisAnalyzer*)
+}
+
+restore_artifacts() {
+    if [ -z "$artifact_entry" ] || [ ! -e "$artifact_entry/analysis.tgz" ] || [ ! -e "$artifact_entry/analyzer_lib.tgz" ]; then
+        return 1
+    fi
+    if [ "$(cat "$artifact_entry/origin")" != "$local $CMSSW_BASE" ]; then
+        return 1
+    fi
+    if ! tar -xzf "$artifact_entry/analysis.tgz" -C "$local" \
+        || ! tar -xzf "$artifact_entry/analyzer_lib.tgz" -C "$CMSSW_BASE" \
+        || ! edmPluginRefresh $(analyzer_lib_files | grep '\.so$' | sed "s|^|$CMSSW_BASE/|"); then
+        rm -rf "$local/analysis"
+        return 1
+    fi
+    touch "$artifact_entry"
+}
+
+# Best effort: a build that cannot be saved (full disk, read-only cache, ...) must not fail the run.
+save_artifacts() {
+    if [ -z "$artifact_entry" ]; then
+        return 0
+    fi
+    mkdir -p "$artifact_cache" || return 1
+    tmp_entry=$(mktemp -d "$artifact_cache/.tmp-XXXXXX") || return 1
+    if ! lib_files=$(analyzer_lib_files) \
+        || ! tar -czf "$tmp_entry/analysis.tgz" -C "$local" analysis \
+        || ! tar -czf "$tmp_entry/analyzer_lib.tgz" -C "$CMSSW_BASE" $lib_files \
+        || ! echo "$local $CMSSW_BASE" > "$tmp_entry/origin"; then
+        rm -rf "$tmp_entry"
+        return 1
+    fi
+    rm -rf "$artifact_entry"
+    mv "$tmp_entry" "$artifact_entry" || rm -rf "$tmp_entry"
+
+    # Evict the least recently used builds
+    ls -1td "$artifact_cache"/*/ | tail -n +$((artifact_cache_entries + 1)) | xargs -r rm -rf
+}
+
 # Build the analysis is need be
-if [ $compile = 1 ]; then
+if [ $compile = 1 ] && restore_artifacts; then
+    echo "Restored build $bundle_hash from $artifact_cache"
+    cd analysis/Analyzer
+elif [ $compile = 1 ]; then
 
     ## Create a subdir for the analysis
     mkdir analysis
@@ -60,11 +122,13 @@ if [ $compile = 1 ]; then
 
 
     cp $DIR/Analyzer.cc ./src/
+    cp $DIR/func_adl_kinematics.h ./src/
     cp $DIR/analyzer_cfg.py .
     cp $DIR/BuildFile.xml .
 
     ## build the analyzer
     scram b
+    save_artifacts || echo "warning: unable to save the build to $artifact_cache"
 else
     cd analysis/Analyzer
 fi
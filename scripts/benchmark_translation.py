@@ -0,0 +1,212 @@
+# Benchmark the time it takes to translate func_adl queries into C++ source files.
+#
+# Each query in the corpus is translated several times, and each phase of the translation is
+# timed on its own. The results are written out as json, and can be compared to a baseline
+# json file from an earlier run:
+#
+#   python scripts/benchmark_translation.py --output baseline.json
+#   ... change the code ...
+#   python scripts/benchmark_translation.py --baseline baseline.json --threshold 0.2
+#
+# The second command exits with a non-zero status if any phase of any query got slower than
+# the baseline by more than the threshold (a fraction).
+import argparse
+import ast
+import json
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+from func_adl import EventDataset
+from func_adl_xAOD.atlas.xaod.executor import atlas_xaod_executor
+from func_adl_xAOD.cms.aod.executor import cms_aod_executor
+from func_adl_xAOD.common.executor import executor
+from func_adl_xAOD.common.generated_code import generated_code
+from func_adl_xAOD.common.statement import block
+from func_adl_xAOD.common.translation_cache import package_version
+
+phases = ['transform', 'visit', 'emit', 'render', 'write']
+
+
+class query_ast_ds(EventDataset):
+    'Return the ast of the query rather than running it'
+
+    async def execute_result_async(self, a: ast.AST) -> Any:
+        return a
+
+
+def _query(*selects: Tuple[str, str]) -> Callable[[], ast.AST]:
+    'Build a query from a list of (operator, lambda text) pairs'
+    def build():
+        q = query_ast_ds()
+        for op, text in selects:
+            q = getattr(q, op)(text)
+        return q.value()
+    return build
+
+
+# The corpus: (name, executor factory, query builder)
+corpus: List[Tuple[str, Callable[[], executor], Callable[[], ast.AST]]] = [
+    ('atlas/jet_pt', atlas_xaod_executor, _query(
+        ('SelectMany', 'lambda e: e.Jets("AntiKt4EMTopoJets")'),
+        ('Select', 'lambda j: j.pt()/1000.0'))),
+    ('atlas/jet_where', atlas_xaod_executor, _query(
+        ('SelectMany', 'lambda e: e.Jets("AntiKt4EMTopoJets")'),
+        ('Where', 'lambda j: j.pt()/1000.0 > 30.0 and abs(j.eta()) < 2.5'),
+        ('Select', 'lambda j: j.pt()/1000.0'))),
+    ('atlas/nested_selectmany', atlas_xaod_executor, _query(
+        ('SelectMany', 'lambda e: e.Jets("AntiKt4EMTopoJets").SelectMany(lambda j: e.Tracks("InDetTrackParticles"))'),
+        ('Select', 'lambda t: t.pt()'))),
+    ('atlas/aggregate_count', atlas_xaod_executor, _query(
+        ('Select', 'lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30000.0).Count()'),)),
+    ('atlas/aggregate_sum', atlas_xaod_executor, _query(
+        ('Select', 'lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()).Aggregate(0, lambda acc, v: acc + v)'),)),
+    ('atlas/first', atlas_xaod_executor, _query(
+        ('Select', 'lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 10.0).First().pt()'),)),
+    ('atlas/dict_output', atlas_xaod_executor, _query(
+        ('Select', 'lambda e: e.Jets("AntiKt4EMTopoJets")'),
+        ('Select', 'lambda jets: {"pt": jets.Select(lambda j: j.pt()), "eta": jets.Select(lambda j: j.eta()), "phi": jets.Select(lambda j: j.phi())}'))),
+    ('atlas/tuple_output', atlas_xaod_executor, _query(
+        ('Select', 'lambda e: (e.Electrons("Electrons"), e.Muons("Muons"))'),
+        ('Select', 'lambda e: (e[0].Select(lambda ele: ele.pt()), e[0].Select(lambda ele: ele.eta()), e[1].Select(lambda mu: mu.pt()), e[1].Select(lambda mu: mu.eta()))'))),
+    ('atlas/deltar', atlas_xaod_executor, _query(
+        ('Select', 'lambda e: (e.Jets("AntiKt4EMTopoJets"), e.Electrons("Electrons"))'),
+        ('Select', 'lambda ev: ev[0].Where(lambda j: ev[1].Where(lambda ele: DeltaR(j.eta(), j.phi(), ele.eta(), ele.phi()) < 0.4).Count() == 0).Select(lambda j: j.pt())'))),
+    ('atlas/get_attribute_float', atlas_xaod_executor, _query(
+        ('SelectMany', 'lambda e: e.Jets("AntiKt4EMTopoJets")'),
+        ('Select', 'lambda j: j.getAttributeFloat("EMFrac")'))),
+    ('atlas/deep_nesting', atlas_xaod_executor, _query(
+        ('Select', 'lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Electrons("Electrons").Select(lambda el: e.Muons("Muons").Select(lambda mu: e.Tracks("InDetTrackParticles").Where(lambda t: t.pt() > j.pt() + el.pt() + mu.pt()).Count()).Sum()).Sum())'),)),
+    ('atlas/deep_selectmany', atlas_xaod_executor, _query(
+        ('SelectMany', 'lambda e: e.Jets("AntiKt4EMTopoJets").SelectMany(lambda j: e.Electrons("Electrons").SelectMany(lambda el: e.Muons("Muons").SelectMany(lambda mu: e.Tracks("InDetTrackParticles").SelectMany(lambda t: e.TruthParticles("TruthParticles").Select(lambda tp: j.pt() + el.pt() + mu.pt() + t.pt() + tp.pt())))))'),)),
+    ('cms/muon_pt', cms_aod_executor, _query(
+        ('SelectMany', 'lambda e: e.TrackMuons("globalMuons")'),
+        ('Select', 'lambda m: m.pt()'))),
+    ('cms/muon_where_dict', cms_aod_executor, _query(
+        ('Select', 'lambda e: e.TrackMuons("globalMuons").Where(lambda m: m.pt() > 10.0)'),
+        ('Select', 'lambda mus: {"pt": mus.Select(lambda m: m.pt()), "eta": mus.Select(lambda m: m.eta())}'))),
+    ('cms/muon_count', cms_aod_executor, _query(
+        ('Select', 'lambda e: e.TrackMuons("globalMuons").Count()'),)),
+]
+
+
+def time_translation(exe: executor, a: ast.AST, output_path: Path) -> Dict[str, float]:
+    'Translate the query and return the time spent in each phase'
+    with exe.profile() as profiler:
+        exe.write_cpp_files(exe.apply_ast_transformations(a), output_path)
+    totals = profiler.totals()
+
+    times = {phase: totals[phase].wall_time for phase in phases}
+    times['total'] = sum(times.values())
+    return times
+
+
+def run_benchmarks(repeat: int, name_filter: str) -> Dict[str, Dict[str, Dict[str, float]]]:
+    'Run every query in the corpus `repeat` times, and return the median and min for each phase'
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        output_path = Path(tmp)
+        for name, exe_factory, build_query in corpus:
+            if name_filter not in name:
+                continue
+            exe = exe_factory()
+
+            # One warm-up run to fill caches that live for the life of the process.
+            time_translation(exe, build_query(), output_path)
+
+            samples: Dict[str, List[float]] = {}
+            for _ in range(repeat):
+                for phase, t in time_translation(exe, build_query(), output_path).items():
+                    samples.setdefault(phase, []).append(t)
+            results[name] = {phase: {'median': statistics.median(s), 'min': min(s)} for phase, s in samples.items()}
+    return results
+
+
+def time_scopes(depth: int, repeat: int) -> Dict[str, float]:
+    r'''
+    Time the scope book keeping a deeply nested query leans on: opening `depth` nested
+    loops, grabbing the scope at each level, and checking every pair of scopes for ancestry
+    (which is what the visitor does each time it re-uses a cached rep).
+    '''
+    samples: Dict[str, List[float]] = {'nest': [], 'starts_with': []}
+    for _ in range(repeat):
+        gc = generated_code()
+        start = time.perf_counter()
+        scopes = []
+        for _ in range(depth):
+            gc.add_statement(block())
+            scopes.append(gc.current_scope())
+        samples['nest'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for s in scopes:
+            for c in scopes:
+                s.starts_with(c)
+        samples['starts_with'].append(time.perf_counter() - start)
+    return {name: min(s) for name, s in samples.items()}
+
+
+def compare(results, baseline, threshold: float, min_delta: float, statistic: str) -> List[str]:
+    'Return a list of regressions - phases whose time grew by more than the threshold'
+    regressions = []
+    for name, query_results in results.items():
+        for phase, stats in query_results.items():
+            base = baseline.get(name, {}).get(phase)
+            if base is None:
+                continue
+            delta = stats[statistic] - base[statistic]
+            if delta > min_delta and stats[statistic] > base[statistic] * (1.0 + threshold):
+                regressions.append(f'{name} {phase}: {base[statistic]*1000:.3f} ms -> {stats[statistic]*1000:.3f} ms')
+    return regressions
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark func_adl to C++ translation.')
+    parser.add_argument('--repeat', type=int, default=20, help='Number of timed translations per query')
+    parser.add_argument('--filter', default='', help='Only run queries whose name contains this string')
+    parser.add_argument('--output', type=Path, help='Write the results as json to this file')
+    parser.add_argument('--baseline', type=Path, help='json results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed fractional slow down before a phase counts as a regression')
+    parser.add_argument('--min-delta', type=float, default=100e-6, help='Slow downs smaller than this many seconds are ignored as noise')
+    parser.add_argument('--statistic', choices=['min', 'median'], default='min', help='Which timing to compare against the baseline')
+    parser.add_argument('--scope-depth', type=int, default=0, help='Also time scope nesting and ancestry checks this many loops deep')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.repeat, args.filter)
+
+    print(f'{"query":<30}' + ''.join(f'{p:>12}' for p in phases + ['total']) + '   (median ms)')
+    for name, query_results in results.items():
+        print(f'{name:<30}' + ''.join(f'{query_results[p]["median"]*1000:>12.3f}' for p in phases + ['total']))
+
+    report = {
+        'package_version': package_version(),
+        'python': sys.version.split()[0],
+        'repeat': args.repeat,
+        'results': results,
+    }
+
+    if args.scope_depth > 0:
+        scope_times = time_scopes(args.scope_depth, args.repeat)
+        print(f'\nscopes {args.scope_depth} deep: ' + ', '.join(f'{n} {t*1000:.3f} ms' for n, t in scope_times.items()))
+        report['scopes'] = {'depth': args.scope_depth, 'min': scope_times}
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2))
+
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())['results']
+        regressions = compare(results, baseline, args.threshold, args.min_delta, args.statistic)
+        if len(regressions) > 0:
+            print(f'\n{len(regressions)} regressions (threshold {args.threshold:.0%}):')
+            for r in regressions:
+                print(f'  {r}')
+            return 1
+        print(f'\nNo regressions against {args.baseline} (threshold {args.threshold:.0%}).')
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
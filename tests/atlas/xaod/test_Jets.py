@@ -12,8 +12,22 @@ def test_get_attribute_float():
     # Check to see if there mention of push_back anywhere.
     lines = get_lines_of_code(r)
     print_lines(lines)
-    l_attribute = find_line_with("getAttribute", lines)
-    assert 'getAttribute<float>("emf")' in lines[l_attribute]
+    l_attribute = find_line_with("_attrib_accessor", lines)
+    assert '(*i_obj' in lines[l_attribute]
+
+    decls = r.QueryVisitor.class_declaration_code()
+    assert any(d.startswith('SG::AuxElement::ConstAccessor<float> _attrib_accessor') and d.endswith('{"emf"};\n') for d in decls)
+    assert 'AthContainers/AuxElement.h' in r.QueryVisitor.class_include_files()
+
+
+def test_get_attribute_accessor_declared_once():
+    r = atlas_xaod_dataset() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: (j.getAttributeFloat("emf"), j.getAttributeFloat("emf") > 0.5, j.getAttributeFloat("width"))') \
+        .value()
+    decls = [d for d in r.QueryVisitor.class_declaration_code() if 'ConstAccessor' in d]
+    assert len(decls) == 2
+    assert len([d for d in decls if '{"emf"}' in d]) == 1
 
 
 def test_get_attribute_float_wrong_args():
@@ -43,8 +57,14 @@ def test_get_attribute_vector_float():
     # Check to see if there mention of push_back anywhere.
     lines = get_lines_of_code(r)
     print_lines(lines)
-    l_attribute = find_line_with("getAttribute", lines)
-    assert 'getAttribute<std::vector<double>>("emf")' in lines[l_attribute]
+
+    # The vector is looped over where it sits in the aux store, rather than copied out.
+    l_attribute = find_line_with("_attrib_accessor", lines)
+    assert lines[l_attribute].strip().startswith('for (auto')
+    assert 'std::vector<double>' not in '\n'.join(lines)
+
+    decls = r.QueryVisitor.class_declaration_code()
+    assert any(d.startswith('SG::AuxElement::ConstAccessor<std::vector<double>> _attrib_accessor') for d in decls)
 
 
 def test_get_attribute_vector_float_wrong_args():
@@ -1,4 +1,5 @@
 import ast
+from pathlib import Path
 
 import pytest
 from func_adl.event_dataset import EventDataset
@@ -63,3 +64,351 @@ def test_bad_ast_no_call_to_name(tmp_path):
         exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path)
 
     assert 'func_adl ast' in str(e.value)
+
+
+def test_translation_cache_hit(tmp_path):
+    'The second time a query is translated the files come from the cache'
+    from func_adl_xAOD.common.translation_cache import translation_cache
+
+    a = query_as_ast() \
+        .Select('lambda e: e.EventInfo("EventInfo").runNumber()') \
+        .value()
+
+    exe = atlas_xaod_executor(translation_cache=translation_cache(tmp_path / 'cache'))
+    (tmp_path / 'run1').mkdir()
+    (tmp_path / 'run2').mkdir()
+    f_spec1 = exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path / 'run1')
+    f_spec2 = exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path / 'run2')
+
+    for name in f_spec1.all_filenames:
+        assert (tmp_path / 'run1' / name).read_text() == (tmp_path / 'run2' / name).read_text()
+    assert f_spec1.result_rep.filename == f_spec2.result_rep.filename
+    assert f_spec1.result_rep.treename == f_spec2.result_rep.treename
+    assert len(list((tmp_path / 'cache').iterdir())) == 1
+
+
+def test_translation_cache_skipped_with_context(tmp_path):
+    'A context passed in can change the C++, so the cache is neither read nor written'
+    from func_adl_xAOD.common.output_options import ttree_output_options
+    from func_adl_xAOD.common.translation_cache import translation_cache
+    from func_adl_xAOD.common.translation_context import TranslationContext
+
+    a = query_as_ast() \
+        .Select('lambda e: e.EventInfo("EventInfo").runNumber()') \
+        .value()
+
+    exe = atlas_xaod_executor(translation_cache=translation_cache(tmp_path / 'cache'))
+    (tmp_path / 'run1').mkdir()
+    (tmp_path / 'run2').mkdir()
+    exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path / 'run1')
+    context = TranslationContext(output_options=ttree_output_options(compression='zstd'))
+    exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path / 'run2', context)
+
+    assert 'SetCompressionSettings' not in (tmp_path / 'run1' / 'query.cxx').read_text()
+    assert 'SetCompressionSettings' in (tmp_path / 'run2' / 'query.cxx').read_text()
+    assert len(list((tmp_path / 'cache').iterdir())) == 1
+
+
+def test_translation_cache_different_queries(tmp_path):
+    'Method calls are hidden in CPPCodeValue nodes - they must still change the key'
+    exe = atlas_xaod_executor()
+    a1 = exe.apply_ast_transformations(query_as_ast().Select('lambda e: e.Jets("AntiKt4EMTopoJets")').value())
+    a2 = exe.apply_ast_transformations(query_as_ast().Select('lambda e: e.Electrons("Electrons")').value())
+    assert exe.fingerprint(a1) != exe.fingerprint(a2)
+
+
+def test_translation_cache_eviction(tmp_path):
+    'Least recently used entries are removed when the cache is too big'
+    import os
+    from func_adl_xAOD.common.translation_cache import translation_cache
+
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'query.cxx').write_text('x' * 100)
+
+    c = translation_cache(tmp_path / 'cache', max_size=250)
+    c.store('a', src, ['query.cxx'], {})
+    os.utime(tmp_path / 'cache' / 'a' / 'translation.json', (1, 1))
+    c.store('b', src, ['query.cxx'], {})
+    os.utime(tmp_path / 'cache' / 'b' / 'translation.json', (2, 2))
+    assert c.lookup('a', tmp_path) is not None
+    c.store('c', src, ['query.cxx'], {})
+
+    assert c.lookup('b', tmp_path) is None
+    assert c.lookup('a', tmp_path) is not None
+    assert c.lookup('c', tmp_path) is not None
+
+
+def test_fingerprint_ignores_lambda_names():
+    'Renaming lambda arguments does not change the query'
+    exe = atlas_xaod_executor()
+    a1 = exe.apply_ast_transformations(query_as_ast().SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")').Select('lambda j: j.pt()').value())
+    a2 = exe.apply_ast_transformations(query_as_ast().SelectMany('lambda evt: evt.Jets("AntiKt4EMTopoJets")').Select('lambda jet: jet.pt()').value())
+    assert exe.fingerprint(a1) == exe.fingerprint(a2)
+
+
+def test_fingerprint_respects_lambda_binding():
+    'Which lambda argument is referenced matters, even if the names are swapped'
+    exe = atlas_xaod_executor()
+    a1 = exe.apply_ast_transformations(query_as_ast().Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.EventInfo("EventInfo").runNumber())').value())
+    a2 = exe.apply_ast_transformations(query_as_ast().Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt())').value())
+    assert exe.fingerprint(a1) != exe.fingerprint(a2)
+
+
+def test_fingerprint_normalizes_constants():
+    'A negative number is the same no matter how the ast spells it'
+    from func_adl_xAOD.common.fingerprint import ast_fingerprint
+
+    a1 = ast.parse('f(-1, "hi")').body[0].value
+    a2 = ast.Call(func=ast.Name(id='f', ctx=ast.Load()), args=[ast.Constant(-1), ast.Constant('hi', kind='u')], keywords=[])
+    assert ast_fingerprint(a1) == ast_fingerprint(a2)
+    assert ast_fingerprint(a1) != ast_fingerprint(ast.parse('f(-1.0, "hi")').body[0].value)
+
+
+def test_cpp_identical_for_equivalent_queries(tmp_path):
+    'The same query, with different lambda names, generates byte identical C++'
+    exe = atlas_xaod_executor()
+    for index, (e_name, j_name) in enumerate([('e', 'j'), ('evt', 'jet')]):
+        a = query_as_ast() \
+            .SelectMany(f'lambda {e_name}: {e_name}.Jets("AntiKt4EMTopoJets")') \
+            .Select(f'lambda {j_name}: {j_name}.pt()') \
+            .value()
+        (tmp_path / str(index)).mkdir()
+        exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path / str(index))
+
+    for name in ['query.cxx', 'query.h']:
+        assert (tmp_path / '0' / name).read_text() == (tmp_path / '1' / name).read_text()
+
+
+def _bundle_hash_in_runner(runner: Path) -> str:
+    'Pull the bundle hash out of a rendered runner script'
+    for line in runner.read_text().split('\n'):
+        if line.startswith('bundle_hash='):
+            return line.split('"')[1]
+    assert False, 'No bundle hash in the runner'
+
+
+def test_bundle_hash(tmp_path):
+    'The runner carries a hash of the source files, so identical builds can be reused'
+    exe = atlas_xaod_executor()
+    hashes = []
+    for index, selection in enumerate(['lambda j: j.pt()', 'lambda jet: jet.pt()', 'lambda j: j.eta()']):
+        a = query_as_ast() \
+            .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+            .Select(selection) \
+            .value()
+        (tmp_path / str(index)).mkdir()
+        f_spec = exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path / str(index))
+        hashes.append(_bundle_hash_in_runner(tmp_path / str(index) / f_spec.main_script))
+
+    assert len(hashes[0]) == 64
+    assert hashes[0] == hashes[1]
+    assert hashes[0] != hashes[2]
+
+
+def test_translate_on_thread_pool(tmp_path):
+    'Translating many queries at once on threads gives the same code as doing it one at a time'
+    from concurrent.futures import ThreadPoolExecutor
+
+    exe = atlas_xaod_executor()
+    n_queries = 16
+
+    # Only the translation runs on the threads: parsing the lambda strings is not thread safe.
+    asts = [query_as_ast()
+            .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")')
+            .Select(f'lambda j: j.pt()/{index % n_queries + 1}.0')
+            .value()
+            for index in range(2 * n_queries)]
+
+    def translate(index: int) -> str:
+        out_dir = tmp_path / str(index)
+        out_dir.mkdir()
+        exe.write_cpp_files(exe.apply_ast_transformations(asts[index]), out_dir)
+        return (out_dir / 'query.cxx').read_text()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(translate, range(2 * n_queries)))
+
+    for index in range(n_queries):
+        assert results[index] == results[index + n_queries]
+    assert 'jets0' in results[0]
+
+
+def test_write_cpp_files_many(tmp_path):
+    'A batch translated in worker processes matches translating one at a time'
+    exe = atlas_xaod_executor()
+    asts = [exe.apply_ast_transformations(query_as_ast()
+                                          .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")')
+                                          .Select(f'lambda j: j.getAttributeFloat("emf")*{i+1}.0')
+                                          .value())
+            for i in range(4)]
+    output_dirs = [tmp_path / f'batch{i}' for i in range(len(asts))]
+    for d in output_dirs:
+        d.mkdir()
+
+    infos = exe.write_cpp_files_many(asts, output_dirs, max_workers=2)
+
+    assert [info.output_path for info in infos] == output_dirs
+    for i, info in enumerate(infos):
+        assert info.result_rep.treename == 'atlas_xaod_tree'
+        single_dir = tmp_path / f'single{i}'
+        single_dir.mkdir()
+        exe.write_cpp_files(asts[i], single_dir)
+        assert (single_dir / 'query.cxx').read_text() == (output_dirs[i] / 'query.cxx').read_text()
+    assert '*4.0' in (output_dirs[3] / 'query.cxx').read_text()
+
+
+def test_write_cpp_files_many_spawned_workers_see_method_types(tmp_path):
+    'A spawned worker does not inherit the parent, so it must be sent the method types added at run time'
+    import multiprocessing
+
+    import func_adl_xAOD.common.cpp_types as ctyp
+
+    ctyp.add_method_type_info("xAOD::Jet", "batchOnlyFloat", ctyp.terminal('float'))
+    try:
+        exe = atlas_xaod_executor()
+        a = exe.apply_ast_transformations(query_as_ast()
+                                          .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")')
+                                          .Select('lambda j: j.batchOnlyFloat()')
+                                          .value())
+        (tmp_path / 'batch').mkdir()
+        exe.write_cpp_files_many([a], [tmp_path / 'batch'], max_workers=1,
+                                 mp_context=multiprocessing.get_context('spawn'))
+    finally:
+        del ctyp.g_method_type_dict["xAOD::Jet"]["batchOnlyFloat"]
+
+    assert 'float _col' in (tmp_path / 'batch' / 'query.h').read_text()
+
+
+def test_kinematics_header_written(tmp_path):
+    a = query_as_ast().Select('lambda e: e.EventInfo("EventInfo").runNumber()').value()
+    exe = atlas_xaod_executor()
+    exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path)
+    assert 'inline double DeltaR(' in (tmp_path / 'func_adl_kinematics.h').read_text()
+    assert 'func_adl_kinematics.h' in (tmp_path / 'runner.sh').read_text()
+
+
+def test_write_cpp_files_many_mismatch(tmp_path):
+    exe = atlas_xaod_executor()
+    with pytest.raises(ValueError):
+        exe.write_cpp_files_many([], [tmp_path])
+
+
+def test_profile_phases(tmp_path):
+    'Each phase and visitor handler is reported to the callback'
+    a = query_as_ast() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Where('lambda j: j.pt() > 10.0') \
+        .Select('lambda j: j.pt()') \
+        .value()
+
+    exe = atlas_xaod_executor()
+    seen = []
+    with exe.profile(seen.append) as profiler:
+        exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path)
+
+    names = [r.name for r in seen]
+    for name in ['transform', 'transform.cpp_ast_finder', 'visit', 'emit', 'render', 'write',
+                 'call_Select', 'call_Where', 'call_SelectMany', 'call_ResultTTree', 'process_ast_node']:
+        assert name in names
+    assert profiler.records == seen
+    assert all(r.wall_time >= 0 for r in seen)
+
+    totals = profiler.totals()
+    assert totals['visit'].wall_time >= totals['call_ResultTTree'].wall_time
+
+
+def test_profile_off_by_default(tmp_path):
+    'Once the with block is done, nothing is recorded'
+    exe = atlas_xaod_executor()
+    with exe.profile() as profiler:
+        pass
+    a = query_as_ast().Select('lambda e: e.EventInfo("EventInfo").runNumber()').value()
+    exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path)
+    assert len(profiler.records) == 0
+
+
+def test_template_environment_reused():
+    'The template directory is looked up and the templates compiled only once'
+    from func_adl_xAOD.common.executor import _j2_environment
+
+    env = _j2_environment('func_adl_xAOD/template/atlas/r21')
+    assert env is _j2_environment('func_adl_xAOD/template/atlas/r21')
+    assert env.get_template('query.cxx') is env.get_template('query.cxx')
+
+
+def test_template_bytecode_cache(tmp_path):
+    'Compiled templates are written to the bytecode cache directory'
+    from func_adl_xAOD.common.executor import set_template_bytecode_cache
+
+    set_template_bytecode_cache(tmp_path / 'bytecode')
+    try:
+        a = query_as_ast().Select('lambda e: e.EventInfo("EventInfo").runNumber()').value()
+        exe = atlas_xaod_executor()
+        (tmp_path / 'out').mkdir()
+        exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path / 'out')
+        assert len(list((tmp_path / 'bytecode').iterdir())) == 6
+    finally:
+        set_template_bytecode_cache(None)
+
+
+def _where_lines(tmp_path: Path, **kwargs):
+    'Translate a filter with an expensive test first, and return the lines of the C++'
+    a = query_as_ast() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Where('lambda j: DeltaR(j.eta(), j.phi(), 0.0, 0.0) < 0.4 and j.pt() > 30000.0') \
+        .Select('lambda j: j.pt()') \
+        .value()
+    exe = atlas_xaod_executor(**kwargs)
+    exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path)
+    return (tmp_path / 'query.cxx').read_text().splitlines()
+
+
+def _first_line(lines, text: str) -> int:
+    return [i for i, ln in enumerate(lines) if text in ln][0]
+
+
+def test_predicates_in_written_order(tmp_path):
+    lines = _where_lines(tmp_path)
+    assert _first_line(lines, 'func_adl::DeltaR') < _first_line(lines, '>30000.0')
+
+
+def test_predicates_reordered(tmp_path):
+    lines = _where_lines(tmp_path, reorder_predicates=True)
+    assert _first_line(lines, '>30000.0') < _first_line(lines, 'func_adl::DeltaR')
+
+
+def _book_lines(exe, tmp_path):
+    'The lines of query.cxx that book the tree'
+    a = query_as_ast().Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt())').value()
+    exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path)
+    return [ln.strip() for ln in (tmp_path / 'query.cxx').read_text().splitlines() if 'myTree->' in ln]
+
+
+def test_output_options_default(tmp_path):
+    lines = _book_lines(atlas_xaod_executor(), tmp_path)
+    assert len(lines) == 1
+    assert lines[0].endswith(');')
+    assert 'SetCompressionSettings' not in lines[0]
+
+
+def test_output_options_in_book_code(tmp_path):
+    from func_adl_xAOD.common.output_options import ttree_output_options
+    exe = atlas_xaod_executor(output_options=ttree_output_options(compression='lz4', basket_size=64000, auto_flush=-30000000))
+    lines = _book_lines(exe, tmp_path)
+    assert lines[0].endswith(', 64000)->SetCompressionSettings(404);')
+    assert lines[1] == 'myTree->SetAutoFlush(-30000000);'
+
+
+def test_output_options_change_fingerprint():
+    from func_adl_xAOD.common.output_options import ttree_output_options
+    a = atlas_xaod_executor().apply_ast_transformations(query_as_ast().Select('lambda e: e.Jets("AntiKt4EMTopoJets")').value())
+    plain = atlas_xaod_executor().fingerprint(a)
+    zstd = atlas_xaod_executor(output_options=ttree_output_options(compression='zstd')).fingerprint(a)
+    lz4 = atlas_xaod_executor(output_options=ttree_output_options(compression='lz4')).fingerprint(a)
+    assert len({plain, zstd, lz4}) == 3
+
+
+def test_precise_types_change_fingerprint():
+    a = atlas_xaod_executor().apply_ast_transformations(query_as_ast().Select('lambda e: e.Jets("AntiKt4EMTopoJets")').value())
+    assert atlas_xaod_executor().fingerprint(a) != atlas_xaod_executor(precise_types=True).fingerprint(a)
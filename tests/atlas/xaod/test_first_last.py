@@ -67,3 +67,43 @@ def test_First_Of_Select_After_Where_is_in_right_place():
     ln = find_line_with(">10.0", lines)
     # Look for the "false" that First uses to remember it has gone by one.
     assert find_line_with("false", lines[ln:], throw_if_not_found=False) > 0
+
+
+def test_First_breaks_out_of_loop():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 10.0).First().pt()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_break = find_line_with("break;", lines)
+
+    # The break is the last thing done for the first jet, after the Fill.
+    assert find_line_with("Fill()", lines) < l_break
+    active_blocks = find_open_blocks(lines[:l_break])
+    assert "is_first" in active_blocks[-1]
+    assert 1 == ["for" in a for a in active_blocks].count(True)
+
+
+def test_First_of_collection_inside_loop():
+    # The first collection is used inside the if statement, in the loop, so the loop can stop after it.
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Tracks("InDetTrackParticles")).First().Count()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    active_blocks = find_open_blocks(lines[:find_line_with("size()", lines)])
+    assert "is_first" in active_blocks[-1]
+    assert 1 == ["for" in a for a in active_blocks].count(True)
+    assert find_line_with("Fill()", lines) < find_line_with("break;", lines)
+
+
+def test_First_after_Where_of_reused_value():
+    # The Select re-uses the pt calculated for the filter test, ahead of the filter. The first
+    # item must still be the first jet that passes it.
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30).Select(lambda j: j.pt()).First()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_first = find_line_with("if (is_first", lines)
+    assert 1 == [">30" in ln for ln in find_open_blocks(lines[:l_first])].count(True)
@@ -1,3 +1,4 @@
+import pytest
 from tests.utils.locators import find_line_numbers_with, find_line_with, find_next_closing_bracket, find_open_blocks
 from tests.utils.general import get_lines_of_code, print_lines
 from tests.atlas.xaod.utils import atlas_xaod_dataset
@@ -17,6 +18,17 @@ def test_tree_name():
     assert 1 == len(l_sets)
 
 
+def test_sum_of_bool_times_one_is_int():
+    # `*1` turns the test into an int, so it must not be folded away.
+    r = atlas_xaod_dataset() \
+        .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Select(lambda j: (j.pt() > 10)*1).Sum()") \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert "*1)" in lines[find_line_with("(aggResult", lines)]
+    assert ['int'] == [str(v.cpp_type()) for v in r.QueryVisitor._gc._class_vars]
+
+
 def test_Aggregate_not_initial_const_SUM():
     r = atlas_xaod_dataset() \
         .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Select(lambda j: j.pt()/1000).Sum()") \
@@ -43,13 +55,10 @@ def test_count_after_single_sequence():
         .value()
     lines = get_lines_of_code(r)
     print_lines(lines)
-    # Make sure there is just one for loop in here.
-    assert 1 == ["for" in ln for ln in lines].count(True)
-    # Make sure the +1 happens after the for, and before another } bracket.
-    num_for = find_line_with("for", lines)
-    num_inc = find_line_with("+1", lines[num_for:])
-    num_close = find_next_closing_bracket(lines[num_for:])
-    assert num_close > num_inc
+    # Nothing is filtered, so this is the size of the collection - no loop needed.
+    assert 0 == ["for" in ln for ln in lines].count(True)
+    l_col = lines[find_line_with("_col1", lines)]
+    assert "static_cast<int>(jets" in l_col and "->size())" in l_col
 
 
 def test_count_after_single_sequence_with_filter():
@@ -88,13 +97,10 @@ def test_count_after_single_sequence_of_sequence():
         .value()
     lines = get_lines_of_code(r)
     print_lines(lines)
-    # Make sure there is just one for loop in here.
-    assert 1 == ["for" in ln for ln in lines].count(True)
-    # Make sure the +1 happens after the for, and before another } bracket.
-    num_for = find_line_with("for", lines)
-    num_inc = find_line_with("+1", lines[num_for:])
-    num_close = find_next_closing_bracket(lines[num_for:])
-    assert num_close > num_inc
+    # This counts the jets.
+    assert 0 == ["for" in ln for ln in lines].count(True)
+    l_col = lines[find_line_with("_col1", lines)]
+    assert "jets" in l_col and "->size()" in l_col
 
 
 def test_count_after_double_sequence_with_filter():
@@ -133,15 +139,20 @@ def test_count_after_single_sequence_of_sequence_with_useless_where():
         .value()
     lines = get_lines_of_code(r)
     print_lines(lines)
-    # Make sure there is just one for loop in here.
-    l_increment = find_line_with('+1', lines)
-    block_headers = find_open_blocks(lines[:l_increment])
-    assert 1 == ["for" in ln for ln in block_headers].count(True)
-    # Make sure the +1 happens after the for, and before another } bracket.
-    num_for = find_line_with("for", lines)
-    num_inc = find_line_with("+1", lines[num_for:])
-    num_close = find_next_closing_bracket(lines[num_for:])
-    assert num_close > num_inc
+    # The Where is inside the Select, so this still counts every jet.
+    assert 0 == ["for" in ln for ln in lines].count(True)
+    l_col = lines[find_line_with("_col1", lines)]
+    assert "jets" in l_col and "->size()" in l_col
+
+
+def test_count_of_filtered_sequence_loops():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AllMyJets").Select(lambda j: j.pt()).Where(lambda pt: pt > 10.0).Select(lambda pt: pt*2).Count()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 1 == ["for" in ln for ln in lines].count(True)
+    assert 0 == len(find_line_numbers_with("size()", lines))
 
 
 def test_first_can_be_iterable_after_where():
@@ -167,7 +178,7 @@ def test_Aggregate_per_jet():
 
 def test_Aggregate_per_jet_int():
     r = atlas_xaod_dataset() \
-        .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Select(lambda j: j.pt()).Count()") \
+        .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Select(lambda j: j.pt()).Where(lambda pt: pt > 10.0).Count()") \
         .value()
 
     lines = get_lines_of_code(r)
@@ -182,17 +193,121 @@ def test_generate_Max():
         .value()
     lines = get_lines_of_code(r)
     print_lines(lines)
+    # The first jet always sets the max - it does not have to beat zero.
+    l_test = find_line_with("if ((is_first", lines)
+    assert ">aggResult" in lines[l_test]
+    assert "double agg" in lines[find_line_with("aggResult", lines)]
+
+
+def test_generate_Min_calculates_item_once():
+    r = atlas_xaod_dataset() \
+        .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Select(lambda j: j.pt()).Min()") \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 1 == len(find_line_numbers_with("->pt()", lines))
+    l_test = find_line_with("if ((is_first", lines)
+    assert "<aggResult" in lines[l_test]
+
+
+def test_Sum_of_ints_is_int():
+    r = atlas_xaod_dataset() \
+        .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Select(lambda j: 1).Sum()") \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert find_line_with('int agg', lines) > 0
+
+
+def test_Sum_with_selector():
+    r = atlas_xaod_dataset() \
+        .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Sum(lambda j: j.pt())") \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_sum = find_line_with("aggResult", lines[find_line_with("for", lines):])
+    assert "->pt()" in lines[find_line_with("for", lines) + l_sum]
+
+
+def test_Aggregate_starts_from_first_item():
+    r = atlas_xaod_dataset() \
+        .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Select(lambda j: j.pt()).Aggregate(lambda acc, v: acc*v)") \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_first = find_line_with("if (is_first", lines)
+    l_else = find_line_with("else", lines)
+    assert l_first < l_else
+    assert "=i_obj" in lines[l_first + 3].replace(" ", "")
+    assert "*" in lines[l_else + 2]
+
+
+def test_Aggregate_with_initial_function():
+    r = atlas_xaod_dataset() \
+        .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Select(lambda j: j.pt()).Aggregate(lambda v: v*2, lambda acc, v: acc+v)") \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_first = find_line_with("if (is_first", lines)
+    assert "*2" in lines[l_first + 3]
+    assert "+" in lines[find_line_with("else", lines) + 2]
+
+
+def test_aggregates_over_one_collection_share_a_loop():
+    r = atlas_xaod_dataset() \
+        .Select("lambda e: (e.Jets('AntiKt4EMTopoJets').Count(lambda j: j.eta() > 0.0), e.Jets('AntiKt4EMTopoJets').Sum(lambda j: j.pt()), e.Jets('AntiKt4EMTopoJets').Max(lambda j: j.eta()))") \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 1 == len(find_line_numbers_with("for", lines))
+    l_fill = find_line_with("Fill()", lines)
+    for a in ["+1", "->pt()", "->eta()"]:
+        assert find_line_with(a, lines) < l_fill
+
+
+def test_fused_aggregates_keep_their_filters():
+    # The pt is calculated once, ahead of all the filters, and each update must still be inside
+    # its own filter only.
+    r = atlas_xaod_dataset() \
+        .Select("lambda e: {'n': e.Jets('AntiKt4EMTopoJets').Where(lambda j: j.pt() > 30.0).Count(), "
+                "'m': e.Jets('AntiKt4EMTopoJets').Where(lambda j: j.eta() > 1).Select(lambda j: j.pt()).Min(), "
+                "'pt': e.Jets('AntiKt4EMTopoJets').Sum(lambda j: j.pt())}") \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 1 == len(find_line_numbers_with("for", lines))
+
+    def filters(text: str):
+        blocks = find_open_blocks(lines[:find_line_with(text, lines)])
+        return [f for f in [">30.0", ">1)"] if any(f in ln for ln in blocks)]
+
+    assert [">30.0"] == filters("+1)")
+    assert [">1)"] == filters("||")
+    assert [">1)"] == filters("= cse")
+    assert [] == filters("+cse")
+
+
+def test_aggregates_over_different_collections_not_fused():
+    r = atlas_xaod_dataset() \
+        .Select("lambda e: (e.Jets('AntiKt4EMTopoJets').Sum(lambda j: j.pt()), e.Jets('AntiKt4LCTopoJets').Sum(lambda j: j.pt()))") \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 2 == len(find_line_numbers_with("for", lines))
 
 
 def test_First_selects_collection_count():
-    # Make sure that we have the "First" predicate after if Where's if statement.
+    # The tracks are a collection, so the count is their size, inside the First's if statement.
     r = atlas_xaod_dataset() \
         .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Tracks("InDetTrackParticles")).First().Count()') \
         .value()
     lines = get_lines_of_code(r)
     print_lines(lines)
     ln = find_line_numbers_with("for", lines)
-    assert 2 == len(ln)
+    assert 1 == len(ln)
+    l_size = find_line_with("->size()", lines)
+    assert "tracks" in lines[l_size]
+    assert 1 == ["is_first" in a for a in find_open_blocks(lines[:l_size])].count(True)
 
 
 def test_sequence_with_where_first():
@@ -208,3 +323,21 @@ def test_sequence_with_where_first():
     l_agg = find_line_with("+1", lines)
     active_blocks = find_open_blocks(lines[:l_agg])
     assert 1 == [">1000" in a for a in active_blocks].count(True)
+
+
+@pytest.mark.parametrize("aggregate, update", [
+    ('Sum()', 'aggResult'),
+    ('Aggregate(0.0, lambda acc, v: acc + v)', 'aggResult'),
+    ('Max()', 'is_first'),
+    ('Min()', 'is_first'),
+])
+def test_aggregate_update_inside_filter(aggregate, update):
+    # The pt calculated for the filter test is re-used by the Select, ahead of the filter. The
+    # accumulator must still only be updated for the jets that pass it.
+    r = atlas_xaod_dataset() \
+        .Select(f'lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30).Select(lambda j: j.pt()).{aggregate}') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_update = [i for i in find_line_numbers_with(update, lines) if '=' in lines[i] and 'if' not in lines[i]][0]
+    assert 1 == [">30" in ln for ln in find_open_blocks(lines[:l_update])].count(True)
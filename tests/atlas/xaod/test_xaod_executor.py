@@ -1,6 +1,8 @@
 from tests.utils.locators import find_line_numbers_with, find_line_with, find_open_blocks
 from tests.utils.general import get_lines_of_code, print_lines
 import pytest
+from func_adl_xAOD.common.output_options import ttree_output_options
+from func_adl_xAOD.common.translation_context import TranslationContext
 from tests.atlas.xaod.utils import atlas_xaod_dataset, exe_from_qastle
 
 # Tests that make sure the xaod executor is working correctly
@@ -291,6 +293,12 @@ def test_Select_Multiple_arrays_2_step():
     assert 0 == ["for" in a for a in active_blocks].count(True)
 
 
+def _storage_clear_line(r, lines, cpp_type: str) -> int:
+    'The inner storage of a nested array is a class member, cleared at the level it is filled for'
+    name = [d.split()[-1].rstrip(';') for d in r.QueryVisitor.class_declaration_code() if d.startswith(cpp_type + ' ')][0]
+    return find_line_with(f"{name}.clear()", lines)
+
+
 def test_Select_of_2D_array():
     # This should generate a 2D array.
     r = atlas_xaod_dataset() \
@@ -299,7 +307,7 @@ def test_Select_of_2D_array():
     lines = get_lines_of_code(r)
     print_lines(lines)
 
-    l_vector_decl = find_line_with("vector<double>", lines)
+    l_vector_decl = _storage_clear_line(r, lines, "std::vector<double>")
     l_vector_active = len(find_open_blocks(lines[:l_vector_decl]))
 
     l_first_push = find_line_numbers_with("push_back", lines)
@@ -320,7 +328,7 @@ def test_Select_of_2D_with_where():
     lines = get_lines_of_code(r)
     print_lines(lines)
 
-    l_vector_decl = find_line_with("vector<double>", lines)
+    l_vector_decl = _storage_clear_line(r, lines, "std::vector<double>")
     l_vector_active = len(find_open_blocks(lines[:l_vector_decl]))
 
     l_first_push = find_line_with("push_back", lines)
@@ -336,10 +344,10 @@ def test_Select_of_3D_array():
     lines = get_lines_of_code(r)
     print_lines(lines)
 
-    l_vector_decl = find_line_with("vector<double> ", lines)
+    l_vector_decl = _storage_clear_line(r, lines, "std::vector<double>")
     l_vector_active = len(find_open_blocks(lines[:l_vector_decl]))
 
-    l_vector_double_decl = find_line_with("vector<std::vector<double>>", lines)
+    l_vector_double_decl = _storage_clear_line(r, lines, "std::vector<std::vector<double>>")
     l_vector_double_active = len(find_open_blocks(lines[:l_vector_double_decl]))
 
     assert l_vector_active == (l_vector_double_active + 1)
@@ -356,6 +364,42 @@ def test_Select_of_2D_array_with_tuple():
     assert "data structures" in str(e.value)
 
 
+def test_Select_of_2D_array_reserved():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Electrons("Electrons").Select(lambda e: e.pt()))') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_reserves = find_line_numbers_with(".reserve(", lines)
+    assert 2 == len(l_reserves)
+    assert "jets" in lines[l_reserves[0]]
+    assert "electrons" in lines[l_reserves[1]]
+
+    # Each is just before the loop over the collection it sizes to
+    l_loops = find_line_numbers_with("for (", lines)
+    assert [ll + 1 for ll in l_reserves] == l_loops
+
+
+def test_filtered_sequence_reserved():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30.0).Select(lambda j: j.eta())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_reserve = find_line_with(".reserve(", lines)
+    assert l_reserve + 1 == find_line_with("for (", lines)
+
+
+def test_flattened_sequence_not_reserved():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").SelectMany(lambda j: e.Electrons("Electrons")).Select(lambda e: e.pt())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 0 == len(find_line_numbers_with(".reserve(", lines))
+
+
 def test_SelectMany_of_tuple_is_not_array():
     # The following statement should be a straight sequence, not an array.
     r = atlas_xaod_dataset() \
@@ -374,22 +418,22 @@ def test_generate_binary_operators():
     ops = ['+', '-', '*', '/', '%']
     for o in ops:
         r = atlas_xaod_dataset() \
-            .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt(){0}1)'.format(o)) \
+            .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt(){0}2)'.format(o)) \
             .value()
         lines = get_lines_of_code(r)
         print_lines(lines)
-        _ = find_line_with(f"pt(){o}1", lines)
+        _ = find_line_with(f"pt(){o}2", lines)
 
 
 def test_generate_unary_operations():
     ops = ['+', '-']
     for o in ops:
         r = atlas_xaod_dataset() \
-            .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()+({0}1))'.format(o)) \
+            .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()+({0}j.eta()))'.format(o)) \
             .value()
         lines = get_lines_of_code(r)
         print_lines(lines)
-        _ = find_line_with(f"pt()+({o}(1))", lines)
+        _ = find_line_with(f"pt()+({o}(", lines)
 
 
 def test_generate_unary_not():
@@ -546,3 +590,395 @@ async def test_electron_and_muon_from_qastle():
     q = "(call ResultTTree (call Select (call Select (call EventDataset (list 'localds:bogus')) (lambda (list e) (list (call (attr e 'Electrons') 'Electrons') (call (attr e 'Muons') 'Muons')))) (lambda (list e) (list (call (attr (subscript e 0) 'Select') (lambda (list ele) (call (attr ele 'E')))) (call (attr (subscript e 0) 'Select') (lambda (list ele) (call (attr ele 'pt')))) (call (attr (subscript e 0) 'Select') (lambda (list ele) (call (attr ele 'phi')))) (call (attr (subscript e 0) 'Select') (lambda (list ele) (call (attr ele 'eta')))) (call (attr (subscript e 1) 'Select') (lambda (list mu) (call (attr mu 'E')))) (call (attr (subscript e 1) 'Select') (lambda (list mu) (call (attr mu 'pt')))) (call (attr (subscript e 1) 'Select') (lambda (list mu) (call (attr mu 'phi')))) (call (attr (subscript e 1) 'Select') (lambda (list mu) (call (attr mu 'eta'))))))) (list 'e_E' 'e_pt' 'e_phi' 'e_eta' 'mu_E' 'mu_pt' 'mu_phi' 'mu_eta') 'forkme' 'dude.root')"
     r = await exe_from_qastle(q)
     print(r)
+
+
+def test_repeated_member_call_done_once():
+    r = atlas_xaod_dataset() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: (j.pt()/1000.0, j.pt()/1000.0 > 30.0)') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 1 == len([ln for ln in lines if "->pt()" in ln])
+
+
+def test_repeated_member_call_in_where_done_once():
+    r = atlas_xaod_dataset() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Where('lambda j: j.pt() > 30.0') \
+        .Select('lambda j: j.pt()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_pt = find_line_numbers_with("->pt()", lines)
+    assert 1 == len(l_pt)
+    assert l_pt[0] < find_line_with("if (", lines)
+
+
+def test_repeated_member_call_in_where_filled_in_if():
+    r = atlas_xaod_dataset() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Where('lambda j: j.pt() > 30.0') \
+        .Select('lambda j: j.pt()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_fill = find_line_with("Fill()", lines)
+    active_blocks = find_open_blocks(lines[:l_fill])
+    assert "if" in active_blocks[-1]
+
+
+def test_single_member_call_not_stored():
+    r = atlas_xaod_dataset() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: (j.pt(), j.eta())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 0 == len([ln for ln in lines if "cse" in ln])
+
+
+@pytest.mark.parametrize("selects", [
+    ['lambda e: {"j": e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()), "el": e.Electrons("Electrons").Select(lambda j: j.pt())}'],
+    ['lambda e: (e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()), e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()*2))'],
+    ['lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.eta() > 0).Count() + j.eta())'],
+    ['lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 25).Count()', 'lambda n: (n >= 2, n)'],
+])
+def test_no_single_use_locals(selects):
+    'The same text, called on different objects, is not a repeat - and neither is one call used in two places'
+    import re
+    q = atlas_xaod_dataset()
+    for s in selects:
+        q = q.Select(s)
+    r = q.value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    cse_vars = {m for ln in lines for m in re.findall(r'\bcse[0-9]+\b', ln)}
+    for v in cse_vars:
+        # Declared, set, and then used more than once
+        assert len([m for ln in lines for m in re.findall(rf'\b{v}\b', ln)]) >= 4
+
+
+def test_repeated_deltar_done_once():
+    r = atlas_xaod_dataset() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: (DeltaR(j.eta(), j.phi(), 0.0, 1.0), DeltaR(j.eta(), j.phi(), 0.0, 1.0) < 0.4)') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 1 == len([ln for ln in lines if "func_adl::DeltaR(" in ln])
+
+
+def test_deltar_cut_compares_squares():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Electrons("Electrons").Where(lambda el: DeltaR(j.eta(), j.phi(), el.eta(), el.phi()) < 0.4).Count())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 1 == len([ln for ln in lines if "func_adl::DeltaR2(" in ln])
+    assert 0 == len([ln for ln in lines if "func_adl::DeltaR(" in ln])
+    l_test = find_line_with("<0.16)", lines)
+    assert lines[l_test].strip().startswith('if (')
+
+
+def test_repeated_collection_pair_loop():
+    r = atlas_xaod_dataset() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j1: e.Jets("AntiKt4EMTopoJets").Where(lambda j2: j2.pt() > j1.pt()).Count())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 2 == len([ln for ln in lines if ln.strip().startswith("for (")])
+    l_if = find_line_with("if (", lines)
+    assert "i_obj1->pt()>i_obj1->pt()" not in lines[l_if]
+
+
+def test_collection_retrieved_once_for_dict_columns():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: {"pt": e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()), "eta": e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.eta())}') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 1 == len([ln for ln in lines if "retrieve(" in ln])
+
+
+def test_collection_retrieved_before_outer_loop():
+    r = atlas_xaod_dataset() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Electrons("Electrons").Where(lambda el: el.pt() > j.pt()).Count())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_electrons = find_line_with('"Electrons"', lines)
+    l_first_loop = find_line_with("for (", lines)
+    assert l_electrons < l_first_loop
+    assert 2 == len([ln for ln in lines if "retrieve(" in ln])
+
+
+def test_different_collections_retrieved_separately():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: {"j1": e.Jets("AntiKt4EMTopoJets").Count(), "j2": e.Jets("AntiKt4LCTopoJets").Count()}') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 2 == len([ln for ln in lines if "retrieve(" in ln])
+
+
+def test_event_level_member_call_moved_out_of_loop():
+    r = atlas_xaod_dataset() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > e.EventInfo("EventInfo").eventNumber())') \
+        .Select('lambda j: j.eta()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_event_number = find_line_with("->eventNumber()", lines)
+    assert l_event_number < find_line_with("for (", lines)
+
+
+def test_outer_loop_member_call_moved_out_of_inner_loop():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Tracks("InDetTrackParticles").Where(lambda t: t.pt() > j.pt()).Count())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_loops = find_line_numbers_with("for (", lines)
+    assert 2 == len(l_loops)
+    l_jet_pt = [i for i, ln in enumerate(lines) if "cse" in ln and "->pt();" in ln]
+    assert 1 == len(l_jet_pt)
+    assert l_loops[0] < l_jet_pt[0] < l_loops[1]
+
+
+def test_loop_invariant_deltar_moved_out_of_loop():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Tracks("InDetTrackParticles").Where(lambda t: DeltaR(j.eta(), j.phi(), 0.0, 1.0) < t.pt()).Count())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_loops = find_line_numbers_with("for (", lines)
+    l_deltar = find_line_with("func_adl::DeltaR(", lines)
+    assert l_loops[0] < l_deltar < l_loops[1]
+
+
+def test_accumulator_stays_in_loop():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()).Aggregate(0, lambda acc, v: acc + v)') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 0 == len([ln for ln in lines if "cse" in ln])
+
+
+def test_constants_folded():
+    r = atlas_xaod_dataset() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Where('lambda j: True and j.pt()/1000.0/1.0 > 20*1000/1000') \
+        .Select('lambda j: j.eta()*abs(-3)') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 0 == len([ln for ln in lines if "bool_op" in ln])
+    l_if = find_line_with("if (", lines)
+    assert "/1000.0)>20.0)" in lines[l_if]
+    assert "/1.0" not in lines[l_if]
+    _ = find_line_with("eta()*3)", lines)
+
+
+def test_where_true_dropped():
+    r = atlas_xaod_dataset() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Where('lambda j: 1 < 2') \
+        .Select('lambda j: j.pt()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 0 == len([ln for ln in lines if "if (" in ln])
+
+
+def test_range_is_a_counting_loop():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: Range(0, j.nTracks()).Select(lambda i: i*2))') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 0 == len([ln for ln in lines if "iota" in ln or "std::vector" in ln])
+    l_for = find_line_with("for (int", lines)
+    assert "= 0;" in lines[l_for]
+    assert "++)" in lines[l_for]
+
+    # The upper bound is calculated once, before the loop
+    l_end = find_line_with("nTracks()", lines)
+    assert l_end < l_for
+    assert "nTracks()" not in lines[l_for]
+
+
+def test_range_bound_calculated_before_use():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: Range(1, e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30.0).Count()).Where(lambda i: i > 2).Count()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_count = find_line_with("+1)", lines)
+    l_end = find_line_with("int end", lines)
+    assert l_count < l_end
+    _ = find_line_with("= 1;", lines)
+
+
+def test_any_breaks_on_first_match():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Any(lambda j: j.pt() > 10.0)') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    _ = find_line_with("bool aggResult", lines)
+    assert "(false)" in lines[find_line_with("bool aggResult", lines)]
+    l_if = find_line_with("if ((", lines)
+    assert "= true;" in lines[l_if + 2]
+    assert "break;" in lines[l_if + 3]
+
+
+def test_all_breaks_on_first_failure():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").All(lambda j: j.pt() > 10.0)') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert "(true)" in lines[find_line_with("bool aggResult", lines)]
+    l_if = find_line_with("if (!", lines)
+    assert "= false;" in lines[l_if + 2]
+    assert "break;" in lines[l_if + 3]
+
+
+def test_any_nested_breaks_inner_loop():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: e.Tracks("InDetTrackParticles").Any(lambda t: t.pt() > j.pt())).Count()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_break = find_line_with("break;", lines)
+    active_blocks = find_open_blocks(lines[:l_break])
+    assert 2 == ["for" in a for a in active_blocks].count(True)
+
+    # The outer loop goes on to count the jet.
+    assert find_line_with("+1)", lines) > l_break
+
+
+def test_any_of_flattened_sequence_breaks_inner_loop_only():
+    # The break can only leave the inner loop - the answer is still kept.
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").SelectMany(lambda j: e.Tracks("InDetTrackParticles")).Any(lambda t: t.pt() > 10.0)') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_set = find_line_with("= true;", lines)
+    active_blocks = find_open_blocks(lines[:l_set])
+    assert 2 == ["for" in a for a in active_blocks].count(True)
+
+
+def _count_break_limit(lines):
+    'The number the count stops at, or None if it does not stop early'
+    l_break = find_line_with("break;", lines, throw_if_not_found=False)
+    if l_break < 0:
+        return None
+    return lines[l_break - 2].split(">=")[1].rstrip("))")
+
+
+def test_count_compare_stops_at_threshold():
+    r = atlas_xaod_dataset() \
+        .Where('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 25000.0).Count() >= 2') \
+        .Select('lambda e: e.EventInfo("EventInfo").runNumber()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert "2" == _count_break_limit(lines)
+
+    # The break is inside the jet loop and the Where's if statement.
+    active_blocks = find_open_blocks(lines[:find_line_with("break;", lines)])
+    assert 1 == ["for" in a for a in active_blocks].count(True)
+    assert "pt()" in active_blocks[-2]
+
+
+@pytest.mark.parametrize("compare, limit", [
+    ("{0} > 2", "3"),
+    ("{0} == 0", "1"),
+    ("{0} < 3", "3"),
+    ("{0} != 1", "2"),
+    ("2 < {0}", "3"),
+])
+def test_count_compare_limits(compare, limit):
+    count = 'e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 25000.0).Count()'
+    r = atlas_xaod_dataset() \
+        .Select(f'lambda e: {compare.format(count)}') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert limit == _count_break_limit(lines)
+
+
+def test_count_compare_to_float_runs_to_end():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 25000.0).Count() > 2.5') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert _count_break_limit(lines) is None
+
+
+def test_count_compare_sharing_loop_runs_to_end():
+    # The two counts are done in the same loop, so the compare can't cut it short.
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 25.0)') \
+        .Select('lambda js: (js.Count(), js.Count() >= 2)') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert _count_break_limit(lines) is None
+
+
+def _jet_query(query: str, context=None):
+    'Run `query` over the jets, in the translation `context`'
+    return atlas_xaod_dataset(context=context) \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select(query) \
+        .value()
+
+
+def _column_types(r):
+    'The C++ types of the output columns'
+    return [d.split()[0] for d in r.QueryVisitor.class_declaration_code() if d.split()[-1].startswith('_col')]
+
+
+def test_float_divided_by_literal_is_double():
+    r = _jet_query('lambda j: j.getAttributeFloat("x")/1000.0')
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert '/1000.0)' in lines[find_line_with("/1000.0", lines)]
+    assert ['double'] == _column_types(r)
+
+
+def test_precise_types_keep_float():
+    r = _jet_query('lambda j: j.getAttributeFloat("x")/1000.0', TranslationContext(precise_types=True))
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert '/1000.0f)' in lines[find_line_with("/1000.0", lines)]
+    assert ['float'] == _column_types(r)
+
+
+def test_precise_types_if_expression():
+    r = _jet_query('lambda j: j.getAttributeFloat("x") if j.pt() > 0 else 0.0', TranslationContext(precise_types=True))
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert lines[find_line_with("if_else_result", lines)].strip().startswith('float ')
+
+
+def test_precise_types_double_stays_double():
+    r = _jet_query('lambda j: j.pt()/1000.0', TranslationContext(precise_types=True))
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert '/1000.0)' in lines[find_line_with("/1000.0", lines)]
+    assert ['double'] == _column_types(r)
+
+
+def test_float_branches():
+    r = _jet_query('lambda j: j.pt()/1000.0', TranslationContext(output_options=ttree_output_options(float_branches=True)))
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert '/1000.0)' in lines[find_line_with("/1000.0", lines)]
+    assert ['float'] == _column_types(r)
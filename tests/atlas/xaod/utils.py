@@ -1,6 +1,6 @@
 import ast
 from pathlib import Path
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Union
 
 import awkward as ak
 import pandas as pd
@@ -10,6 +10,7 @@ from func_adl_xAOD.atlas.xaod.executor import atlas_xaod_executor
 from func_adl_xAOD.atlas.xaod.query_ast_visitor import \
     atlas_xaod_query_ast_visitor
 from func_adl_xAOD.common.cpp_representation import cpp_sequence, cpp_variable
+from func_adl_xAOD.common.translation_context import TranslationContext
 from func_adl_xAOD.common.util_scope import top_level_scope
 from tests.utils.base import LocalFile, dataset, dummy_executor
 
@@ -26,8 +27,8 @@ class atlas_xaod_dummy_executor(dummy_executor):
 
 
 class atlas_xaod_dataset(dataset):
-    def __init__(self, qastle_roundtrip=False):
-        super().__init__(qastle_roundtrip=qastle_roundtrip)
+    def __init__(self, qastle_roundtrip=False, context: Optional[TranslationContext] = None):
+        super().__init__(qastle_roundtrip=qastle_roundtrip, context=context)
 
     def get_dummy_executor_obj(self) -> dummy_executor:
         return atlas_xaod_dummy_executor()
@@ -0,0 +1,47 @@
+# Test the passes that prepare the aggregate terminals
+import ast
+
+from func_adl_xAOD.common.aggregates import fuse_aggregates, fused_group, normalize_aggregates
+
+
+def _normalize(text: str) -> str:
+    return ast.unparse(normalize_aggregates().visit(ast.parse(text)))
+
+
+def _tuple(text: str) -> ast.Tuple:
+    t = ast.parse(text).body[0].value  # type: ignore
+    fuse_aggregates(t)
+    return t
+
+
+def test_len_is_count():
+    assert 'Count(jets)' == _normalize('len(jets)')
+
+
+def test_count_with_predicate():
+    assert 'Count(Where(jets, lambda j: j.pt() > 30))' == _normalize('Count(jets, lambda j: j.pt() > 30)')
+
+
+def test_sum_with_selector():
+    assert 'Sum(Select(jets, lambda j: j.pt()))' == _normalize('Sum(jets, lambda j: j.pt())')
+
+
+def test_aggregate_not_changed():
+    assert 'Aggregate(jets, 0, lambda acc, j: acc + 1)' == _normalize('Aggregate(jets, 0, lambda acc, j: acc + 1)')
+
+
+def test_same_collection_fused():
+    t = _tuple('(Count(e.Jets()), Sum(Select(e.Jets(), lambda j: j.pt())))')
+    count, total = t.elts
+    assert fused_group(count) is fused_group(total)
+    assert count.args[0] is total.args[0].args[0]  # type: ignore
+
+
+def test_different_collections_not_fused():
+    t = _tuple('(Count(e.Jets()), Count(e.Electrons()))')
+    assert all(fused_group(a) is None for a in t.elts)
+
+
+def test_nested_sequence_not_fused():
+    t = _tuple('(Count(e.Jets()), Sum(Select(e.Jets(), lambda j: Count(j.tracks()))))')
+    assert all(fused_group(a) is None for a in t.elts)
@@ -0,0 +1,54 @@
+# Test the constant folding pass
+import ast
+
+from func_adl_xAOD.common.constant_folding import fold_constants
+
+
+def _fold(text: str) -> str:
+    return ast.unparse(fold_constants().visit(ast.parse(text)))
+
+
+def test_fold_arithmetic():
+    assert '20.0' == _fold('20*1000/1000')
+
+
+def test_integer_divide_not_exact():
+    assert '7 / 2' == _fold('7/2')
+
+
+def test_fold_function():
+    assert '3' == _fold('abs(-3)')
+
+
+def test_neutral_bool_removed():
+    assert 'x > 5' == _fold('True and (x > 5)')
+
+
+def test_dominating_bool():
+    assert 'False' == _fold('False and (x > 5)')
+
+
+def test_non_bool_operand_kept():
+    assert 'True and x' == _fold('True and x')
+
+
+def test_float_identity_kept_for_unknown_type():
+    assert 'x / 1.0' == _fold('x/1.0')
+
+
+def test_float_identity_dropped_for_double():
+    assert 'x / 1000.0' == _fold('x/1000.0/1.0')
+
+
+def test_int_identity_dropped():
+    assert 'x' == _fold('x*1 + 0')
+
+
+def test_bool_identity_kept():
+    assert '(j.pt() > 10) * 1' == _fold('(j.pt() > 10)*1')
+    assert '0 + (x and y)' == _fold('0 + (x and y)')
+    assert '(not x) - 0' == _fold('(not x) - 0')
+
+
+def test_where_true_removed():
+    assert 'jets' == _fold('Where(jets, lambda j: 1 < 2)')
@@ -1,6 +1,7 @@
 import pytest
-from func_adl_xAOD.common.math_utils import DeltaR
+from func_adl_xAOD.common.math_utils import DeltaPhi, DeltaR, DeltaR2, InvariantMass
 from tests.atlas.xaod.utils import atlas_xaod_dataset
+from tests.utils.general import get_lines_of_code
 
 
 def test_deltaR_call():
@@ -13,3 +14,25 @@ def test_deltaR_call():
 def test__bad_deltaR_call():
     with pytest.raises(ValueError):
         atlas_xaod_dataset().Select(lambda e: DeltaR(1.0, 1.0, 1.0)).value()  # type: ignore
+
+
+def test_deltaR_uses_kinematics_header():
+    r = atlas_xaod_dataset().Select(lambda e: DeltaR(1.0, 1.0, 1.0, 1.0)).value()
+    assert 'func_adl_kinematics.h' in r.QueryVisitor.include_files()
+    assert any('func_adl::DeltaR(1.0, 1.0, 1.0, 1.0)' in ln for ln in get_lines_of_code(r))
+
+
+@pytest.mark.parametrize("query, cpp", [
+    (lambda e: DeltaR2(1.0, 2.0, 3.0, 4.0), 'func_adl::DeltaR2(1.0, 2.0, 3.0, 4.0)'),
+    (lambda e: DeltaPhi(1.0, 2.0), 'func_adl::DeltaPhi(1.0, 2.0)'),
+    (lambda e: InvariantMass(1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0), 'func_adl::InvariantMass(1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0)'),
+])
+def test_kinematics_call(query, cpp):
+    r = atlas_xaod_dataset().Select(query).value()
+    assert any(cpp in ln for ln in get_lines_of_code(r))
+
+
+def test_bad_invariant_mass_call():
+    with pytest.raises(ValueError) as e:
+        atlas_xaod_dataset().Select(lambda e: InvariantMass(1.0, 2.0, 3.0, 4.0)).value()  # type: ignore
+    assert 'InvariantMass' in str(e.value)
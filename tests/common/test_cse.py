@@ -0,0 +1,65 @@
+# Test the marking of repeated expressions
+import ast
+
+from func_adl_xAOD.common.cse import (is_repeated, is_shared,
+                                      mark_repeated_expressions)
+
+
+def _calls(a: ast.AST):
+    return [n for n in ast.walk(a) if isinstance(n, ast.Call) and isinstance(n.func, ast.Attribute)]
+
+
+def test_repeated_member_call_marked():
+    a = mark_repeated_expressions(ast.parse('(j.pt()/1000.0, j.pt() > 30.0)'))
+    calls = _calls(a)
+    assert 2 == len(calls)
+    assert all(is_repeated(c) for c in calls)
+
+
+def test_different_member_calls_not_marked():
+    a = mark_repeated_expressions(ast.parse('(j.pt(), j.eta())'))
+    assert not any(is_repeated(c) for c in _calls(a))
+
+
+def test_different_arguments_not_marked():
+    a = mark_repeated_expressions(ast.parse('(j.getAttribute("a"), j.getAttribute("b"))'))
+    assert not any(is_repeated(c) for c in _calls(a))
+
+
+def test_func_adl_calls_not_marked():
+    a = mark_repeated_expressions(ast.parse('(Count(jets), Count(jets))'))
+    assert not any(is_repeated(n) for n in ast.walk(a))
+
+
+def test_shared_node_marked():
+    jets = ast.parse('e.Jets()').body[0].value  # type: ignore
+    a = ast.Tuple(elts=[ast.Call(func=ast.Name(id='Count'), args=[jets], keywords=[]),
+                        ast.Call(func=ast.Name(id='First'), args=[jets], keywords=[])])
+    mark_repeated_expressions(a)
+    assert is_shared(jets)
+    assert not is_shared(a.elts[0])
+
+
+def test_same_call_in_one_lambda_marked():
+    a = mark_repeated_expressions(ast.parse('Select(jets, lambda j: (j.pt()/1000.0, j.pt() > 30.0))'))
+    assert all(is_repeated(c) for c in _calls(a))
+
+
+def test_same_call_on_different_collections_not_marked():
+    a = mark_repeated_expressions(ast.parse('(Select(jets, lambda j: j.pt()), Select(electrons, lambda j: j.pt()))'))
+    assert not any(is_repeated(c) for c in _calls(a))
+
+
+def test_same_call_through_where_marked():
+    a = mark_repeated_expressions(ast.parse('Select(Where(jets, lambda j: j.pt() > 30.0), lambda j: j.pt())'))
+    assert all(is_repeated(c) for c in _calls(a))
+
+
+def test_same_call_after_select_not_marked():
+    a = mark_repeated_expressions(ast.parse('Select(Select(jets, lambda j: j.pt()), lambda j: j.pt())'))
+    assert not any(is_repeated(c) for c in _calls(a))
+
+
+def test_same_call_in_inner_lambda_not_marked():
+    a = mark_repeated_expressions(ast.parse('Select(jets, lambda j: Count(Where(jets, lambda j: j.eta() > 0)) + j.eta())'))
+    assert not any(is_repeated(c) for c in _calls(a))
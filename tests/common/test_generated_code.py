@@ -87,3 +87,84 @@ def test_get_rep_hidden():
     assert 10 == g.get_rep("dude")
     g.pop_scope()
     assert 5 == g.get_rep("dude")
+
+
+def test_get_rep_at_insertion_point_deeper():
+    g = generated_code()
+    g.set_rep_at_insertion_point("dude", 5)
+    g.add_statement(statement.iftest("true"))
+    assert 5 == g.get_rep_at_insertion_point("dude")
+
+
+def test_get_rep_at_insertion_point_block_started_before():
+    g = generated_code()
+    g.add_statement(statement.iftest("true"))
+    s_if = g.current_scope()
+    g.pop_scope()
+    g.set_rep_at_insertion_point("dude", 5)
+    assert 5 == g.get_rep_at_insertion_point("dude")
+
+    # The if statement comes before the value was set, so it can't use it.
+    g.set_scope(s_if)
+    assert None is g.get_rep_at_insertion_point("dude")
+
+
+def test_get_rep_at_insertion_point_missing():
+    g = generated_code()
+    g.add_statement(statement.iftest("true"))
+    assert None is g.get_rep_at_insertion_point("dude")
+
+
+def test_hoisted_statement_goes_before_current_block():
+    g = generated_code()
+    s_loop = statement.iftest("true")
+    g.add_statement(s_loop)
+    s_hoisted = statement.set_var("v1", "true")
+    with g.hoisted(g.current_scope().parent()):
+        g.add_statement(s_hoisted)
+    assert g.current_scope().block() is s_loop
+    assert [s_hoisted, s_loop] == g._block._statements
+
+
+def test_hoisted_rep_good_in_current_block():
+    g = generated_code()
+    g.add_statement(statement.iftest("true"))
+    with g.hoisted(g.current_scope().parent()):
+        g.add_statement(statement.set_var("v1", "true"))
+        g.set_rep_at_insertion_point("dude", 5)
+    assert 5 == g.get_rep_at_insertion_point("dude")
+
+
+def test_hoisted_to_current_scope():
+    g = generated_code()
+    s1 = statement.set_var("v1", "true")
+    with g.hoisted(g.current_scope()):
+        g.add_statement(s1)
+    assert [s1] == g._block._statements
+
+
+def test_is_in_loop_below():
+    g = generated_code()
+    top = g.current_scope()
+    g.add_statement(statement.loop("j", "jets"))
+    s_loop = g.current_scope()
+    g.add_statement(statement.iftest("true"))
+
+    assert g.is_in_loop_below(top)
+    assert not g.is_in_loop_below(s_loop)
+    assert not g.is_in_loop_below(g.current_scope())
+
+
+def test_class_variable_with_key_declared_once():
+    import func_adl_xAOD.common.cpp_types as ctyp
+    from func_adl_xAOD.common.cpp_representation import cpp_value, cpp_variable
+    from func_adl_xAOD.common.util_scope import top_level_scope
+
+    def accessor(name: str):
+        return cpp_variable(name, top_level_scope(), ctyp.terminal('SG::AuxElement::ConstAccessor<float>'),
+                            initial_value=cpp_value('"emf"', top_level_scope(), None))
+
+    g = generated_code()
+    first = g.declare_class_variable(accessor('_acc1'), key='emf')
+    assert g.declare_class_variable(accessor('_acc2'), key='emf') is first
+    assert ['SG::AuxElement::ConstAccessor<float> _acc1{"emf"};\n'] == g.class_declaration_code()
@@ -0,0 +1,40 @@
+# Test the rewrite of DeltaR comparisons to squared distances
+import ast
+
+from func_adl_xAOD.common.math_utils import square_deltar_comparisons
+
+
+def _square(text: str) -> str:
+    return ast.unparse(square_deltar_comparisons(ast.parse(text)))
+
+
+def test_less_than():
+    assert 'DeltaR2(a, b, c, d) < 0.16' == _square('DeltaR(a, b, c, d) < 0.4')
+
+
+def test_constant_on_the_left():
+    assert '0.25 <= DeltaR2(a, b, c, d)' == _square('0.5 <= DeltaR(a, b, c, d)')
+
+
+def test_range():
+    assert '0.01 < DeltaR2(a, b, c, d) < 0.16' == _square('0.1 < DeltaR(a, b, c, d) < 0.4')
+
+
+def test_integer_constant():
+    assert 'DeltaR2(a, b, c, d) > 4' == _square('DeltaR(a, b, c, d) > 2')
+
+
+def test_negative_constant_not_squared():
+    assert 'DeltaR(a, b, c, d) > -1.0' == _square('DeltaR(a, b, c, d) > -1.0')
+
+
+def test_equality_not_squared():
+    assert 'DeltaR(a, b, c, d) == 0.4' == _square('DeltaR(a, b, c, d) == 0.4')
+
+
+def test_variable_not_squared():
+    assert 'DeltaR(a, b, c, d) < x' == _square('DeltaR(a, b, c, d) < x')
+
+
+def test_value_used_elsewhere_not_squared():
+    assert '(DeltaR(a, b, c, d), DeltaR(a, b, c, d) < 0.4)' == _square('(DeltaR(a, b, c, d), DeltaR(a, b, c, d) < 0.4)')
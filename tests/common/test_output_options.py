@@ -0,0 +1,32 @@
+# Test the output TTree options
+import pytest
+
+from func_adl_xAOD.common.output_options import ttree_output_options
+
+
+def test_no_compression():
+    assert ttree_output_options().compression_settings() is None
+
+
+def test_default_level():
+    assert 505 == ttree_output_options(compression='zstd').compression_settings()
+
+
+def test_explicit_level():
+    assert 109 == ttree_output_options(compression='zlib', level=9).compression_settings()
+
+
+def test_unknown_algorithm():
+    with pytest.raises(ValueError) as e:
+        ttree_output_options(compression='gzip')
+    assert 'gzip' in str(e.value)
+
+
+def test_level_needs_algorithm():
+    with pytest.raises(ValueError):
+        ttree_output_options(level=4)
+
+
+def test_bad_basket_size():
+    with pytest.raises(ValueError):
+        ttree_output_options(basket_size=0)
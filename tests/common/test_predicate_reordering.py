@@ -0,0 +1,50 @@
+# Test the cost based reordering of filter tests
+import ast
+
+from func_adl_xAOD.common.cpp_functions import find_known_functions
+from func_adl_xAOD.common.predicate_reordering import (expression_cost,
+                                                       is_movable,
+                                                       reorder_conjuncts)
+
+
+def _reorder(text: str) -> str:
+    return ast.unparse(reorder_conjuncts().visit(ast.parse(text)))
+
+
+def _cost(text: str) -> int:
+    return expression_cost(find_known_functions().visit(ast.parse(text)))
+
+
+def test_member_call_cheaper_than_loop():
+    assert _cost('j.pt() > 30') < _cost('Count(Where(e.Jets(), lambda j: j.pt() > 30)) > 0')
+
+
+def test_function_cheaper_than_member_call():
+    assert _cost('sqrt(x)') < _cost('j.pt()')
+
+
+def test_cheap_test_moved_first():
+    assert 'j.pt() > 30 and Count(jets) > 2' == _reorder('Count(jets) > 2 and j.pt() > 30')
+
+
+def test_equal_cost_order_kept():
+    assert 'j.pt() > 30 and j.eta() < 2' == _reorder('j.pt() > 30 and j.eta() < 2')
+
+
+def test_or_not_reordered():
+    assert 'Count(jets) > 2 or j.pt() > 30' == _reorder('Count(jets) > 2 or j.pt() > 30')
+
+
+def test_guarded_test_stays_put():
+    text = 'Count(jets) > 0 and First(jets).pt() > 30 and j.pt() > 5'
+    assert ast.unparse(ast.parse(text)) == _reorder(text)
+
+
+def test_division_by_variable_not_movable():
+    assert not is_movable(ast.parse('j.pt()/j.m() > 2'))
+    assert is_movable(ast.parse('j.pt()/1000.0 > 2'))
+
+
+def test_consecutive_where_reordered():
+    assert 'Where(Where(jets, lambda j: j.pt() > 30), lambda j: Count(j.tracks()) > 2)' \
+        == _reorder('Where(Where(jets, lambda j: Count(j.tracks()) > 2), lambda j: j.pt() > 30)')
@@ -0,0 +1,35 @@
+# Test finding the package version that goes into the translation cache key
+import sys
+from types import SimpleNamespace
+
+import func_adl_xAOD.common.translation_cache as tcache
+
+
+def test_package_version_from_pkg_resources(monkeypatch):
+    'Without importlib.metadata (python 3.7) the version comes from pkg_resources'
+    monkeypatch.setitem(sys.modules, 'importlib.metadata', None)
+    monkeypatch.setitem(sys.modules, 'importlib_metadata', None)
+    monkeypatch.setitem(sys.modules, 'pkg_resources',
+                        SimpleNamespace(get_distribution=lambda name: SimpleNamespace(version='1.2.3')))
+    assert '1.2.3' == tcache._installed_version()
+
+
+def test_package_version_not_installed(monkeypatch):
+    'With no version to be found, the key changes with the package source'
+    monkeypatch.setattr(tcache, '_installed_version', lambda: None)
+    tcache.package_version.cache_clear()
+    try:
+        v = tcache.package_version()
+    finally:
+        tcache.package_version.cache_clear()
+    assert v == f'source-{tcache._source_hash()}'
+    assert v != 'unknown'
+
+
+def test_package_version_installed(monkeypatch):
+    monkeypatch.setattr(tcache, '_installed_version', lambda: '2.0')
+    tcache.package_version.cache_clear()
+    try:
+        assert '2.0' == tcache.package_version()
+    finally:
+        tcache.package_version.cache_clear()
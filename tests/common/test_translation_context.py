@@ -0,0 +1,39 @@
+import func_adl_xAOD.common.cpp_types as ctyp
+from func_adl_xAOD.common.cpp_vars import unique_name
+from func_adl_xAOD.common.translation_context import (TranslationContext,
+                                                      current_context)
+
+
+def test_unique_name_counts_per_context():
+    with TranslationContext():
+        assert unique_name('jet') == 'jet0'
+        assert unique_name('jet', is_class_var=True) == '_jet1'
+    with TranslationContext():
+        assert unique_name('jet') == 'jet0'
+
+
+def test_nested_context_restored():
+    outer = TranslationContext()
+    with outer:
+        with TranslationContext() as inner:
+            assert current_context() is inner
+        assert current_context() is outer
+
+
+def test_method_type_layered_over_defaults():
+    ctyp.add_method_type_info("bogus_ctx_default", "pt", ctyp.terminal('double'))
+    c = TranslationContext()
+    c.add_method_type_info("bogus_ctx_default", "eta", ctyp.terminal('float'))
+
+    assert str(c.method_type_info("bogus_ctx_default", "pt")) == 'double'
+    assert str(c.method_type_info("bogus_ctx_default", "eta")) == 'float'
+    assert c.method_type_info("bogus_ctx_default", "phi") is None
+    assert ctyp.method_type_info("bogus_ctx_default", "eta") is None
+    assert TranslationContext().method_type_info("bogus_ctx_default", "eta") is None
+
+
+def test_function_mapping_layered_over_defaults():
+    c = TranslationContext()
+    c.functions['my_func'] = c.functions['sin']
+    assert 'my_func' in c.functions
+    assert 'my_func' not in TranslationContext().functions
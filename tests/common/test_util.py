@@ -33,3 +33,10 @@ def test_accurate_type_float_and_double():
     t2 = ctyp.terminal('float', False)
     r = most_accurate_type([t1, t2])
     assert r._type == 'double'
+
+
+def test_accurate_type_bool_is_int():
+    t1 = ctyp.terminal('bool', False)
+    t2 = ctyp.terminal('int', False)
+    assert most_accurate_type([t1, t1])._type == 'int'
+    assert most_accurate_type([t1, t2])._type == 'int'
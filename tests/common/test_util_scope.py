@@ -61,3 +61,55 @@ def test_top_level_starts_with_top_level():
     top2 = gc_scope_top_level()
 
     assert top1.starts_with(top2)
+
+
+def test_scope_is_interned():
+    g = generated_code()
+    s1 = statement.iftest("true")
+    g.add_statement(s1)
+    scope_1 = g.current_scope()
+    g.pop_scope()
+    g.set_scope(scope_1)
+
+    assert g.current_scope() is scope_1
+    assert g.current_scope().parent().child(s1) is scope_1
+
+
+def test_starts_with_deeper_scope():
+    g = generated_code()
+    g.add_statement(statement.iftest("true"))
+    scope_1 = g.current_scope()
+    g.add_statement(statement.iftest("true"))
+    g.add_statement(statement.iftest("true"))
+    scope_3 = g.current_scope()
+
+    assert scope_3.starts_with(scope_1)
+    assert scope_3.starts_with(scope_3)
+    assert not scope_1.starts_with(scope_3)
+
+
+def test_starts_with_sibling_scope():
+    g = generated_code()
+    g.add_statement(statement.iftest("true"))
+    scope_1 = g.current_scope()
+    g.pop_scope()
+    g.add_statement(statement.iftest("true"))
+    g.add_statement(statement.iftest("true"))
+    scope_2 = g.current_scope()
+
+    assert not scope_2.starts_with(scope_1)
+    assert not scope_1.starts_with(scope_2)
+
+
+def test_scope_slice_and_frame_statements():
+    g = generated_code()
+    s1 = statement.iftest("true")
+    s2 = statement.iftest("true")
+    g.add_statement(s1)
+    scope_1 = g.current_scope()
+    g.add_statement(s2)
+    scope_2 = g.current_scope()
+
+    assert scope_2[-1] is scope_1
+    assert scope_2.frame_statements(-1) is s2
+    assert scope_2.frame_statements(1) is s1
@@ -5,6 +5,7 @@ import asyncio
 import logging
 import tempfile
 
+from contextlib import nullcontext
 from typing import Any, Callable, List, Optional, Union
 from pathlib import Path
 from abc import ABC, abstractmethod
@@ -16,6 +17,7 @@ from func_adl_xAOD.common.executor import executor
 from func_adl_xAOD.common.ast_to_cpp_translator import query_ast_visitor
 from func_adl_xAOD.common.util_scope import top_level_scope
 from func_adl_xAOD.common.cpp_representation import cpp_sequence, cpp_variable
+from func_adl_xAOD.common.translation_context import TranslationContext
 
 # Use this to turn on dumping of output and C++
 dump_running_log = True
@@ -143,13 +145,14 @@ class dummy_executor(ABC):
     def get_visitor_obj(self) -> query_ast_visitor:
         pass
 
-    def evaluate(self, a: ast.AST):
+    def evaluate(self, a: ast.AST, context: Optional[TranslationContext] = None):
         rnr = self.get_executor_obj()
-        self.QueryVisitor = self.get_visitor_obj()
-        # TODO: #126 query_ast_visitor needs proper arguments
-        a_transformed = rnr.apply_ast_transformations(a)
-        self.ResultRep = \
-            self.QueryVisitor.get_as_ROOT(a_transformed)
+        with (context if context is not None else nullcontext()):
+            self.QueryVisitor = self.get_visitor_obj()
+            # TODO: #126 query_ast_visitor needs proper arguments
+            a_transformed = rnr.apply_ast_transformations(a)
+            self.ResultRep = \
+                self.QueryVisitor.get_as_ROOT(a_transformed)
 
     def get_result(self, q_visitor, result_rep):
         'Got the result. Cache for use in tests'
@@ -159,9 +162,10 @@ class dummy_executor(ABC):
 
 
 class dataset(EventDataset, ABC):
-    def __init__(self, qastle_roundtrip=False):
+    def __init__(self, qastle_roundtrip=False, context: Optional[TranslationContext] = None):
         EventDataset.__init__(self)
         self._q_roundtrip = qastle_roundtrip
+        self._context = context
 
     def __repr__(self) -> str:
         # When we need to move into a representation, use
@@ -188,7 +192,7 @@ class dataset(EventDataset, ABC):
         iterator = cpp_variable("bogus-do-not-use", top_level_scope(), cpp_type=None)
         file.rep = cpp_sequence(iterator, iterator, top_level_scope())  # type: ignore
 
-        # Use the dummy executor to process this, and return it.
+        # Use the dummy executor to process this, in the translation context if one was given, and return it.
         exe = self.get_dummy_executor_obj()
-        exe.evaluate(a)
+        exe.evaluate(a, self._context)
         return exe